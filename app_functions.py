@@ -8,21 +8,626 @@ App functions for AP explorer
 @author: tbury
 """
 
+import os
+import re
+import atexit
+import sys
+import json
+import base64
+import time
+import pickle
+import platform
+import sysconfig
+import queue
+import hashlib
+import itertools
+import threading
+import multiprocessing
+import tempfile
+import zipfile
+import zlib
+import uuid
+import urllib.parse
+import contextvars
+import cProfile
+import pstats
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from concurrent.futures import ProcessPoolExecutor, CancelledError
+from concurrent.futures import wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 
 import numpy as np
 import pandas as pd
 
+import plotly
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 
-from dash import Dash, dcc, html
+from dash import Dash, dcc, html, Patch
+import flask
 
 
 import myokit as myokit
 
 cols = px.colors.qualitative.Plotly
 
+# Variables logged by the S1S2 and rate dependence protocols
+log_vars_protocol = ["environment.time", "membrane.v", "intracellular_ions.cai"]
+
+# Simulation pool and cancel flags of a worker process (see make_process_pool)
+_worker_pool = None
+_worker_cancel_flags = None
+
+# Format version of stored default results. Increment to invalidate them.
+DEFAULT_RESULTS_VERSION = 4
+
+# Number of points drawn per time series figure (traces are decimated to fit)
+display_points = 10000
+min_points_per_trace = 500
+
+# Form of the result IDs made by ResultStore.put
+_result_id_re = re.compile(r"^[0-9a-f]{32}$")
+
+# Timing records of request stages (see timing_span). Set AP_TIMING=0 to stop
+# printing them.
+timing_enabled = os.environ.get("AP_TIMING", "1") != "0"
+
+# Functions called with each timing record, e.g. RequestMetrics.observe_span
+span_handlers = []
+
+# Request ID and enclosing stages of the current request
+_request_id = contextvars.ContextVar("request_id", default=None)
+_span_path = contextvars.ContextVar("span_path", default=())
+
+
+def _json_default(value):
+    """Convert NumPy scalars (and anything else) in log records for JSON"""
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def log_record(record):
+    """Print a structured log record as one line of JSON"""
+    print(json.dumps(record, default=_json_default))
+
+
+@contextmanager
+def timing_span(stage, **fields):
+    """
+    Time a stage of a request and log it as a structured record
+
+    On exit, a record with the request ID, the path of enclosing stages
+    (e.g. "run_reg_stim/prepace"), the wall time in ms and the given fields
+    is printed as a line of JSON (see log_record). If the stage raises, the
+    exception type is recorded as "error".
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage
+    **fields
+        Fields of the record known at the start of the stage
+
+    Yields
+    ------
+    fields : dict
+        Fields of the record, which the stage can add to, e.g.
+        "simulated_ms" (model time simulated), "bytes" (size of the output)
+        or "cache" (hit, miss or warm)
+
+    """
+    path = _span_path.get() + (stage,)
+    token = _span_path.set(path)
+    t_start = time.perf_counter()
+    try:
+        yield fields
+    except BaseException as e:
+        fields["error"] = type(e).__name__
+        raise
+    finally:
+        _span_path.reset(token)
+        log_span(stage, time.perf_counter() - t_start, **fields)
+
+
+def log_span(stage, wall_time, **fields):
+    """
+    Log a stage timed by the caller, as a record of timing_span
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage. It is logged within the enclosing spans.
+    wall_time : float
+        Wall time (s) of the stage
+    **fields
+        Other fields of the record
+
+    """
+    record = {
+        "event": "span",
+        "request_id": _request_id.get(),
+        "span": "/".join(_span_path.get() + (stage,)),
+        "wall_ms": round(wall_time * 1000, 3),
+        **fields,
+    }
+    for handler in span_handlers:
+        handler(record)
+    if timing_enabled:
+        log_record(record)
+
+
+@contextmanager
+def request_span(name, request_id=None, **fields):
+    """
+    Outermost timing span of a request, which sets its request ID
+
+    The request ID is request_id if given, else the X-Request-ID header of
+    the Flask request being handled (if any), else a new random ID. Spans
+    opened within the block are logged with it.
+
+    """
+    if request_id is None and flask.has_request_context():
+        request_id = flask.request.headers.get("X-Request-ID")
+    if request_id is None:
+        request_id = uuid.uuid4().hex[:16]
+    token = _request_id.set(request_id)
+    try:
+        with timing_span(name, **fields) as span:
+            yield span
+    finally:
+        _request_id.reset(token)
+
+
+def timed_request(name):
+    """Decorator running each call of a (callback) function in request_span"""
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with request_span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# Directory to write profiles of requests to (see profiled). Requests can only
+# be profiled if it is set.
+profile_dir = os.environ.get("AP_PROFILE_DIR")
+
+# Number of functions and allocation sites listed in profile summaries
+profile_top = int(os.environ.get("AP_PROFILE_TOP", 30))
+
+# Only one request is profiled at a time, as tracemalloc traces all threads
+_profile_lock = threading.Lock()
+
+
+def profile_requested():
+    """
+    True if the Flask request being handled asks to be profiled, with an
+    X-AP-Profile header, or if it was sent from a page opened with a profile
+    query parameter (e.g. ?profile=1). Dash callback requests don't carry the
+    query string of the page, so it is read from their Referer header.
+    """
+    if not flask.has_request_context():
+        return False
+    flag = flask.request.headers.get("X-AP-Profile")
+    if flag is None:
+        query = urllib.parse.urlsplit(flask.request.referrer or "").query
+        flag = urllib.parse.parse_qs(query).get("profile", [""])[0]
+    return flag.lower() not in ("", "0", "false", "no")
+
+
+def params_hash(params):
+    """Short hash of a dict of (JSON serializable) parameters"""
+    data = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()[:12]
+
+
+def profiled(name, ignore=("n_clicks", "session_id")):
+    """
+    Decorator profiling calls of a (callback) function on request
+
+    If AP_PROFILE_DIR is set and the request asks to be profiled (see
+    profile_requested), the call is run under cProfile and tracemalloc.
+    <name>_<parameter hash>_<request ID>.prof (cProfile stats) and .txt (the
+    top functions by cumulative time and the top allocation sites) are
+    written to AP_PROFILE_DIR. The parameter hash is of the keyword
+    arguments of the call other than ignore, so profiles of the same
+    parameters can be compared. Simulations run in worker processes are not
+    profiled.
+
+    If AP_PROFILE_DIR is not set, fn is returned unchanged.
+
+    """
+
+    def decorator(fn):
+        if profile_dir is None:
+            return fn
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not profile_requested():
+                return fn(*args, **kwargs)
+            if not _profile_lock.acquire(blocking=False):
+                print("Not profiling {}: another profile is running".format(name))
+                return fn(*args, **kwargs)
+            try:
+                params = {
+                    key: value for key, value in kwargs.items() if key not in ignore
+                }
+                tag = "{}_{}_{}".format(
+                    name,
+                    params_hash([args, params]),
+                    _request_id.get() or time.strftime("%Y%m%d-%H%M%S"),
+                )
+                return _run_profiled(tag, fn, args, kwargs)
+            finally:
+                _profile_lock.release()
+
+        return wrapper
+
+    return decorator
+
+
+def _run_profiled(tag, fn, args, kwargs):
+    """Run fn under cProfile and tracemalloc and write the profile (see profiled)"""
+    profiler = cProfile.Profile()
+    tracemalloc.start(10)
+    t_start = time.perf_counter()
+    profiler.enable()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        profiler.disable()
+        wall_time = time.perf_counter() - t_start
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        path = os.path.join(profile_dir, tag)
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.dump_stats(path + ".prof")
+        snapshot = snapshot.filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        with open(path + ".txt", "w") as f:
+            f.write("Profile {}\n".format(tag))
+            f.write("Wall time: {:.3f} s\n".format(wall_time))
+            f.write("Peak traced memory: {:.1f} MB\n\n".format(peak / 2**20))
+            f.write("Top {} allocation sites:\n".format(profile_top))
+            for stat in snapshot.statistics("lineno")[:profile_top]:
+                f.write("{}\n".format(stat))
+            f.write("\nTop {} functions by cumulative time:\n".format(profile_top))
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats("cumulative").print_stats(profile_top)
+        print("Profile written to {}.prof".format(path))
+
+
+def _format_labels(labels):
+    """Labels of a sample in the Prometheus text format"""
+    if len(labels) == 0:
+        return ""
+    items = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        items.append('{}="{}"'.format(key, value.replace("\n", "\\n")))
+    return "{" + ",".join(items) + "}"
+
+
+def _format_value(value):
+    """Value of a sample in the Prometheus text format"""
+    if isinstance(value, int):
+        return str(value)
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class RequestMetrics:
+    """
+    Aggregate metrics of requests, served in the Prometheus text format
+
+    Latency, model time simulated, payload sizes and cache lookups are
+    accumulated from timing records of requests (add observe_span to
+    span_handlers). Gauges, e.g. simulations in use, are read from stats
+    functions when the metrics are exposed (see add_stats). Updates are made
+    under a lock, so one instance can be shared by request threads. Metrics
+    are per process.
+
+    Parameters
+    ----------
+    prefix : str
+        Prefix of metric names
+
+    """
+
+    latency_buckets = (0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+    bytes_buckets = (1e3, 1e4, 1e5, 3e5, 1e6, 3e6, 1e7, 3e7, 1e8)
+
+    def __init__(self, prefix="ap_"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        # Name -> (type, help, buckets), and name -> labels -> value. The
+        # value of a histogram is [count of each bucket, sum, count].
+        self._metrics = OrderedDict()
+        self._values = {}
+        self._stats = []
+
+        self._define(
+            "request_seconds",
+            "histogram",
+            "Wall time of requests",
+            self.latency_buckets,
+        )
+        self._define(
+            "stage_seconds",
+            "histogram",
+            "Wall time of each stage of requests, including waits to be "
+            "admitted by the scheduler (admit) and for a simulation (checkout)",
+            self.latency_buckets,
+        )
+        self._define("request_errors_total", "counter", "Requests that raised")
+        self._define("simulated_seconds_total", "counter", "Model time simulated")
+        self._define(
+            "solver_seconds_total",
+            "counter",
+            "Wall time of the stages that simulated model time. Throughput is "
+            "the ratio of simulated_seconds_total to solver_seconds_total.",
+        )
+        self._define(
+            "payload_bytes",
+            "histogram",
+            "Size of callback payloads (JSON) and exports",
+            self.bytes_buckets,
+        )
+        self._define(
+            "cache_lookups_total",
+            "counter",
+            "Cache lookups of each stage, by result (hit, miss or warm start)",
+        )
+
+    def _define(self, name, kind, help, buckets=None):
+        self._metrics[self.prefix + name] = (kind, help, buckets)
+        self._values[self.prefix + name] = {}
+
+    def inc(self, name, value=1, **labels):
+        """Add value to a counter"""
+        name = self.prefix + name
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values[name]
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Add an observation to a histogram"""
+        name = self.prefix + name
+        buckets = self._metrics[name][2]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values[name]
+            if key not in values:
+                values[key] = [[0] * len(buckets), 0.0, 0]
+            counts = values[key][0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+            values[key][1] += value
+            values[key][2] += 1
+
+    def observe_span(self, record):
+        """Update the metrics with a timing record (see timing_span)"""
+        if record["request_id"] is None:
+            # Not part of a request, e.g. default results computed at startup
+            return
+        path = record["span"].split("/")
+        request, stage = path[0], path[-1]
+        wall_time = record["wall_ms"] / 1000
+
+        if len(path) == 1:
+            self.observe("request_seconds", wall_time, request=request)
+            if "error" in record:
+                error = record["error"]
+                self.inc("request_errors_total", request=request, error=error)
+        else:
+            self.observe("stage_seconds", wall_time, request=request, stage=stage)
+
+        if "simulated_ms" in record:
+            simulated_time = record["simulated_ms"] / 1000
+            self.inc("simulated_seconds_total", simulated_time, request=request)
+            self.inc("solver_seconds_total", wall_time, request=request)
+        if "bytes" in record and (stage == "serialize" or len(path) == 1):
+            self.observe("payload_bytes", record["bytes"], request=request)
+        if record.get("cache", "off") != "off":
+            self.inc("cache_lookups_total", stage=stage, result=record["cache"])
+
+    def add_stats(self, name, stats, counters=()):
+        """
+        Expose the values of a stats function (e.g. SimulationPool.stats)
+
+        Each numeric value of the dict returned by stats is exposed as the
+        gauge <prefix><name>_<key>, or as the counter
+        <prefix><name>_<key>_total if key is in counters.
+
+        """
+        self._stats.append((name, stats, counters))
+
+    def exposition(self):
+        """Metrics in the Prometheus text exposition format"""
+        lines = []
+
+        def add_sample(name, labels, value):
+            lines.append(
+                "{}{} {}".format(name, _format_labels(labels), _format_value(value))
+            )
+
+        with self._lock:
+            for name, (kind, help, buckets) in self._metrics.items():
+                lines.append("# HELP {} {}".format(name, help))
+                lines.append("# TYPE {} {}".format(name, kind))
+                for key, value in sorted(self._values[name].items()):
+                    if kind == "counter":
+                        add_sample(name, key, value)
+                        continue
+                    # Buckets are cumulative, ending with +Inf (all values)
+                    counts, total, count = value
+                    bounds = buckets + (float("inf"),)
+                    for bound, bucket_count in zip(bounds, counts + [count]):
+                        labels = key + (("le", _format_value(bound)),)
+                        add_sample(name + "_bucket", labels, bucket_count)
+                    add_sample(name + "_sum", key, total)
+                    add_sample(name + "_count", key, count)
+
+        for stats_name, stats, counters in self._stats:
+            for key, value in stats().items():
+                if not isinstance(value, (int, float)):
+                    continue
+                name = "{}{}_{}".format(self.prefix, stats_name, key)
+                if key in counters:
+                    name += "_total"
+                kind = "counter" if key in counters else "gauge"
+                lines.append("# HELP {} {} of {}".format(name, key, stats_name))
+                lines.append("# TYPE {} {}".format(name, kind))
+                add_sample(name, (), value)
+        return "\n".join(lines) + "\n"
+
+
+class SimResult:
+    """
+    Simulation output stored as named columns of equal length
+
+    Columns are NumPy arrays. Columns logged by myokit (array.array of
+    doubles) are wrapped without copying. Conversion to pandas, JSON or Arrow
+    is only done when asked for.
+
+    Parameters
+    ----------
+    data : dict
+        Column name -> values
+    attrs : dict
+        Metadata about the simulation, e.g. number of prepacing beats
+    float32 : bool
+        If True, store columns other than time as float32. This halves the
+        memory used but makes a copy. Time is kept in float64 so that long
+        simulations keep sub-step resolution.
+
+    """
+
+    __slots__ = ("_data", "attrs")
+
+    def __init__(self, data, attrs=None, float32=False):
+        self._data = {}
+        for key, values in data.items():
+            if getattr(values, "typecode", None) == "d":
+                # Zero-copy view of the logged values
+                values = np.frombuffer(values, dtype=np.float64)
+            else:
+                values = np.asarray(values)
+            if float32 and key != "time" and values.dtype == np.float64:
+                values = values.astype(np.float32)
+            self._data[key] = values
+        lengths = {len(values) for values in self._data.values()}
+        if len(lengths) > 1:
+            raise ValueError("Columns must have the same length")
+        self.attrs = {} if attrs is None else dict(attrs)
+
+    @classmethod
+    def concat(cls, results, float32=False):
+        """
+        Join results with the same columns end to end
+
+        Attributes are taken from the first result.
+        """
+        results = list(results)
+        if len(results) == 0:
+            return cls({})
+        data = {
+            key: np.concatenate([result[key] for result in results])
+            for key in results[0].columns
+        }
+        return cls(data, attrs=results[0].attrs, float32=float32)
+
+    @property
+    def columns(self):
+        return list(self._data.keys())
+
+    @property
+    def nbytes(self):
+        """Memory used by the column arrays"""
+        return sum(values.nbytes for values in self._data.values())
+
+    def __len__(self):
+        for values in self._data.values():
+            return len(values)
+        return 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, values):
+        """Add a column. A scalar is repeated for every row."""
+        if np.ndim(values) == 0:
+            values = np.full(len(self), values)
+        elif len(self._data) > 0 and len(values) != len(self):
+            raise ValueError("Columns must have the same length")
+        self._data[key] = np.asarray(values)
+
+    def __repr__(self):
+        return "SimResult(rows={}, columns={})".format(len(self), self.columns)
+
+    def items(self):
+        return self._data.items()
+
+    def to_pandas(self):
+        """Return a pd.DataFrame of the columns"""
+        df = pd.DataFrame(self._data)
+        df.attrs = dict(self.attrs)
+        return df
+
+    def to_dict(self, orient="list"):
+        """
+        Return the columns as Python objects
+
+        Parameters
+        ----------
+        orient : str
+            "list" for {column: list of values} or "records" for a list of
+            {column: value} per row (as pd.DataFrame.to_dict)
+
+        """
+        data = {key: values.tolist() for key, values in self._data.items()}
+        if orient == "list":
+            return data
+        if orient == "records":
+            keys = list(data.keys())
+            return [dict(zip(keys, row)) for row in zip(*data.values())]
+        raise ValueError("orient must be 'list' or 'records'")
+
+    def to_json(self):
+        """Return the columns as a JSON string of {column: list of values}"""
+        return json.dumps(self.to_dict("list"))
+
+    def to_arrow(self):
+        """Return a pyarrow.Table of the columns (requires pyarrow)"""
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError("SimResult.to_arrow requires pyarrow")
+        table = pa.table(self._data)
+        return table.replace_schema_metadata(
+            {"attrs": json.dumps(self.attrs, default=float)}
+        )
+
 
 def sim_model(
     s,
@@ -31,73 +636,2303 @@ def sim_model(
     bcl=1000,
     total_beats=100,
     beats_keep=4,
+    cache=None,
+    warm_start=None,
+    adaptive=False,
+    rtol=1e-4,
+    log_interval=None,
+    biomarkers=False,
+    float32=False,
+    control=None,
+):
+    """
+    Simulate Torord model
+
+    Parameters
+    ----------
+
+    s : simulation class (myokit.Simulation)
+    params : dict
+        Dictionary of user-defined model parameter values. Those that are not
+        specified are set to default.
+    bcl : float
+        basic cycle length
+    total_beats : int
+        total number of beats to simulate
+    beats_kepp: int
+        number of beats to display in figure (from the end of the simulation)
+    cache : SteadyStateCache
+        Cache of prepaced states. If the configuration has been simulated
+        before, prepacing is skipped and the recorded simulation starts from
+        the cached state.
+    warm_start : WarmStartStore
+        Store of converged prepaced states. If given and adaptive, prepacing
+        starts from the nearest stored state and stops once the beat-to-beat
+        change in state is within warm_start.rtol.
+    adaptive : bool
+        If True, prepace beat by beat and stop once the state at each stimulus
+        changes by less than rtol between beats. total_beats is then an upper
+        bound.
+    rtol : float
+        Relative tolerance for adaptive prepacing
+    log_interval : float
+        Interval (ms) at which variables are logged. If None, every solver
+        step is logged.
+    biomarkers : bool
+        If True, also return biomarkers of each recorded beat
+    float32 : bool
+        If True, store the recorded variables (other than time) as float32
+    control : RunControl
+        Cancel token and deadline of the run. If the run is stopped during
+        prepacing, myokit.SimulationCancelledError is raised. If it is
+        stopped during the recorded simulation, the beats that finished are
+        returned.
+
+    Returns
+    -------
+    df : SimResult
+        Variables at each time value. The number of prepacing beats
+        simulated and the final beat-to-beat residual are stored in
+        df.attrs["prepace_beats"] and df.attrs["prepace_residual"]. If the
+        run was stopped early, df.attrs["stopped"] is the reason (see
+        RunControl.stop_reason) and df.attrs["completed"] is the number of
+        beats recorded out of beats_keep.
+    df_beats : pd.DataFrame
+        Biomarkers of each recorded beat (see compute_biomarkers). Only
+        returned if biomarkers is True.
+
+    """
+
+    # Get default state of model
+    default_state = s.default_state()
+
+    # Assign parameters to simulation object
+    for key in params.keys():
+        s.set_constant(key, params[key])
+
+    # Set pacing protocol and assign to simulation object
+    p = myokit.pacing.blocktrain(bcl, duration=0.5, offset=20)
+    s.set_protocol(p)
+
+    # Pre-pacing simulation (or load prepaced state from cache)
+    beats, residual = prepace_model(
+        s,
+        params,
+        bcl,
+        max(total_beats - beats_keep, 0),
+        cache=cache,
+        warm_start=warm_start,
+        adaptive=adaptive,
+        rtol=rtol,
+        progress=control,
+    )
+
+    # Pacing simulation - only log the variables that are plotted
+    print("Begin recorded simulation")
+    log_vars = ["environment.time"] + [
+        var for var in plot_vars if var != "environment.time"
+    ]
+    if biomarkers:
+        log_vars += [var for var in log_vars_protocol if var not in log_vars]
+    stopped = None
+    with timing_span("run", bcl=bcl) as span:
+        if control is None:
+            d = s.run(bcl * beats_keep, log=log_vars, log_interval=log_interval)
+            beats_done = beats_keep
+        else:
+            # Run beat by beat, appending to the same log, so that the beats
+            # that finished can be returned if the run is stopped
+            d = log_vars
+            beats_done, num_rows = 0, 0
+            try:
+                for beat in range(beats_keep):
+                    d = s.run(bcl, log=d, log_interval=log_interval, progress=control)
+                    beats_done += 1
+                    num_rows = len(d["environment.time"])
+            except myokit.SimulationCancelledError:
+                if beats_done == 0:
+                    raise
+                stopped = control.stop_reason
+                print(
+                    "Run {} after {} of {} beats".format(
+                        stopped, beats_done, beats_keep
+                    )
+                )
+                d = {key: np.asarray(d[key])[:num_rows] for key in log_vars}
+        span.update(
+            beats=beats_done,
+            simulated_ms=beats_done * bcl,
+            rows=len(d["environment.time"]),
+        )
+
+    # Collect data specified in plot_vars
+    with timing_span("result") as span:
+        data_dict = {key: d[key] for key in plot_vars}
+        data_dict["time"] = d["environment.time"]
+        df = SimResult(
+            data_dict,
+            attrs={
+                "prepace_beats": beats,
+                "prepace_residual": residual,
+                "stopped": stopped,
+                "completed": beats_done,
+            },
+            float32=float32,
+        )
+        span["bytes"] = df.nbytes
+
+    # Reset simulation (don't use s.reset as this only goes to end of pre-pacing)
+    # s.pre also overwrites the default state, so restore it too. Otherwise the
+    # next run would start from this run's prepaced state.
+    s.set_default_state(default_state)
+    s.set_state(default_state)
+    s.set_time(0)
+
+    if biomarkers:
+        with timing_span("biomarkers", beats=beats_done):
+            df_beats = compute_biomarkers(
+                d["environment.time"],
+                d["membrane.v"],
+                d["intracellular_ions.cai"],
+                stim_times=20 + bcl * np.arange(beats_done),
+            )
+        return df, df_beats
+
+    return df
+
+
+def sim_model_beats(
+    s,
+    params={},
+    bcl=1000,
+    total_beats=100,
+    beats_keep=4,
+    cache=None,
+    warm_start=None,
+    adaptive=False,
+    rtol=1e-4,
+    log_vars=None,
+    log_interval=None,
+    control=None,
+):
+    """
+    Simulate Torord model as sim_model, yielding the recorded beats one at a
+    time
+
+    Only one beat of the recorded simulation is held in memory at once, so
+    all variables can be logged for long simulations (see stream_export).
+    The simulation is reset when the generator finishes or is closed.
+
+    Parameters
+    ----------
+    s : simulation class (myokit.Simulation)
+    log_vars : list
+        Variables to log. If None, all variables that aren't constant.
+    control : RunControl
+        Cancel token and deadline of the run. If the run is stopped,
+        myokit.SimulationCancelledError is raised.
+
+    Other parameters are as sim_model.
+
+    Yields
+    ------
+    SimResult
+        Time and logged variables of each recorded beat. The number of
+        prepacing beats simulated is stored in attrs["prepace_beats"].
+
+    """
+
+    default_state = s.default_state()
+    try:
+        for key in params.keys():
+            s.set_constant(key, params[key])
+        p = myokit.pacing.blocktrain(bcl, duration=0.5, offset=20)
+        s.set_protocol(p)
+        beats, residual = prepace_model(
+            s,
+            params,
+            bcl,
+            max(total_beats - beats_keep, 0),
+            cache=cache,
+            warm_start=warm_start,
+            adaptive=adaptive,
+            rtol=rtol,
+            progress=control,
+        )
+
+        if log_vars is None:
+            log_vars = myokit.LOG_ALL
+        else:
+            log_vars = ["environment.time"] + [
+                var for var in log_vars if var != "environment.time"
+            ]
+
+        print("Begin recorded simulation ({} beats)".format(beats_keep))
+        for beat in range(beats_keep):
+            with timing_span("run", bcl=bcl, beat=beat, simulated_ms=bcl):
+                d = s.run(
+                    bcl, log=log_vars, log_interval=log_interval, progress=control
+                )
+            data_dict = {"time": d["environment.time"]}
+            for key in d.keys():
+                if key != "environment.time":
+                    data_dict[key] = d[key]
+            yield SimResult(
+                data_dict,
+                attrs={"prepace_beats": beats, "prepace_residual": residual},
+            )
+    finally:
+        s.set_default_state(default_state)
+        s.set_state(default_state)
+        s.set_time(0)
+
+
+# Formats of stream_export, with their file extension and MIME type
+export_formats = {
+    "csv.gz": ("csv.gz", "application/gzip"),
+    "npz": ("npz", "application/zip"),
+    "parquet": ("parquet", "application/vnd.apache.parquet"),
+}
+
+
+def available_export_formats():
+    """Formats of stream_export that can be written (parquet needs pyarrow)"""
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        return [fmt for fmt in export_formats if fmt != "parquet"]
+    return list(export_formats)
+
+
+class _ByteSink:
+    """Write-only file object whose contents are taken out with drain"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_export(chunks, fmt="csv.gz"):
+    """
+    Write chunks of a simulation to a file format as a stream of bytes
+
+    Chunks are written as they arrive and then discarded, so the whole table
+    is never held in memory. NPZ files hold one array per column, so columns
+    are spilled to temporary files until the last chunk has arrived.
+
+    Parameters
+    ----------
+    chunks : iterable of SimResult
+        Consecutive parts of the table, with the same columns
+        (e.g. from sim_model_beats)
+    fmt : str
+        One of export_formats
+
+    Yields
+    ------
+    bytes
+        Consecutive parts of the file
+
+    """
+
+    if fmt == "csv.gz":
+        return _stream_csv_gz(chunks)
+    if fmt == "npz":
+        return _stream_npz(chunks)
+    if fmt == "parquet":
+        return _stream_parquet(chunks)
+    raise ValueError("Unknown export format {}".format(fmt))
+
+
+def _stream_csv_gz(chunks):
+    # wbits=31 writes a gzip header and trailer
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    header = True
+    for chunk in chunks:
+        csv = chunk.to_pandas().to_csv(index=False, header=header)
+        header = False
+        data = compressor.compress(csv.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _stream_npz(chunks):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files = {}
+        dtypes = {}
+        try:
+            for chunk in chunks:
+                for key, values in chunk.items():
+                    if key not in files:
+                        files[key] = open(os.path.join(tmp_dir, str(len(files))), "wb")
+                        dtypes[key] = values.dtype
+                    values.astype(dtypes[key], copy=False).tofile(files[key])
+        finally:
+            for f in files.values():
+                f.close()
+
+        # Zip each column as a .npy file. The sink isn't seekable, so zipfile
+        # writes sizes after each file's data.
+        sink = _ByteSink()
+        with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED) as zf:
+            for key, f in files.items():
+                values = np.memmap(f.name, dtype=dtypes[key], mode="r")
+                with zf.open(key + ".npy", "w", force_zip64=True) as npy:
+                    np.lib.format.write_array(npy, values)
+                del values
+                yield sink.drain()
+        yield sink.drain()
+
+
+def _stream_parquet(chunks):
+    import pyarrow.parquet as pq
+
+    sink = _ByteSink()
+    writer = None
+    try:
+        # One row group per chunk
+        for chunk in chunks:
+            table = chunk.to_arrow()
+            if writer is None:
+                writer = pq.ParquetWriter(sink, table.schema)
+            writer.write_table(table)
+            yield sink.drain()
+    finally:
+        if writer is not None:
+            writer.close()
+    yield sink.drain()
+
+
+def state_residual(state_prev, state, atol=1e-6):
+    """
+    Relative change between two state vectors (max over components)
+
+    Each component's change is divided by its magnitude plus atol, so that
+    states close to zero (known only to the solver's absolute tolerance) do
+    not dominate the residual.
+
+    Parameters
+    ----------
+    state_prev : list
+        state at the previous stimulus
+    state : list
+        state at the current stimulus
+    atol : float
+        absolute tolerance, matching the solver's default
+
+    Returns
+    -------
+    float
+
+    """
+    state_prev = np.asarray(state_prev)
+    state = np.asarray(state)
+    if len(state) == 0:
+        return np.nan
+    return np.max(np.abs(state - state_prev) / (np.abs(state_prev) + atol))
+
+
+def prepace(s, bcl, num_beats, progress=None):
+    """
+    Prepace for a fixed number of beats
+
+    The final beat is paced separately so that the beat-to-beat residual can
+    be reported (see state_residual).
+
+    Parameters
+    ----------
+    s : simulation class (myokit.Simulation)
+    bcl : float
+        basic cycle length
+    num_beats : int
+        number of beats to pace
+    progress : RunControl
+        If given, pacing stops (raising myokit.SimulationCancelledError) when
+        the run is cancelled or times out
+
+    Returns
+    -------
+    beats : int
+        number of beats paced
+    residual : float
+        relative change in state over the final beat (nan if no beats paced)
+
+    """
+
+    if num_beats <= 0:
+        return 0, np.nan
+
+    s.pre((num_beats - 1) * bcl, progress=progress)
+    state_prev = s.state()
+    s.pre(bcl, progress=progress)
+    return num_beats, state_residual(state_prev, s.state())
+
+
+def prepace_to_steady_state(s, bcl, max_beats, rtol=1e-4, progress=None):
+    """
+    Prepace beat by beat until the state at the start of each beat settles
+
+    The simulation must already have its pacing protocol set, with period bcl.
+    Pacing stops when the relative change in state between consecutive beats
+    (see state_residual) is below rtol, or after max_beats beats.
+
+    Parameters
+    ----------
+    s : simulation class (myokit.Simulation)
+    bcl : float
+        basic cycle length
+    max_beats : int
+        maximum number of beats to pace
+    rtol : float
+        relative tolerance for convergence
+    progress : RunControl
+        If given, pacing stops (raising myokit.SimulationCancelledError) when
+        the run is cancelled or times out
+
+    Returns
+    -------
+    beats : int
+        number of beats paced
+    residual : float
+        relative change in state over the final beat (nan if no beats paced)
+
+    """
+
+    beats = 0
+    residual = np.nan
+    while beats < max_beats:
+        state_prev = s.state()
+        s.pre(bcl, progress=progress)
+        beats += 1
+        residual = state_residual(state_prev, s.state())
+        if residual < rtol:
+            break
+
+    return beats, residual
+
+
+def prepace_model(
+    s,
+    params,
+    bcl,
+    num_beats_pre,
+    cache=None,
+    warm_start=None,
+    adaptive=False,
+    rtol=1e-4,
+    progress=None,
+):
+    """
+    Prepace the model for the regular stimulation protocol of sim_model
+
+    The simulation must already have its parameters and pacing protocol
+    set. The prepaced state is loaded from cache if possible. Otherwise, if
+    adaptive, prepacing starts from the nearest state in warm_start (if
+    given) and the result is added to both. Without adaptive, exactly
+    num_beats_pre beats are paced from the default state, so results don't
+    depend on earlier runs. States that converged are added to warm_start
+    either way.
+
+    Parameters
+    ----------
+    s : simulation class (myokit.Simulation)
+    params : dict
+        Dictionary of user-defined model parameter values
+    bcl : float
+        basic cycle length
+    num_beats_pre : int
+        number of prepacing beats (an upper bound if adaptive)
+    cache : SteadyStateCache
+        Cache of prepaced states. Fixed and adaptive prepacing are cached
+        under different keys.
+    warm_start : WarmStartStore
+        Store of converged prepaced states, only started from if adaptive
+    adaptive : bool
+        If True, prepace beat by beat until the state settles to within rtol
+    rtol : float
+        Relative tolerance for adaptive prepacing (replaced by
+        warm_start.rtol if warm_start is given)
+    progress : RunControl
+        Cancel token and deadline of the run (see prepace)
+
+    Returns
+    -------
+    beats : int
+        number of beats paced (0 if loaded from cache)
+    residual : float
+        relative change in state over the final beat (nan if loaded from
+        cache)
+
+    """
+
+    if not adaptive:
+        rtol = None
+    elif warm_start is not None:
+        rtol = warm_start.rtol
+
+    prepaced_state = None
+    if cache is not None:
+        cache_key = steady_state_key(
+            params,
+            bcl,
+            num_beats_pre,
+            offset=20,
+            rtol=rtol,
+            adaptive=adaptive,
+            model_hash=cache.model_hash,
+        )
+        prepaced_state = cache.get(cache_key)
+
+    warm_state = None
+    if prepaced_state is None and adaptive and warm_start is not None:
+        warm_state = warm_start.nearest(params, bcl)
+
+    cache_status = "miss" if cache is not None else "off"
+    with timing_span("prepace", bcl=bcl, cache=cache_status) as span:
+        if prepaced_state is not None:
+            print("Load prepaced state from cache")
+            s.set_state(prepaced_state)
+            span.update(cache="hit", beats=0, simulated_ms=0)
+            return 0, np.nan
+        elif warm_state is not None:
+            print("Begin prepacing from warm start")
+            span["cache"] = "warm"
+            s.set_state(warm_state)
+            beats, residual = prepace_to_steady_state(
+                s, bcl, num_beats_pre, rtol=rtol, progress=progress
+            )
+            warm_start.record_saving(num_beats_pre - beats)
+        elif adaptive:
+            print("Begin adaptive prepacing")
+            beats, residual = prepace_to_steady_state(
+                s, bcl, num_beats_pre, rtol=rtol, progress=progress
+            )
+        else:
+            print("Begin prepacing")
+            beats, residual = prepace(s, bcl, num_beats_pre, progress=progress)
+        span.update(beats=beats, simulated_ms=beats * bcl)
+
+    print("Prepaced {} beats, residual {:.2e}".format(beats, residual))
+    if warm_start is not None and residual < warm_start.rtol:
+        warm_start.add(params, bcl, s.state())
+    if cache is not None:
+        cache.put(cache_key, s.state())
+    return beats, residual
+
+
+def model_code_hash(model):
+    """Hash of the code of model, which changes with any edit to the model"""
+    return hashlib.sha256(model.code().encode()).hexdigest()
+
+
+def steady_state_key(
+    params,
+    bcl,
+    num_beats_pre,
+    offset=0,
+    rtol=None,
+    adaptive=False,
+    model_hash=None,
 ):
     """
-    Simulate Torord model
+    Canonical hash of a prepacing configuration.
+
+    Parameter values are converted to floats and sorted by name, so that
+    equivalent dicts (e.g. 1 vs 1.0, different insertion order) give the same
+    key.
+
+    Parameters
+    ----------
+    params : dict
+        Dictionary of user-defined model parameter values
+    bcl : float
+        basic cycle length
+    num_beats_pre : int
+        number of prepacing beats
+    offset : float
+        offset of the first stimulus in the pacing protocol
+    rtol : float
+        tolerance of adaptive prepacing (None if a fixed number of beats)
+    adaptive : bool
+        whether prepacing stops once at steady state (possibly warm started
+        from another configuration), rather than pacing num_beats_pre beats
+        from the default state
+    model_hash : str
+        hash of the model (see model_code_hash), so that states of an older
+        version of the model aren't used
+
+    Returns
+    -------
+    str
+        Hex digest identifying the configuration
+
+    """
+
+    params = {key: float(value) for key, value in params.items()}
+    config = {
+        "celltype": params.pop("environment.celltype", None),
+        "params": sorted(params.items()),
+        "bcl": float(bcl),
+        "num_beats_pre": int(num_beats_pre),
+        "offset": float(offset),
+        "rtol": rtol,
+        "mode": "adaptive" if adaptive else "fixed",
+        "model": model_hash,
+    }
+    config_str = json.dumps(config, sort_keys=True)
+    return hashlib.sha256(config_str.encode()).hexdigest()
+
+
+class SteadyStateCache:
+    """
+    Bounded cache of prepaced model states with least-recently-used eviction.
+
+    Keys are made with steady_state_key. If a path is given, the cache is
+    loaded from it on creation and written back (as JSON) once states have
+    been added, at most every save_interval seconds and when the process
+    exits, so that prepaced states survive app restarts. Errors writing the
+    file are printed rather than raised, so they never fail a simulation.
+
+    Parameters
+    ----------
+    path : str
+        JSON file used to persist the cache. If None, the cache is in memory
+        only.
+    maxsize : int
+        Maximum number of states to keep
+    model : myokit.Model
+        Model whose states are cached. Its hash is part of the keys (see
+        steady_state_key), so states stored for an older version of the
+        model aren't used.
+    save_interval : float
+        Minimum time (s) between writes of the file
+
+    """
+
+    def __init__(self, path=None, maxsize=256, model=None, save_interval=10):
+        self.path = path
+        self.maxsize = maxsize
+        self.model_hash = None if model is None else model_code_hash(model)
+        self.save_interval = save_interval
+        self.hits = 0
+        self.misses = 0
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._last_save = 0
+
+        if path is not None:
+            if os.path.exists(path):
+                self.load()
+            atexit.register(self.flush)
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, key):
+        """Return the cached state for key (or None) and mark it as recent"""
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                self.misses += 1
+                return None
+            self._states.move_to_end(key)
+            self.hits += 1
+            return list(state)
+
+    def put(self, key, state):
+        """Add a state to the cache, evicting the least recently used one"""
+        with self._lock:
+            self._states[key] = [float(x) for x in state]
+            self._states.move_to_end(key)
+            while len(self._states) > self.maxsize:
+                self._states.popitem(last=False)
+            self._dirty = True
+            save_due = time.time() - self._last_save >= self.save_interval
+        if self.path is not None and save_due:
+            self.save()
+
+    def load(self):
+        """Load cached states from self.path"""
+        try:
+            with open(self.path) as f:
+                states = json.load(f)
+        except (OSError, ValueError):
+            print("Could not read steady state cache at {}".format(self.path))
+            return
+
+        with self._lock:
+            # File is ordered from least to most recently used
+            for key, state in states:
+                self._states[key] = state
+            while len(self._states) > self.maxsize:
+                self._states.popitem(last=False)
+
+    def flush(self):
+        """Write cached states to self.path if any were added since the last write"""
+        if self.path is not None and self._dirty:
+            self.save()
+
+    def save(self):
+        """Write cached states to self.path"""
+        with self._save_lock:
+            with self._lock:
+                states = list(self._states.items())
+                self._dirty = False
+                self._last_save = time.time()
+
+            # Write to a temporary file of this thread first, so that readers
+            # never see a partial file
+            dir_name = os.path.dirname(os.path.abspath(self.path))
+            path_tmp = None
+            try:
+                os.makedirs(dir_name, exist_ok=True)
+                fd, path_tmp = tempfile.mkstemp(dir=dir_name, suffix=".tmp")
+                with os.fdopen(fd, "w") as f:
+                    json.dump(states, f)
+                os.replace(path_tmp, self.path)
+            except OSError as e:
+                print(
+                    "Could not write steady state cache at {}: {}".format(self.path, e)
+                )
+                with self._lock:
+                    self._dirty = True
+                if path_tmp is not None and os.path.exists(path_tmp):
+                    os.remove(path_tmp)
+
+
+class ResultStore:
+    """
+    Server-side store of simulation results, so that only a result ID needs
+    to be sent to the browser.
+
+    Results are keyed by a hash of their pickled contents. Recently used
+    results are kept in memory, bounded by their total pickled size. If a
+    path is given, results are also written there when stored, so that other
+    processes serving the app (and this one, once the result is evicted from
+    memory) can read them. The oldest files written by this process are
+    removed once their total size exceeds max_disk_bytes. The size of the
+    directory is counted once on creation and kept as a running total, so
+    storing a result never rescans it.
+
+    Result IDs come from the browser, so get only accepts IDs of the form
+    made by put (32 hex digits). Any other ID is treated as a miss, without
+    touching memory or disk.
+
+    Parameters
+    ----------
+    path : str
+        Directory shared by the app processes to store results on disk. If
+        None, results are in memory only, and only served by this process.
+    max_bytes : int
+        Maximum total size of results kept in memory
+    max_disk_bytes : int
+        Maximum total size of results kept in path
+
+    """
+
+    def __init__(self, path=None, max_bytes=256 * 2**20, max_disk_bytes=2**30):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.nbytes = 0
+        self.disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        # Sizes of result files, from oldest to newest
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+        if path is not None and os.path.isdir(path):
+            self._scan_disk()
+
+    def __len__(self):
+        return len(self._results)
+
+    @staticmethod
+    def valid_id(result_id):
+        """Whether result_id has the form of an ID made by put"""
+        return isinstance(result_id, str) and bool(_result_id_re.match(result_id))
+
+    def _file(self, result_id):
+        return os.path.join(self.path, "{}.pkl".format(result_id))
+
+    def put(self, result):
+        """Store a (picklable) result and return its ID"""
+        with timing_span("store") as span:
+            data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+            result_id = hashlib.sha256(data).hexdigest()[:32]
+            with self._lock:
+                span.update(bytes=len(data), cache="hit")
+                if result_id not in self._results:
+                    span["cache"] = "miss"
+            self._put_memory(result_id, result, len(data))
+            if self.path is not None:
+                self._write_disk(result_id, data)
+
+        return result_id
+
+    def get(self, result_id):
+        """Return the result with result_id, or None if it is not stored"""
+        if not self.valid_id(result_id):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            entry = self._results.get(result_id)
+            if entry is not None:
+                self._results.move_to_end(result_id)
+                self.hits += 1
+                return entry[0]
+
+        result = None
+        if self.path is not None and os.path.exists(self._file(result_id)):
+            try:
+                with open(self._file(result_id), "rb") as f:
+                    data = f.read()
+                result = pickle.loads(data)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                print("Could not read result at {}".format(self._file(result_id)))
+
+        if result is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.disk_hits += 1
+        self._put_memory(result_id, result, len(data))
+        return result
+
+    def _put_memory(self, result_id, result, nbytes):
+        """Add a result to memory, evicting the least recently used ones"""
+        evicted = []
+        with self._lock:
+            if result_id not in self._results:
+                self._results[result_id] = (result, nbytes)
+                self.nbytes += nbytes
+            self._results.move_to_end(result_id)
+            # Always keep the newest result, even if it is over the limit
+            while self.nbytes > self.max_bytes and len(self._results) > 1:
+                result_id_evicted, (result_evicted, nbytes_evicted) = (
+                    self._results.popitem(last=False)
+                )
+                self.nbytes -= nbytes_evicted
+                evicted.append((result_id_evicted, result_evicted))
+
+        # Evicted results were written to disk when stored, unless their file
+        # has since been removed to make room
+        if self.path is not None:
+            for result_id_evicted, result_evicted in evicted:
+                if result_id_evicted not in self._files:
+                    data = pickle.dumps(
+                        result_evicted, protocol=pickle.HIGHEST_PROTOCOL
+                    )
+                    self._write_disk(result_id_evicted, data)
+
+    def _write_disk(self, result_id, data):
+        """Write a pickled result to path, removing the oldest files if full"""
+        with self._lock:
+            if result_id in self._files:
+                self._files.move_to_end(result_id)
+                return
+
+        # Write to a temporary file first so that readers never see a partial
+        # file. Errors are printed, as the result is still held in memory.
+        path_tmp = None
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, path_tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(path_tmp, self._file(result_id))
+        except OSError as e:
+            print("Could not write result to {}: {}".format(self.path, e))
+            if path_tmp is not None and os.path.exists(path_tmp):
+                os.remove(path_tmp)
+            return
+
+        removed = []
+        with self._lock:
+            if result_id not in self._files:
+                self._files[result_id] = len(data)
+                self.disk_bytes += len(data)
+            # Always keep the newest file
+            while self.disk_bytes > self.max_disk_bytes and len(self._files) > 1:
+                result_id_removed, size = self._files.popitem(last=False)
+                self.disk_bytes -= size
+                removed.append(result_id_removed)
+
+        for result_id_removed in removed:
+            try:
+                os.remove(self._file(result_id_removed))
+            except OSError:
+                pass
+
+    def _scan_disk(self):
+        """Count the result files already in path (e.g. from a restart)"""
+        files = []
+        for entry in os.scandir(self.path):
+            result_id, ext = os.path.splitext(entry.name)
+            if ext != ".pkl" or not self.valid_id(result_id):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, result_id, stat.st_size))
+
+        with self._lock:
+            for _, result_id, size in sorted(files):
+                self._files[result_id] = size
+                self.disk_bytes += size
+
+    def stats(self):
+        """Return usage statistics"""
+        with self._lock:
+            return {
+                "results": len(self._results),
+                "nbytes": self.nbytes,
+                "files": len(self._files),
+                "disk_bytes": self.disk_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+            }
+
+
+class WarmStartStore:
+    """
+    Store of converged prepaced states for warm-starting nearby configurations.
+
+    States are indexed by a feature vector made of each parameter divided by
+    its reference value, plus BCL divided by bcl_scale. The cell type is
+    categorical, so only states of the same cell type are used. The nearest
+    neighbour is found by a brute force search over the stored vectors, which
+    for the few thousand states kept here is faster than building a tree.
+
+    Parameters
+    ----------
+    reference_params : dict
+        Reference (default) parameter values. Its keys define the parameters
+        that make up the feature vector.
+    bcl_scale : float
+        BCL is divided by this value in the feature vector
+    max_distance : float
+        Stored states further than this from the query are not used
+    maxsize : int
+        Maximum number of states to keep (the oldest states of the most
+        common cell type are dropped first)
+    rtol : float
+        Relative tolerance used to decide a warm-started run has converged
+
+    """
+
+    def __init__(
+        self,
+        reference_params,
+        bcl_scale=1000,
+        max_distance=0.5,
+        maxsize=2000,
+        rtol=1e-4,
+    ):
+        self.reference_params = dict(reference_params)
+        self.celltype_ref = self.reference_params.pop("environment.celltype", 0)
+        self.par_names = sorted(self.reference_params.keys())
+        self.bcl_scale = bcl_scale
+        self.max_distance = max_distance
+        self.maxsize = maxsize
+        self.rtol = rtol
+
+        self.queries = 0
+        self.warm_starts = 0
+        self.beats_saved = 0
+
+        self._features = {}
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(states) for states in self._states.values())
+
+    def _features_from_params(self, params, bcl):
+        """Celltype and normalised feature vector of a configuration"""
+        features = []
+        for par in self.par_names:
+            value_ref = self.reference_params[par]
+            value = params.get(par, value_ref)
+            features.append(value / value_ref if value_ref != 0 else value)
+        features.append(bcl / self.bcl_scale)
+        celltype = params.get("environment.celltype", self.celltype_ref)
+        return celltype, np.array(features)
+
+    def add(self, params, bcl, state):
+        """Add a converged prepaced state"""
+        celltype, features = self._features_from_params(params, bcl)
+        with self._lock:
+            list_features = self._features.setdefault(celltype, [])
+            list_states = self._states.setdefault(celltype, [])
+            list_features.append(features)
+            list_states.append(list(state))
+            # Drop oldest states
+            while len(self) > self.maxsize:
+                celltype_oldest = max(self._states, key=lambda c: len(self._states[c]))
+                self._features[celltype_oldest].pop(0)
+                self._states[celltype_oldest].pop(0)
+
+    def nearest(self, params, bcl):
+        """
+        Return the stored state closest to the configuration, or None if no
+        state of this cell type lies within max_distance.
+        """
+        celltype, features = self._features_from_params(params, bcl)
+        with self._lock:
+            self.queries += 1
+            list_features = self._features.get(celltype, [])
+            if len(list_features) == 0:
+                return None
+            distances = np.linalg.norm(np.array(list_features) - features, axis=1)
+            idx = np.argmin(distances)
+            if distances[idx] > self.max_distance:
+                return None
+            self.warm_starts += 1
+            return list(self._states[celltype][idx])
+
+    def record_saving(self, beats_saved):
+        """Record the number of beats saved by a warm start"""
+        with self._lock:
+            self.beats_saved += beats_saved
+        print(
+            "Warm start saved {} beats ({} in total over {} warm starts)".format(
+                beats_saved, self.beats_saved, self.warm_starts
+            )
+        )
+
+    def stats(self):
+        """Summary of warm start usage"""
+        with self._lock:
+            return {
+                "states": len(self),
+                "queries": self.queries,
+                "warm_starts": self.warm_starts,
+                "beats_saved": self.beats_saved,
+            }
+
+
+def simulation_cache_key(model):
+    """
+    Hash identifying a compiled simulation of model
+
+    Combines the model code with the myokit version, the SUNDIALS paths and
+    the compiler and platform, so that a stored extension is only reused
+    where it would be built identically.
+
+    Parameters
+    ----------
+    model : myokit.Model
+
+    Returns
+    -------
+    str
+
+    """
+
+    build_info = [
+        model.code(),
+        myokit.__version__,
+        str(myokit.SUNDIALS_LIB),
+        str(myokit.SUNDIALS_INC),
+        str(sysconfig.get_config_var("CC")),
+        str(sysconfig.get_config_var("CFLAGS")),
+        os.environ.get("CC", ""),
+        os.environ.get("CFLAGS", ""),
+        os.environ.get("LDFLAGS", ""),
+        platform.platform(),
+        sys.version,
+    ]
+    return hashlib.sha256("\n".join(build_info).encode()).hexdigest()
+
+
+def load_compiled_simulation(model, cache_dir):
+    """
+    Create a simulation of model, reusing a compiled extension from cache_dir
+
+    If no compiled simulation is stored for this model and build environment
+    (see simulation_cache_key), the model is compiled and stored so that
+    later processes can load it instead of compiling.
+
+    Parameters
+    ----------
+    model : myokit.Model
+        Model to simulate
+    cache_dir : str
+        Directory of compiled simulations
+
+    Returns
+    -------
+    myokit.Simulation
+
+    """
+
+    path = os.path.join(cache_dir, "sim_{}.zip".format(simulation_cache_key(model)))
+    if os.path.exists(path):
+        try:
+            return myokit.Simulation.from_path(path)
+        except Exception as e:
+            print("Could not load compiled simulation {}: {}".format(path, e))
+
+    # Compile and store. Write to a temporary file first so that other
+    # processes never load a partial file.
+    os.makedirs(cache_dir, exist_ok=True)
+    path_tmp = "{}.{}.tmp".format(path, os.getpid())
+    s = myokit.Simulation(model, path=path_tmp)
+    os.replace(path_tmp, path)
+    return s
+
+
+class SimulationPool:
+    """
+    Pool of compiled simulations of the same model, for concurrent requests.
+
+    Each simulation is checked out by one request at a time, so requests
+    running in different threads don't overwrite each other's constants,
+    protocol or state. When a simulation is returned to the pool its
+    constants, protocol, state and time are reset to the model defaults.
+
+    Parameters
+    ----------
+    model : myokit.Model
+        Model to simulate
+    size : int
+        Number of simulations in the pool
+    cache_dir : str
+        Directory of compiled simulations (see load_compiled_simulation). If
+        None, every simulation is compiled.
+
+    """
+
+    def __init__(self, model, size=2, cache_dir=None):
+        self.size = size
+        self._default_state = model.initial_values(as_floats=True)
+        self._queue = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+        self.in_use = 0
+        self.checkouts = 0
+        self.wait_time_total = 0
+        self.wait_time_max = 0
+
+        for i in range(size):
+            if cache_dir is None:
+                print("Compile simulation {} of {}".format(i + 1, size))
+                self._queue.put(myokit.Simulation(model))
+            else:
+                self._queue.put(load_compiled_simulation(model, cache_dir))
+
+        # Literal constants that can be reset with set_constant
+        s = self._queue.get()
+        self._constants = {}
+        for var in model.variables(const=True):
+            if var.is_literal():
+                try:
+                    s.set_constant(var.qname(), var.eval())
+                except ValueError:
+                    continue
+                self._constants[var.qname()] = var.eval()
+        self._queue.put(s)
+
+    def reset(self, s):
+        """Reset constants, protocol, state and time of s to model defaults"""
+        for name, value in self._constants.items():
+            s.set_constant(name, value)
+        s.set_protocol(None)
+        s.set_default_state(self._default_state)
+        s.set_state(self._default_state)
+        s.set_time(0)
+
+    @contextmanager
+    def simulation(self, timeout=None):
+        """
+        Check out a simulation for the duration of a with block
+
+        Parameters
+        ----------
+        timeout : float
+            Maximum time (s) to wait for a free simulation. If None, wait
+            indefinitely.
+
+        Raises
+        ------
+        TimeoutError
+            If no simulation became free within timeout
+
+        """
+
+        t_start = time.perf_counter()
+        try:
+            s = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(
+                "No simulation available after {} s ({} in use)".format(
+                    timeout, self.in_use
+                )
+            )
+        wait_time = time.perf_counter() - t_start
+        log_span("checkout", wait_time)
+
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+
+        try:
+            yield s
+        finally:
+            self.reset(s)
+            with self._lock:
+                self.in_use -= 1
+            self._queue.put(s)
+
+    def stats(self):
+        """Pool size and wait-time metrics"""
+        with self._lock:
+            return {
+                "size": self.size,
+                "in_use": self.in_use,
+                "checkouts": self.checkouts,
+                "wait_time_mean": self.wait_time_total / max(self.checkouts, 1),
+                "wait_time_max": self.wait_time_max,
+            }
+
+
+def _init_worker(model, cache_dir=None, cancel_flags=None):
+    """Initialise a worker process with its own simulation of model"""
+    global _worker_pool, _worker_cancel_flags
+    _worker_pool = SimulationPool(model, size=1, cache_dir=cache_dir)
+    _worker_cancel_flags = cancel_flags
+
+
+def _worker_ready():
+    return os.getpid()
+
+
+class SimulationProcessPool(ProcessPoolExecutor):
+    """
+    Process pool whose workers each hold a compiled simulation of model
+
+    Workers are spawned (not forked), so they don't inherit the threads,
+    locks and memory of the server process, and the pool can be made from
+    a request thread. Tasks run by run_in_processes are each given a slot
+    of cancel_flags, shared with the workers, so that a stopped run also
+    stops its tasks that are already running.
+
+    Parameters
+    ----------
+    model : myokit.Model
+        Model to simulate
+    max_workers : int
+        Number of worker processes
+    cache_dir : str
+        Directory of compiled simulations (see load_compiled_simulation)
+    num_slots : int
+        Number of cancel flags. Slots are reused in turn, so this should be
+        more than the number of runs that can be in progress at once.
+
+    """
+
+    def __init__(self, model, max_workers, cache_dir=None, num_slots=256):
+        context = multiprocessing.get_context("spawn")
+        self.cancel_flags = context.RawArray("b", num_slots)
+        self._slots = itertools.count()
+        super().__init__(
+            max_workers=max_workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(model, cache_dir, self.cancel_flags),
+        )
+
+    def new_slot(self):
+        """Return a cleared cancel flag slot for a run"""
+        slot = next(self._slots) % len(self.cancel_flags)
+        self.cancel_flags[slot] = 0
+        return slot
+
+
+def make_process_pool(model, max_workers=2, cache_dir=None):
+    """
+    Make a SimulationProcessPool and wait for its workers to start
+
+    Parameters
+    ----------
+    model : myokit.Model
+        Model to simulate
+    max_workers : int
+        Number of worker processes
+    cache_dir : str
+        Directory of compiled simulations (see load_compiled_simulation)
+
+    Returns
+    -------
+    SimulationProcessPool
+
+    """
+
+    executor = SimulationProcessPool(model, max_workers, cache_dir=cache_dir)
+    futures = [executor.submit(_worker_ready) for _ in range(max_workers)]
+    for future in futures:
+        future.result()
+    return executor
+
+
+def run_in_processes(executor, fn, list_args, control=None):
+    """
+    Run fn over a list of argument tuples in executor, preserving order
+
+    Returns None if the process pool is broken, so that the caller can fall
+    back to running serially.
+
+    If control is given, fn is also given task=(deadline, slot) as a keyword
+    argument, from which it makes its progress reporter with
+    _worker_control. If the run is stopped, tasks that haven't started are
+    cancelled, the cancel flag of the slot is set so that running tasks stop
+    at their next progress update, and None is returned in their place.
+    Tasks that stop early (raising myokit.SimulationCancelledError) also give
+    None.
+    """
+    if len(list_args) == 0:
+        return []
+    if control is None:
+        try:
+            return list(executor.map(fn, *zip(*list_args)))
+        except BrokenProcessPool:
+            print("Process pool unavailable - running serially")
+            return None
+
+    try:
+        slot = executor.new_slot()
+        task = (control.deadline, slot)
+        futures = [executor.submit(fn, *args, task=task) for args in list_args]
+        pending = set(futures)
+        while pending:
+            if control.stop_reason is not None:
+                executor.cancel_flags[slot] = 1
+                for future in pending:
+                    future.cancel()
+                break
+            done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+
+        # Tasks that didn't finish give None
+        not_finished = (
+            CancelledError,
+            FuturesTimeoutError,
+            myokit.SimulationCancelledError,
+        )
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result(timeout=0))
+            except not_finished:
+                results.append(None)
+        return results
+    except BrokenProcessPool:
+        print("Process pool unavailable - running serially")
+        return None
+
+
+def _worker_control(task):
+    """RunControl of a task in a worker process (see run_in_processes)"""
+    if task is None:
+        return None
+    deadline, slot = task
+    return RunControl(deadline=deadline, cancel_flags=_worker_cancel_flags, slot=slot)
+
+
+class RunControl(myokit.ProgressReporter):
+    """
+    Cancel token and wall-clock deadline of a simulation run
+
+    Passed to myokit as the progress reporter of a simulation, so that the
+    simulation stops (raising myokit.SimulationCancelledError) at its next
+    progress update once cancel is called or the deadline has passed.
+
+    Parameters
+    ----------
+    timeout : float
+        Time (s) the run may take. If None, there is no deadline.
+    deadline : float
+        Time (time.time()) at which the run stops, instead of timeout. Used
+        to pass the deadline of a run to worker processes.
+    cancel_flags : multiprocessing shared array
+        Flags shared with the process that started the run. If given, the
+        run is also cancelled once cancel_flags[slot] is set (see
+        run_in_processes).
+    slot : int
+        Index of the run's flag in cancel_flags
+
+    """
+
+    def __init__(self, timeout=None, deadline=None, cancel_flags=None, slot=None):
+        if deadline is None and timeout is not None:
+            deadline = time.time() + timeout
+        self.timeout = timeout
+        self.deadline = deadline
+        self._cancelled = threading.Event()
+        self._cancel_flags = cancel_flags
+        self._slot = slot
+
+    def cancel(self):
+        """Stop the run at its next progress update"""
+        self._cancelled.set()
+
+    @property
+    def stop_reason(self):
+        """Why the run was stopped ("cancelled" or "timeout"), or None"""
+        if self._cancelled.is_set():
+            return "cancelled"
+        if self._cancel_flags is not None and self._cancel_flags[self._slot]:
+            return "cancelled"
+        if self.deadline is not None and time.time() > self.deadline:
+            return "timeout"
+        return None
+
+    def remaining(self):
+        """Time (s) left before the deadline (None if there is no deadline)"""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.time(), 0)
+
+    def check(self):
+        """Raise myokit.SimulationCancelledError if the run has been stopped"""
+        if self.stop_reason is not None:
+            raise myokit.SimulationCancelledError()
+
+    def update(self, progress):
+        return self.stop_reason is None
+
+
+class RunRegistry:
+    """
+    Run in progress of each session, so that a new run cancels the last one
+
+    Parameters
+    ----------
+    timeout : float
+        Time (s) each run may take (see RunControl). If None, there is no
+        limit.
+
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._runs = {}
+        self._lock = threading.Lock()
+        self.cancelled = 0
+
+    def start(self, session_id):
+        """Cancel the session's run in progress, and return a new RunControl"""
+        control = RunControl(timeout=self.timeout)
+        with self._lock:
+            previous = self._runs.get(session_id)
+            self._runs[session_id] = control
+        if previous is not None:
+            print("Cancel previous run of session {}".format(session_id))
+            previous.cancel()
+            self.cancelled += 1
+        return control
+
+    def finish(self, session_id, control):
+        """Remove control from the registry, unless a newer run replaced it"""
+        with self._lock:
+            if self._runs.get(session_id) is control:
+                del self._runs[session_id]
+
+    def stats(self):
+        with self._lock:
+            return {"active": len(self._runs), "cancelled": self.cancelled}
+
+
+class RunRejected(Exception):
+    """A run that RunScheduler won't start. The message is shown to the user."""
+
+
+class RunScheduler:
+    """
+    Admission control for simulation runs
+
+    The cost of a run is the model time it simulates (ms, summed over its
+    simulations, see sim_model_cost, s1s2_cost and rate_change_cost). Runs
+    costing more than max_cost are rejected. Otherwise a run waits until
+    its session has fewer than session_limit runs in progress and the total
+    cost of runs in progress leaves room for it within budget.
+
+    Interactive runs (costing at most interactive_cost) are started before
+    waiting sweeps, and sweeps may only use budget - interactive_cost, so
+    there is always room for an interactive run once earlier interactive
+    runs finish.
+
+    Parameters
+    ----------
+    max_cost : float
+        Maximum cost (simulated ms) of a run
+    budget : float
+        Maximum total cost of runs in progress
+    session_limit : int
+        Maximum number of runs in progress per session
+    interactive_cost : float
+        Maximum cost of a run that is started before sweeps
+    max_waiting : int
+        Maximum number of runs waiting to start. Further runs are rejected.
+
+    """
+
+    def __init__(
+        self,
+        max_cost=1e6,
+        budget=3e6,
+        session_limit=1,
+        interactive_cost=2e5,
+        max_waiting=20,
+    ):
+        if max_cost > budget - interactive_cost:
+            raise ValueError("max_cost must be at most budget - interactive_cost")
+        self.max_cost = max_cost
+        self.budget = budget
+        self.session_limit = session_limit
+        self.interactive_cost = interactive_cost
+        self.max_waiting = max_waiting
+
+        self._condition = threading.Condition()
+        self._counter = itertools.count()
+        # Tickets of waiting and running runs: (is_sweep, order, session, cost)
+        self._waiting = []
+        self._running = []
+        self.cost_in_progress = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_time_total = 0
+        self.wait_time_max = 0
+
+    def _session_full(self, session_id):
+        if session_id is None:
+            return False
+        num_runs = sum(1 for ticket in self._running if ticket[2] == session_id)
+        return num_runs >= self.session_limit
+
+    def _can_start(self, ticket):
+        # Next waiting run whose session has room, highest priority first
+        for waiting in sorted(self._waiting):
+            if not self._session_full(waiting[2]):
+                break
+        else:
+            return False
+        if waiting is not ticket:
+            return False
+        is_sweep, _, _, cost = ticket
+        budget = self.budget - self.interactive_cost if is_sweep else self.budget
+        return self.cost_in_progress + cost <= budget
+
+    def _reject(self, message):
+        self.rejected += 1
+        raise RunRejected(message)
+
+    @contextmanager
+    def admit(self, session_id, cost, control=None):
+        """
+        Wait until the run can start, and hold its place for a with block
+
+        Parameters
+        ----------
+        session_id : str
+            Session of the run. If None, there is no per-session limit.
+        cost : float
+            Cost (simulated ms) of the run
+        control : RunControl
+            Cancel token and deadline of the run. The run waits no longer
+            than its deadline.
+
+        Raises
+        ------
+        RunRejected
+            If the run costs too much, too many runs are waiting, or the run
+            reached its deadline before it could start
+        myokit.SimulationCancelledError
+            If the run was cancelled while waiting
+
+        """
+
+        with self._condition:
+            if cost > self.max_cost:
+                self._reject(
+                    "This run would simulate {:g} s of model time, more than the "
+                    "limit of {:g} s. Reduce the number of beats or values to "
+                    "simulate.".format(cost / 1000, self.max_cost / 1000)
+                )
+            if len(self._waiting) >= self.max_waiting:
+                self._reject("The server is busy. Please try again shortly.")
+
+            is_sweep = cost > self.interactive_cost
+            ticket = (is_sweep, next(self._counter), session_id, cost)
+            t_start = time.perf_counter()
+            self._waiting.append(ticket)
+            try:
+                while not self._can_start(ticket):
+                    if control is not None and control.stop_reason == "cancelled":
+                        raise myokit.SimulationCancelledError()
+                    if control is not None and control.stop_reason == "timeout":
+                        self._reject(
+                            "The server is busy and the run couldn't start "
+                            "within {:g} s. Please try again shortly.".format(
+                                control.timeout
+                            )
+                        )
+                    # Poll so that cancellation and the deadline are noticed
+                    self._condition.wait(timeout=None if control is None else 0.1)
+            finally:
+                self._waiting.remove(ticket)
+                self._condition.notify_all()
+
+            wait_time = time.perf_counter() - t_start
+            self._running.append(ticket)
+            self.cost_in_progress += cost
+            self.admitted += 1
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+
+        # Logged once the lock is released
+        log_span("admit", wait_time, cost_ms=cost, sweep=is_sweep)
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._running.remove(ticket)
+                self.cost_in_progress -= cost
+                self._condition.notify_all()
+
+    def stats(self):
+        """Runs in progress and waiting, and admission metrics"""
+        with self._condition:
+            return {
+                "running": len(self._running),
+                "waiting": len(self._waiting),
+                "cost_in_progress": self.cost_in_progress,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "wait_time_mean": self.wait_time_total / max(self.admitted, 1),
+                "wait_time_max": self.wait_time_max,
+            }
+
+
+def sim_model_cost(bcl, total_beats):
+    """Model time (ms) simulated by sim_model"""
+    return float(bcl * total_beats)
+
+
+def s1s2_cost(s1_interval, s1_nbeats, s2_intervals):
+    """Model time (ms) simulated by sim_s1s2_restitution"""
+    num_s2_intervals = len([s2 for s2 in s2_input_to_list(s2_intervals) if s2 > 0])
+    return float(s1_interval * (s1_nbeats + 2 * num_s2_intervals))
+
+
+def rate_change_cost(bcl_values, nbeats):
+    """Model time (ms) simulated by sim_rate_change"""
+    list_bcl_values = [bcl for bcl in s2_input_to_list(bcl_values) if bcl > 0]
+    return float(sum(bcl * (nbeats + 3) for bcl in list_bcl_values))
+
+
+def stopped_message(reason, timeout=None, completed=None, total=None, unit="beats"):
+    """Message to show the user when a run was stopped early"""
+    if reason == "timeout":
+        message = "Simulation stopped at the time limit of {:g} s.".format(timeout)
+    else:
+        message = "Simulation cancelled."
+    if completed is not None:
+        message += " Showing the {} of {} {} that finished.".format(
+            completed, total, unit
+        )
+    return message
+
+
+# Message to show the user when a result is requested after it was removed from
+# the result store
+RESULT_EXPIRED_MESSAGE = (
+    "The results of this simulation are no longer stored. Please run it again."
+)
+
+
+def default_results_key(model, config):
+    """
+    Hash identifying the default results of an app
+
+    Combines the model code, the app configuration, the myokit version, the
+    source of this module and DEFAULT_RESULTS_VERSION, so that stored results
+    become stale whenever any of these change.
+
+    Parameters
+    ----------
+    model : myokit.Model
+    config : dict
+        Settings used to compute the default results (JSON serialisable)
+
+    Returns
+    -------
+    str
+
+    """
+
+    with open(os.path.abspath(__file__), "rb") as f:
+        source_hash = hashlib.sha256(f.read()).hexdigest()
+    key_info = [
+        model.code(),
+        json.dumps(config, sort_keys=True, default=str),
+        myokit.__version__,
+        source_hash,
+        str(DEFAULT_RESULTS_VERSION),
+    ]
+    return hashlib.sha256("\n".join(key_info).encode()).hexdigest()
+
+
+def load_default_results(path, model, config, compute):
+    """
+    Load an app's default results from path, computing them if necessary
+
+    The results are normally built ahead of time by build_defaults.py. If the
+    file is missing or stale (see default_results_key), compute is called and
+    its results are stored at path for the next process.
 
     Parameters
     ----------
+    path : str
+        Pickle file of default results
+    model : myokit.Model
+    config : dict
+        Settings used to compute the default results
+    compute : function
+        Function with no arguments that returns the default results
 
-    s : simulation class (myokit.Simulation)
-    params : dict
-        Dictionary of user-defined model parameter values. Those that are not
-        specified are set to default.
-    bcl : float
-        basic cycle length
-    total_beats : int
-        total number of beats to simulate
-    beats_kepp: int
-        number of beats to display in figure (from the end of the simulation)
+    Returns
+    -------
+    results returned by compute
+
+    """
+
+    key = default_results_key(model, config)
+    if os.path.exists(path):
+        try:
+            with open(path, "rb") as f:
+                artifact = pickle.load(f)
+            if artifact["key"] == key:
+                return artifact["results"]
+            print("Default results at {} are stale".format(path))
+        except Exception as e:
+            print("Could not read default results at {}: {}".format(path, e))
+
+    print("Compute default results")
+    results = compute()
+
+    # Write to a temporary file first so that readers never see a partial file
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    path_tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(path_tmp, "wb") as f:
+        pickle.dump({"key": key, "results": results}, f)
+    os.replace(path_tmp, path)
+
+    return results
+
+
+@lru_cache(maxsize=None)
+def plotly_js_version():
+    """
+    Version of plotly.js served by dash, as a tuple of ints (or None if it
+    cannot be found)
+    """
+    # Older dash bundles plotly.js, newer dash serves the one in plotly
+    paths = [
+        os.path.join(os.path.dirname(dcc.__file__), "plotly.min.js"),
+        os.path.join(os.path.dirname(plotly.__file__), "package_data", "plotly.min.js"),
+    ]
+    for path in paths:
+        try:
+            with open(path) as f:
+                header = f.read(200)
+        except OSError:
+            continue
+        match = re.search(r"plotly\.js v(\d+)\.(\d+)\.(\d+)", header)
+        if match is not None:
+            return tuple(int(x) for x in match.groups())
+    return None
+
+
+def plotly_typed_arrays_supported():
+    """True if the bundled plotly.js reads base64 typed arrays (v2.28+)"""
+    version = plotly_js_version()
+    return version is not None and version >= (2, 28, 0)
+
+
+def round_significant(values, digits=7):
+    """
+    Round values to a number of significant digits
+
+    Results are the doubles nearest to the rounded decimals, so they are
+    written to JSON with at most digits significant digits. 7 digits
+    matches float32 precision.
+    """
+    values = np.asarray(values, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        exponent = digits - 1 - np.floor(np.log10(np.abs(values)))
+    exponent = np.where(np.isfinite(exponent), exponent, 0)
+    # Divide by (rather than multiply by) powers of ten below one, as these
+    # are not exact in binary
+    scale = 10.0 ** np.abs(exponent)
+    return np.where(
+        exponent >= 0,
+        np.round(values * scale) / scale,
+        np.round(values / scale) * scale,
+    )
+
+
+def encode_array(values, float32=True, typed_array=False):
+    """
+    Encode a numeric array for sending to the browser
+
+    Parameters
+    ----------
+    values : np.array
+    float32 : bool
+        If True, reduce precision to float32 (about 7 significant digits)
+    typed_array : bool
+        If True, return a plotly typed array {"dtype", "bdata"} with the
+        values as base64 encoded bytes, instead of a list
 
     Returns
     -------
-    df : pd.DataFrame
-        Dataframe of variables at each time value.
+    list or dict
 
     """
 
-    # Get default state of model
-    default_state = s.default_state()
+    if isinstance(values, dict) and "bdata" in values:
+        # Already a typed array (plotly 6+ encodes numpy arrays itself)
+        values = np.frombuffer(base64.b64decode(values["bdata"]), values["dtype"])
 
-    # Assign parameters to simulation object
-    for key in params.keys():
-        s.set_constant(key, params[key])
+    values = np.asarray(values)
+    if values.dtype.kind != "f":
+        return values.tolist()
 
-    # Set pacing protocol and assign to simulation object
-    p = myokit.pacing.blocktrain(bcl, duration=0.5, offset=20)
-    s.set_protocol(p)
+    if typed_array:
+        dtype = "<f4" if float32 else "<f8"
+        return {
+            "dtype": dtype[1:],
+            "bdata": base64.b64encode(values.astype(dtype).tobytes()).decode("ascii"),
+        }
 
-    # Pre-pacing simulation
-    num_beats_pre = max(total_beats - beats_keep, 0)
-    print("Begin prepacing")
-    s.pre(num_beats_pre * bcl)
+    if float32:
+        values = round_significant(values, 7)
+    return values.tolist()
 
-    # Pacing simulation
-    print("Begin recorded simulation")
-    d = s.run(bcl * beats_keep)
 
-    # Collect data specified in plot_vars
-    data_dict = {key: d[key] for key in plot_vars}
-    data_dict["time"] = d["environment.time"]
-    df = pd.DataFrame(data_dict)
+def compact_figure(fig, float32=True, typed_array=None):
+    """
+    Return a figure as a dict with compactly encoded trace data
 
-    # Reset simulation (don't use s.reset as this only goes to end of pre-pacing)
-    s.set_state(default_state)
-    s.set_time(0)
+    Trace x and y arrays are encoded with encode_array. The full precision
+    data stays on the server for downloads.
 
-    return df
+    Parameters
+    ----------
+    fig : go.Figure
+    float32 : bool
+        If True, reduce trace data to float32 precision
+    typed_array : bool
+        If True, send trace data as base64 typed arrays. If None, typed arrays
+        are used if the plotly.js bundled with dash supports them.
+
+    Returns
+    -------
+    dict
+
+    """
+
+    if typed_array is None:
+        typed_array = plotly_typed_arrays_supported()
+
+    fig_dict = fig.to_dict()
+    for trace in fig_dict["data"]:
+        for key in ["x", "y"]:
+            if key in trace and (
+                isinstance(trace[key], dict) or np.ndim(trace[key]) == 1
+            ):
+                trace[key] = encode_array(trace[key], float32, typed_array)
+    return fig_dict
+
+
+def make_tab_figures(make_fig, plot_vars):
+    """
+    Make the figure for each tab, in the form used to switch tabs on the
+    client (see render_figures in assets/clientside.js)
+
+    Figures for different tabs must have the same traces in the same order.
+    x data that is the same for all tabs is sent once. Traces keep their own
+    x data where it differs, so time series should be decimated for all tabs
+    together with decimate_columns (rather than for each tab by
+    decimate_traces) before making the figures.
+
+    Parameters
+    ----------
+    make_fig : function
+        Returns the figure for a plot variable
+    plot_vars : list
+        Plot variable of each tab
+
+    Returns
+    -------
+    dict
+        x : list
+            x data of each trace, shared by all tabs
+        traces : dict
+            Traces of the compact figure for each plot variable (see
+            compact_figure), without x data if it is the shared x data
+        layout : dict
+            Layout of the figure for each plot variable
+
+    """
+
+    tab_figures = {"x": [], "traces": {}, "layout": {}}
+    with timing_span("figures", tabs=len(plot_vars)):
+        for plot_var in plot_vars:
+            fig = compact_figure(make_fig(plot_var))
+            if len(tab_figures["x"]) == 0:
+                tab_figures["x"] = [trace.get("x") for trace in fig["data"]]
+            for trace, x in zip(fig["data"], tab_figures["x"]):
+                if trace.get("x") == x:
+                    del trace["x"]
+            tab_figures["traces"][plot_var] = fig["data"]
+            tab_figures["layout"][plot_var] = fig["layout"]
+    return tab_figures
+
+
+def payload_size(payload):
+    """Size in bytes of payload serialised to JSON as dash does"""
+    return len(json.dumps(payload, cls=plotly.utils.PlotlyJSONEncoder))
+
+
+def log_payload_size(label, payload):
+    """Log the JSON size of a callback payload and the time to serialize it"""
+    with timing_span("serialize", payload=label) as span:
+        span["bytes"] = payload_size(payload)
+
+
+def _halve_minmax(x, y):
+    """
+    Halve the number of points in a trace, keeping the min and max of each
+    block of four points (in time order)
+    """
+    n = len(x) // 4 * 4
+    x_blocks = x[:n].reshape(-1, 4)
+    y_blocks = y[:n].reshape(-1, 4)
+    idx_min = np.argmin(y_blocks, axis=1)
+    idx_max = np.argmax(y_blocks, axis=1)
+    idx = np.sort(np.column_stack([idx_min, idx_max]), axis=1)
+    rows = np.arange(len(x_blocks))[:, None]
+    # Samples left over at the end are kept as they are
+    x_out = np.concatenate([x_blocks[rows, idx].ravel(), x[n:]])
+    y_out = np.concatenate([y_blocks[rows, idx].ravel(), y[n:]])
+    return x_out, y_out
+
+
+class TracePyramid:
+    """
+    Multi-resolution min/max decimation of a trace
+
+    Level 0 is the trace itself. Each following level has half as many
+    points, keeping the min and max of each block of four points of the
+    level below, so peaks (e.g. of action potentials) are never lost.
+
+    Parameters
+    ----------
+    x : np.array
+        x values (e.g. time), in increasing order
+    y : np.array
+        y values
+    min_points : int
+        Stop adding levels once a level has at most this many points
+
+    """
+
+    __slots__ = ("levels",)
+
+    def __init__(self, x, y, min_points=500):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        self.levels = [(x, y)]
+        while len(x) > max(min_points, 3):
+            x, y = _halve_minmax(x, y)
+            self.levels.append((x, y))
+
+    def select(self, x_range=(None, None), max_points=5000):
+        """
+        Return the finest level of the trace within x_range that has at most
+        max_points points
+
+        Parameters
+        ----------
+        x_range : tuple
+            (x0, x1) window. None for either end means the end of the trace.
+        max_points : int
+
+        Returns
+        -------
+        x, y : np.array
+            Points in the window, plus one point either side so that lines
+            continue to the edge of the plot
+
+        """
+        x0, x1 = x_range
+        for x, y in self.levels:
+            i0 = 0 if x0 is None else max(np.searchsorted(x, x0) - 1, 0)
+            i1 = len(x) if x1 is None else np.searchsorted(x, x1, side="right") + 1
+            if i1 - i0 <= max_points:
+                break
+        return x[i0:i1], y[i0:i1]
+
+
+def group_bounds(values):
+    """
+    Start and end index of each run of equal values (e.g. the S2 interval of
+    concatenated protocol runs)
+    """
+    values = np.asarray(values)
+    if len(values) == 0:
+        return []
+    starts = np.flatnonzero(values[1:] != values[:-1]) + 1
+    starts = np.concatenate([[0], starts])
+    ends = np.append(starts[1:], len(values))
+    return list(zip(starts, ends))
+
+
+def make_trace_pyramids(df, x_key, y_key, group_key=None):
+    """
+    Make a TracePyramid for each trace in df
+
+    Traces are runs of rows with the same value of group_key (one trace if
+    group_key is None), in the order they appear. This matches the order of
+    traces in the figures made by make_s1s2_fig and make_bcl_ts_fig.
+
+    Returns
+    -------
+    list(TracePyramid)
+
+    """
+    x = np.asarray(df[x_key])
+    y = np.asarray(df[y_key])
+    if group_key is None:
+        bounds = [(0, len(x))]
+    else:
+        bounds = group_bounds(df[group_key])
+    return [TracePyramid(x[start:end], y[start:end]) for start, end in bounds]
+
+
+def decimate_traces(df, x_key, y_key, group_key=None, max_points=display_points):
+    """
+    Reduce the traces in df to about max_points points in total for display
+    (min/max decimation, see TracePyramid)
+
+    Each trace keeps at least min_points_per_trace points.
+
+    Returns
+    -------
+    dict
+        Columns x_key, y_key (and group_key) of the decimated traces
+
+    """
+    x = np.asarray(df[x_key])
+    y = np.asarray(df[y_key])
+    if group_key is None:
+        bounds = [(0, len(x))]
+    else:
+        groups = np.asarray(df[group_key])
+        bounds = group_bounds(groups)
+
+    max_points_trace = max(max_points // max(len(bounds), 1), min_points_per_trace)
+    data = {x_key: [], y_key: []}
+    if group_key is not None:
+        data[group_key] = []
+    for start, end in bounds:
+        x_trace = x[start:end]
+        y_trace = y[start:end]
+        while len(x_trace) > max_points_trace:
+            x_trace, y_trace = _halve_minmax(x_trace, y_trace)
+        data[x_key].append(x_trace)
+        data[y_key].append(y_trace)
+        if group_key is not None:
+            data[group_key].append(np.full(len(x_trace), groups[start]))
+
+    return {
+        key: np.concatenate(values) if len(values) > 0 else np.array([])
+        for key, values in data.items()
+    }
+
+
+def _minmax_indices(y_list, num_blocks):
+    """
+    Sorted indices of the min and max of each y in each of num_blocks blocks
+    of consecutive samples, plus the first and last sample
+    """
+    n = len(y_list[0])
+    width = -(-n // num_blocks)
+    offsets = np.arange(0, n, width)
+    idx = [np.array([0, n - 1])]
+    for y in y_list:
+        # Pad the last block with its last value
+        y_blocks = np.pad(y, (0, len(offsets) * width - n), mode="edge")
+        y_blocks = y_blocks.reshape(len(offsets), width)
+        idx.append(offsets + np.argmin(y_blocks, axis=1))
+        idx.append(offsets + np.argmax(y_blocks, axis=1))
+    return np.unique(np.minimum(np.concatenate(idx), n - 1))
+
+
+def decimate_columns(df, x_key, y_keys, group_key=None, max_points=display_points):
+    """
+    Reduce the traces of several columns of df onto common x values for
+    display, so that figures of each column (one per tab) share their x data
+    (see make_tab_figures)
+
+    Each trace is split into blocks, and the samples at the min and max of
+    every column in each block are kept, so no column loses its peaks. The
+    number of blocks is the largest (halving from half the points allowed)
+    that keeps each trace within the points that decimate_traces allows it,
+    so decimating the result again with decimate_traces leaves it as it is.
+
+    Parameters
+    ----------
+    df : SimResult or pd.DataFrame
+    x_key : str
+        Column of x values (e.g. time)
+    y_keys : list
+        Columns to decimate. Those not in df are left out.
+    group_key : str
+        Column whose runs of equal values are separate traces (see
+        decimate_traces). If None, df is one trace.
+    max_points : int
+        Maximum number of points of each column in total
+
+    Returns
+    -------
+    SimResult
+        Columns x_key, y_keys (and group_key) at the kept samples
+
+    """
+    keys = [x_key] + [key for key in y_keys if key in df.columns and key != x_key]
+    if group_key is not None:
+        keys.append(group_key)
+    columns = {key: np.asarray(df[key]) for key in keys}
+    y_list = [columns[key] for key in keys[1:] if key != group_key]
+
+    n = len(columns[x_key])
+    if group_key is None:
+        bounds = [(0, n)]
+    else:
+        bounds = group_bounds(columns[group_key])
+    max_points_trace = max(max_points // max(len(bounds), 1), min_points_per_trace)
+
+    idx = []
+    for start, end in bounds:
+        if end - start <= max_points_trace or len(y_list) == 0:
+            idx.append(np.arange(start, end))
+            continue
+        y_trace = [y[start:end] for y in y_list]
+        num_blocks = max_points_trace // 2
+        idx_trace = _minmax_indices(y_trace, num_blocks)
+        while len(idx_trace) > max_points_trace and num_blocks > 1:
+            num_blocks //= 2
+            idx_trace = _minmax_indices(y_trace, num_blocks)
+        idx.append(start + idx_trace)
+    idx = np.concatenate(idx) if len(idx) > 0 else np.array([], dtype=int)
+
+    return SimResult({key: values[idx] for key, values in columns.items()})
+
+
+def relayout_x_range(relayout_data):
+    """
+    Get the x-axis window from the relayoutData of a graph
+
+    Returns
+    -------
+    tuple or None
+        (x0, x1), or (None, None) if the x-axis was reset to show everything.
+        None if the x-axis did not change.
 
+    """
+    if not relayout_data:
+        return None
+    if "xaxis.range[0]" in relayout_data and "xaxis.range[1]" in relayout_data:
+        return relayout_data["xaxis.range[0]"], relayout_data["xaxis.range[1]"]
+    if "xaxis.range" in relayout_data:
+        return tuple(relayout_data["xaxis.range"])
+    if relayout_data.get("xaxis.autorange"):
+        return None, None
+    return None
+
+
+def patch_trace_window(pyramids, x_range, max_points=display_points):
+    """
+    Make a Patch for a figure that replaces its trace data with the finest
+    resolution that fits max_points (in total) within x_range
 
-def make_simulation_fig(df_sim, plot_var):
+    Trace i of the figure is drawn from pyramids[i].
+    """
+    typed_array = plotly_typed_arrays_supported()
+    max_points_trace = max(max_points // max(len(pyramids), 1), min_points_per_trace)
+    patch = Patch()
+    for i, pyramid in enumerate(pyramids):
+        x, y = pyramid.select(x_range, max_points_trace)
+        # Keep full precision in x, which may be zoomed in far
+        patch["data"][i]["x"] = encode_array(x, float32=False, typed_array=typed_array)
+        patch["data"][i]["y"] = encode_array(y, typed_array=typed_array)
+    return patch
+
+
+def make_simulation_fig(df_sim, plot_var, max_points=display_points):
     """
     Make figure showing variable vs time
     If plot_var is not in df_sim, output empty graph
 
     Parameters
     ----------
-    df_sim : pd.DataFrame
+    df_sim : SimResult or pd.DataFrame
         simulation data of model
     var_plot : variable to plot
+    max_points : int
+        number of points to draw (see decimate_traces)
 
     Returns
     -------
@@ -110,10 +2945,11 @@ def make_simulation_fig(df_sim, plot_var):
     fig = go.Figure()
 
     if plot_var in df_sim.columns:
+        data = decimate_traces(df_sim, "time", plot_var, max_points=max_points)
         fig.add_trace(
             go.Scatter(
-                x=df_sim["time"],
-                y=df_sim[plot_var],
+                x=data["time"],
+                y=data[plot_var],
                 showlegend=False,
                 mode="lines",
                 line={
@@ -140,10 +2976,15 @@ def sim_s1s2_restitution(
     s1_interval=1000,
     s1_nbeats=10,
     s2_intervals="300:500:20, 500:1000:50",
+    adaptive=False,
+    rtol=1e-4,
+    log_interval=None,
+    executor=None,
+    float32=False,
+    control=None,
 ):
     """
     Simulate Torord model usign S1S2 stimulation protocol for a range of S2 values
-    Allow a max of 50 S2 values (to aviod overloading machine)
     Return time series of final S1 stimulation followed by single S2 stimulation
     Return data on APD and CaT amplitude as a function of S2 interval
 
@@ -159,23 +3000,49 @@ def sim_s1s2_restitution(
         number of s1 beats (prepacing)
     s2_intervals: str
         String input by the user that provides s2 values
+    adaptive : bool
+        If True, stop S1 prepacing once the state at each stimulus changes by
+        less than rtol between beats. s1_nbeats is then an upper bound.
+    rtol : float
+        Relative tolerance for adaptive prepacing
+    log_interval : float
+        Interval (ms) at which variables are logged. If None, every solver
+        step is logged.
+    executor : SimulationProcessPool
+        Pool made with make_process_pool, used to run the S2 intervals in
+        parallel from the prepaced state. If None (or the pool is broken),
+        S2 intervals are run one after another. Output is the same either
+        way.
+    float32 : bool
+        If True, store the time series (other than time) as float32
+    control : RunControl
+        Cancel token and deadline of the run. If the run is stopped during S1
+        prepacing, myokit.SimulationCancelledError is raised. Otherwise the
+        S2 intervals that finished are returned.
 
     Returns
     -------
-    df_ts : pd.DataFrame
+    df_ts : SimResult
         time series
     df_restitution: pd.DataFrame
-        apd, di and cat_amplitude as a function of S1
+        di and the biomarkers of the S2 beat (see compute_biomarkers) as a
+        function of S2. apd is measured at -80 mV, di runs from the end of the
+        S1 beat to the start of the S2 beat at -80 mV, and cat_amplitude is
+        the peak calcium of the S2 beat. The number
+        of S1 prepacing beats simulated and the final beat-to-beat residual
+        are stored in df_restitution.attrs["prepace_beats"] and
+        df_restitution.attrs["prepace_residual"]. If the run was stopped
+        early, df_restitution.attrs["stopped"] is the reason (see
+        RunControl.stop_reason). df_restitution.attrs["completed"] and
+        df_restitution.attrs["requested"] are the number of S2 intervals
+        that finished and that were asked for.
 
     """
 
-    # Unpack S2 values
+    # Unpack S2 values. The number of values is limited by the app's
+    # RunScheduler (see s1s2_cost).
     list_s2_intervals = s2_input_to_list(s2_intervals)
 
-    # If too many - only work with last 50 vals
-    if len(list_s2_intervals) > 50:
-        list_s2_intervals = list_s2_intervals[-50:]
-
     # Only take values greater than 0
     list_s2_intervals = [s2 for s2 in list_s2_intervals if s2 > 0]
 
@@ -189,123 +3056,529 @@ def sim_s1s2_restitution(
     # Pre-pacing with S1 interval (only needs to be done once)
     p = myokit.pacing.blocktrain(s1_interval, duration=0.5, offset=0)
     s.set_protocol(p)
-    s.pre(s1_nbeats * s1_interval)
-
-    list_df = []
-    list_di_vals = []
-    list_apd_vals = []
-    list_cat_amplitude_vals = []
-
-    for s2_interval in list_s2_intervals:
-        # Set pacing protocol
-        p = myokit.Protocol()
-        # Single S1 stimulus
-        p.schedule(level=1.0, start=0, duration=0.5)
-        # Single S2 stimulus
-        p.schedule(level=1.0, start=s2_interval, duration=0.5)
-
-        # Update protoocl
-        s.set_protocol(p)
-
-        # Pacing simulation
-        d = s.run(2 * s1_interval)
+    with timing_span("prepace", bcl=s1_interval, cache="off") as span:
+        if adaptive:
+            beats, residual = prepace_to_steady_state(
+                s, s1_interval, s1_nbeats, rtol, progress=control
+            )
+        else:
+            beats, residual = prepace(s, s1_interval, s1_nbeats, progress=control)
+        span.update(beats=beats, simulated_ms=beats * s1_interval)
+
+    # Run S2 intervals, in parallel if an executor is given
+    results = None
+    with timing_span("s2_intervals", requested=len(list_s2_intervals)) as span:
+        if executor is not None:
+            prepaced_state = s.state()
+            results = run_in_processes(
+                executor,
+                _run_s2_interval_worker,
+                [
+                    (
+                        params,
+                        prepaced_state,
+                        s1_interval,
+                        s2_interval,
+                        log_interval,
+                    )
+                    for s2_interval in list_s2_intervals
+                ],
+                control=control,
+            )
+        span["parallel"] = results is not None
+
+        if results is None:
+            results = [None] * len(list_s2_intervals)
+            for i, s2_interval in enumerate(list_s2_intervals):
+                try:
+                    results[i] = _run_s2_interval(
+                        s, s1_interval, s2_interval, log_interval, progress=control
+                    )
+                except myokit.SimulationCancelledError:
+                    break
+                # Reset simulation to pre-paced state
+                s.reset()
+
+        completed = sum(result is not None for result in results)
+        span.update(completed=completed, simulated_ms=completed * 2 * s1_interval)
+
+    # Keep the S2 intervals that finished (all of them unless stopped early)
+    num_s2_intervals = len(list_s2_intervals)
+    list_s2_intervals = [
+        s2 for s2, result in zip(list_s2_intervals, results) if result is not None
+    ]
+    results = [result for result in results if result is not None]
+    stopped = None
+    if len(results) < num_s2_intervals:
+        stopped = control.stop_reason
+        print(
+            "Run {} after {} of {} S2 intervals".format(
+                stopped, len(results), num_s2_intervals
+            )
+        )
 
-        # Collect data
-        data_dict = {}
-        data_dict["membrane.v"] = d["membrane.v"]
-        data_dict["time"] = d["environment.time"]
-        data_dict["intracellular_ions.cai"] = d["intracellular_ions.cai"]
-        df = pd.DataFrame(data_dict)
-        df["s2_interval"] = s2_interval
-        list_df.append(df)
-
-        # Compute DI and APD from S2
-        voltage_vals = d["membrane.v"]
-        time_vals = d["environment.time"]
-        thresh = -80  # mV
-        crossings_zero_voltage = find_crossings(voltage_vals, 0)
-        crossings_thresh = find_crossings(voltage_vals, thresh)
-
-        # Must be 4 crossings at zero voltage to determine DI and APD
-        if (len(crossings_zero_voltage) == 4) & (len(crossings_thresh) == 4):
-            # Get DI and APD info
-            di_start = crossings_thresh[1]
-            di_end = crossings_thresh[2]
-            ap_end = crossings_thresh[3]
-            di = time_vals[di_end] - time_vals[di_start]
-            apd = time_vals[ap_end] - time_vals[di_end]
+    list_df = [result[0] for result in results]
+    list_df_beats = [result[1] for result in results]
 
+    with timing_span("result") as span:
+        # Restitution of the S2 beat. DI runs from the end of S1 to the start
+        # of S2, both at -80 mV.
+        df_restitution = pd.DataFrame(
+            {"s2_interval": list_s2_intervals},
+            columns=["s2_interval", "di", "apd", "cat_amplitude"],
+        )
+        if len(list_df_beats) > 0:
+            df_beats = pd.concat(list_df_beats, ignore_index=True)
+            df_s1 = df_beats.iloc[0::2].reset_index(drop=True)
+            df_s2 = df_beats.iloc[1::2].reset_index(drop=True)
+            df_restitution = pd.concat(
+                [
+                    df_restitution[["s2_interval"]],
+                    pd.DataFrame({"di": df_s2["ap_start"] - df_s1["ap_end"]}),
+                    df_s2.drop(columns=["beat"]),
+                ],
+                axis=1,
+            )
+        df_restitution.attrs["prepace_beats"] = beats
+        df_restitution.attrs["prepace_residual"] = residual
+        df_restitution.attrs["stopped"] = stopped
+        df_restitution.attrs["completed"] = len(results)
+        df_restitution.attrs["requested"] = num_s2_intervals
+
+        if len(list_df) == 0:
+            columns = ["membrane.v", "time", "intracellular_ions.cai", "s2_interval"]
+            df_ts = SimResult({key: np.array([]) for key in columns})
         else:
-            di = np.nan
-            apd = np.nan
+            df_ts = SimResult.concat(list_df, float32=float32)
+        span["bytes"] = df_ts.nbytes
 
-        list_di_vals.append(di)
-        list_apd_vals.append(apd)
+    # Reset simulation completely (including prepacing)
+    s.set_default_state(default_state)
+    s.set_state(default_state)
+    s.set_time(0)
 
-        # Get calcium transient amplitude (the one after S2)
-        local_maxima = find_local_maxima(d["intracellular_ions.cai"])
-        # Require at least two peaks
-        if len(local_maxima) >= 2:
-            cat_amplitude = local_maxima[1]
-        else:
-            cat_amplitude = np.nan
+    return df_ts, df_restitution
+
+
+def _run_s2_interval(s, s1_interval, s2_interval, log_interval=None, progress=None):
+    """
+    Run a single S1 stimulus followed by an S2 stimulus from the current state
+
+    Returns
+    -------
+    df : SimResult
+        time series
+    df_beats : pd.DataFrame
+        biomarkers of the S1 and S2 beats (see compute_biomarkers)
+
+    """
+
+    # Set pacing protocol
+    p = myokit.Protocol()
+    # Single S1 stimulus
+    p.schedule(level=1.0, start=0, duration=0.5)
+    # Single S2 stimulus
+    p.schedule(level=1.0, start=s2_interval, duration=0.5)
+
+    # Update protoocl
+    s.set_protocol(p)
+
+    # Pacing simulation
+    d = s.run(
+        2 * s1_interval,
+        log=log_vars_protocol,
+        log_interval=log_interval,
+        progress=progress,
+    )
+
+    # Collect data
+    data_dict = {}
+    data_dict["membrane.v"] = d["membrane.v"]
+    data_dict["time"] = d["environment.time"]
+    data_dict["intracellular_ions.cai"] = d["intracellular_ions.cai"]
+    df = SimResult(data_dict)
+    df["s2_interval"] = s2_interval
+
+    # Biomarkers of the S1 and S2 beats
+    df_beats = compute_biomarkers(
+        d["environment.time"],
+        d["membrane.v"],
+        d["intracellular_ions.cai"],
+        stim_times=[0, s2_interval],
+    )
+
+    return df, df_beats
+
+
+def _run_s2_interval_worker(
+    params, state, s1_interval, s2_interval, log_interval, task=None
+):
+    """Run _run_s2_interval in a worker process, starting from state"""
+    progress = _worker_control(task)
+    with _worker_pool.simulation() as s:
+        for key in params.keys():
+            s.set_constant(key, params[key])
+        s.set_state(state)
+        return _run_s2_interval(s, s1_interval, s2_interval, log_interval, progress)
+
+
+def find_crossings(arr, value, time=None):
+    """
+    Find where arr crosses value, in either direction
+
+    Parameters
+    ----------
+    arr : np.array
+        Trace values. A 2D array is treated as one trace per row (shorter
+        traces can be padded with nan).
+    value : float
+        Value to cross
+    time : np.array
+        Sample times, same shape as arr (or 1D if shared by all rows). If
+        given, crossing times are returned, linearly interpolated between
+        the samples either side of each crossing.
+
+    Returns
+    -------
+    np.array or list(np.array)
+        Crossing times, or indices i such that the crossing lies between
+        samples i and i + 1 if time is None. For 2D input, a list with one
+        array per row.
+
+    """
+
+    arr = np.asarray(arr, dtype=float)
+    arr_2d = np.atleast_2d(arr)
+
+    a0 = arr_2d[:, :-1]
+    a1 = arr_2d[:, 1:]
+    is_crossing = ((a0 < value) & (a1 >= value)) | ((a0 > value) & (a1 <= value))
+    rows, idx = np.nonzero(is_crossing)
+
+    if time is None:
+        crossings = idx
+    else:
+        time_2d = np.broadcast_to(np.asarray(time, dtype=float), arr_2d.shape)
+        v0 = arr_2d[rows, idx]
+        v1 = arr_2d[rows, idx + 1]
+        t0 = time_2d[rows, idx]
+        t1 = time_2d[rows, idx + 1]
+        crossings = t0 + (value - v0) / (v1 - v0) * (t1 - t0)
+
+    # Split into one array per row
+    counts = np.bincount(rows, minlength=arr_2d.shape[0])
+    crossings = np.split(crossings, np.cumsum(counts)[:-1])
+    return crossings[0] if arr.ndim == 1 else crossings
+
+
+def find_local_maxima(arr, time=None, return_times=False):
+    """
+    Find local maxima of arr, refined by fitting a parabola to each peak
+
+    Parameters
+    ----------
+    arr : np.array
+        Trace values. A 2D array is treated as one trace per row.
+    time : np.array
+        Sample times, same shape as arr (or 1D if shared by all rows). If
+        None, samples are taken to be evenly spaced.
+    return_times : bool
+        If True, also return the time of each peak
+
+    Returns
+    -------
+    np.array or list(np.array)
+        Peak values (and times if return_times). For 2D input, a list with
+        one array per row.
 
-        list_cat_amplitude_vals.append(cat_amplitude)
+    """
+
+    arr = np.asarray(arr, dtype=float)
+    arr_2d = np.atleast_2d(arr)
+    if time is None:
+        time = np.arange(arr_2d.shape[1], dtype=float)
+    time_2d = np.broadcast_to(np.asarray(time, dtype=float), arr_2d.shape)
+
+    is_peak = (arr_2d[:, 1:-1] > arr_2d[:, :-2]) & (arr_2d[:, 1:-1] > arr_2d[:, 2:])
+    rows, idx = np.nonzero(is_peak)
+    idx = idx + 1
+
+    # Parabola through the peak and its neighbours
+    y0, y1, y2 = arr_2d[rows, idx - 1], arr_2d[rows, idx], arr_2d[rows, idx + 1]
+    t0, t1, t2 = time_2d[rows, idx - 1], time_2d[rows, idx], time_2d[rows, idx + 1]
+    d01 = (y1 - y0) / (t1 - t0)
+    d12 = (y2 - y1) / (t2 - t1)
+    curvature = (d12 - d01) / (t2 - t0)
+    peak_times = np.clip((t0 + t1) / 2 - d01 / (2 * curvature), t0, t2)
+    peak_values = (
+        y0
+        + (peak_times - t0) * d01
+        + ((peak_times - t0) * (peak_times - t1) * curvature)
+    )
+
+    # Split into one array per row
+    counts = np.bincount(rows, minlength=arr_2d.shape[0])
+    split_idx = np.cumsum(counts)[:-1]
+    peak_values = np.split(peak_values, split_idx)
+    peak_times = np.split(peak_times, split_idx)
+    if arr.ndim == 1:
+        peak_values, peak_times = peak_values[0], peak_times[0]
+
+    if return_times:
+        return peak_values, peak_times
+    return peak_values
+
+
+# Columns of the per-beat biomarker table (see compute_biomarkers)
+biomarker_columns_ap = [
+    "beat",
+    "stim_time",
+    "ap_start",
+    "ap_end",
+    "apd",
+    "activation_time",
+    "apd30",
+    "apd50",
+    "apd90",
+    "triangulation",
+    "dvdt_max",
+    "v_peak",
+    "v_rest",
+]
+biomarker_columns_cat = [
+    "cat_amplitude",
+    "cai_diastolic",
+    "cat_rise",
+    "cat_ttp",
+    "cat_tau",
+]
+
+
+def compute_biomarkers(
+    time,
+    voltage,
+    cai=None,
+    stim_times=[0],
+    v_threshold=-80,
+    v_excited=0,
+    min_amplitude=30,
+):
+    """
+    Compute biomarkers for each beat of a recorded trace
+
+    The trace is split into beats at the stimulus times, and every beat is
+    processed at once with NumPy reductions over the segments
+    (np.ufunc.reduceat). Threshold crossings (find_crossings) are linearly
+    interpolated between samples, and calcium peaks (find_local_maxima) are
+    refined by a parabola.
+
+    Parameters
+    ----------
+    time : np.array
+        sample times (ms)
+    voltage : np.array
+        membrane potential (mV)
+    cai : np.array
+        intracellular calcium. If None, calcium biomarkers are not computed.
+    stim_times : list
+        stimulus times (ms). Beat k runs from stim_times[k] up to the next
+        stimulus (or the end of the trace).
+    v_threshold : float
+        Potential (mV) at which apd is measured
+    v_excited : float
+        Potential (mV) the peak must exceed for a beat to count as an action
+        potential. AP biomarkers are nan for other beats.
+    min_amplitude : float
+        Minimum rise (mV) of the peak above the potential at the stimulus for
+        a beat to count as an action potential
+
+    Returns
+    -------
+    df_beats : pd.DataFrame
+        One row per stimulus, with columns
+        - beat, stim_time
+        - ap_start, ap_end: times the potential first rises through
+          v_threshold in the beat, and next falls back through it (ms)
+        - apd: ap_end - ap_start, the APD of the restitution and rate
+          tables (ms)
+        - activation_time: time of max dV/dt
+        - apd30, apd50, apd90: time from activation to 30, 50 and 90%
+          repolarisation (ms)
+        - triangulation: apd90 - apd30 (ms)
+        - dvdt_max: max upstroke velocity (mV/ms)
+        - v_peak: peak potential (mV)
+        - v_rest: potential at the stimulus (mV)
+        - cat_amplitude: peak calcium, the largest local maximum of cai in
+          the beat (nan if cai has no local maximum)
+        - cai_diastolic: calcium at the stimulus
+        - cat_rise: cat_amplitude - cai_diastolic
+        - cat_ttp: time from stimulus to peak calcium (ms)
+        - cat_tau: time from peak calcium to decay by 1 - 1/e of the rise,
+          i.e. the decay time constant of an exponential (ms)
 
-        # Reset simulation to pre-paced state
-        s.reset()
+    """
 
-    df_restitution = pd.DataFrame(
+    time = np.asarray(time, dtype=float)
+    voltage = np.asarray(voltage, dtype=float)
+    stim_times = np.asarray(stim_times, dtype=float)
+    n = len(time)
+
+    # Segment the trace into beats. Beats with fewer than two samples (e.g.
+    # stimuli after the end of the trace) are left as nan.
+    starts_all = np.searchsorted(time, stim_times)
+    ends_all = np.append(starts_all[1:], n)
+    valid = (ends_all - starts_all) >= 2
+    starts = starts_all[valid]
+    ends = np.append(starts[1:], n)
+
+    columns = biomarker_columns_ap + (biomarker_columns_cat if cai is not None else [])
+    df_beats = pd.DataFrame(np.nan, index=range(len(stim_times)), columns=columns)
+    df_beats["beat"] = np.arange(len(stim_times))
+    df_beats["stim_time"] = stim_times
+    if len(starts) == 0:
+        return df_beats
+
+    # Beat of each sample (samples before the first stimulus are not reduced)
+    idx = np.arange(n)
+    beat_id = np.clip(np.searchsorted(starts, idx, side="right") - 1, 0, None)
+
+    # Upstroke velocity - forward difference within each beat
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dvdt = np.append(np.diff(voltage) / np.diff(time), np.nan)
+    dvdt[ends - 1] = np.nan
+    dvdt_max = np.fmax.reduceat(dvdt, starts)
+    idx_upstroke = np.minimum.reduceat(
+        np.where(dvdt == dvdt_max[beat_id], idx, n), starts
+    )
+    idx_upstroke = np.minimum(idx_upstroke, n - 2)
+    activation_time = (time[idx_upstroke] + time[idx_upstroke + 1]) / 2
+
+    # Peak and resting potential
+    v_peak = np.maximum.reduceat(voltage, starts)
+    v_rest = voltage[starts]
+    idx_peak = np.minimum.reduceat(np.where(voltage == v_peak[beat_id], idx, n), starts)
+
+    # Repolarisation times to 30, 50 and 90%
+    fractions = np.array([0.3, 0.5, 0.9])[:, None]
+    levels = v_peak - fractions * (v_peak - v_rest)
+    t_repol = _first_fall_times(time, voltage, levels, idx_peak, beat_id, starts, ends)
+    apds = t_repol - activation_time
+    excited = (v_peak > v_excited) & (v_peak - v_rest > min_amplitude)
+    apds[:, ~excited] = np.nan
+
+    # APD at v_threshold, from the first upward crossing in the beat to the
+    # next downward crossing
+    idx_cross = find_crossings(voltage, v_threshold)
+    t_cross = find_crossings(voltage, v_threshold, time=time)
+    beat_cross = beat_id[idx_cross]
+    rising = voltage[idx_cross + 1] > voltage[idx_cross]
+    ap_start = np.full(len(starts), np.nan)
+    beats_up, first_up = np.unique(beat_cross[rising], return_index=True)
+    ap_start[beats_up] = t_cross[rising][first_up]
+    falling = ~rising & (t_cross > ap_start[beat_cross])
+    ap_end = np.full(len(starts), np.nan)
+    beats_down, first_down = np.unique(beat_cross[falling], return_index=True)
+    ap_end[beats_down] = t_cross[falling][first_down]
+    ap_start[~excited] = np.nan
+    ap_end[~excited] = np.nan
+
+    df_valid = pd.DataFrame(
         {
-            "s2_interval": list_s2_intervals,
-            "di": list_di_vals,
-            "apd": list_apd_vals,
-            "cat_amplitude": list_cat_amplitude_vals,
+            "ap_start": ap_start,
+            "ap_end": ap_end,
+            "apd": ap_end - ap_start,
+            "activation_time": np.where(excited, activation_time, np.nan),
+            "apd30": apds[0],
+            "apd50": apds[1],
+            "apd90": apds[2],
+            "triangulation": apds[2] - apds[0],
+            "dvdt_max": dvdt_max,
+            "v_peak": v_peak,
+            "v_rest": v_rest,
         }
     )
-    if len(list_df) == 0:
-        df_ts = pd.DataFrame(
-            columns=["membrane.v", "time", "intracellular_ions.cai", "s2_interval"]
-        )
-    else:
-        df_ts = pd.concat(list_df)
 
-    # Reset simulation completely (including prepacing)
-    s.set_state(default_state)
-    s.set_time(0)
+    # Calcium transient, peaking at the largest local maximum in the beat
+    if cai is not None:
+        cai = np.asarray(cai, dtype=float)
+        peak_values, peak_times = find_local_maxima(cai, time, return_times=True)
+        peak_beat = np.searchsorted(time[starts], peak_times, side="right") - 1
+        order = np.lexsort((-peak_values, peak_beat))
+        order = order[peak_beat[order] >= 0]
+        beats_peak, first_peak = np.unique(peak_beat[order], return_index=True)
+        cat_amplitude = np.full(len(starts), np.nan)
+        t_cai_peak = np.full(len(starts), np.nan)
+        cat_amplitude[beats_peak] = peak_values[order][first_peak]
+        t_cai_peak[beats_peak] = peak_times[order][first_peak]
+
+        cai_diastolic = cai[starts]
+        cat_rise = cat_amplitude - cai_diastolic
+        idx_cai_peak = np.searchsorted(
+            time, np.where(np.isnan(t_cai_peak), 0, t_cai_peak)
+        )
+        idx_cai_peak = np.clip(idx_cai_peak, starts, ends - 1)
+        levels = (cai_diastolic + cat_rise / np.e)[None, :]
+        t_decay = _first_fall_times(
+            time, cai, levels, idx_cai_peak, beat_id, starts, ends
+        )
+        df_valid["cat_amplitude"] = cat_amplitude
+        df_valid["cai_diastolic"] = cai_diastolic
+        df_valid["cat_rise"] = cat_rise
+        df_valid["cat_ttp"] = t_cai_peak - stim_times[valid]
+        # No decay time constant without a transient
+        with np.errstate(invalid="ignore"):
+            df_valid["cat_tau"] = np.where(
+                cat_rise > 0, t_decay[0] - t_cai_peak, np.nan
+            )
 
-    return df_ts, df_restitution
+    df_beats.loc[valid, df_valid.columns] = df_valid.values
+    return df_beats
 
 
-def find_crossings(arr, value):
-    crossings = []
-    for i in range(len(arr) - 1):
-        if (arr[i] < value and arr[i + 1] >= value) or (
-            arr[i] > value and arr[i + 1] <= value
-        ):
-            crossings.append(i)
-    return crossings
+def _first_fall_times(time, values, levels, after, beat_id, starts, ends):
+    """
+    Time at which values first falls to each level after a given sample,
+    for every beat
 
+    Parameters
+    ----------
+    levels : np.array
+        levels of shape (number of levels, number of beats)
+    after : np.array
+        sample index in each beat after which to look for the fall
 
-def find_local_maxima(arr):
-    local_maxima = []
-    n = len(arr)
+    Returns
+    -------
+    np.array
+        crossing times, linearly interpolated, of the same shape as levels.
+        nan where values does not fall to the level before the end of the
+        beat.
 
-    # Check for edge cases where array length is less than 3
-    if n < 3:
-        return local_maxima
+    """
 
-    for i in range(1, n - 1):
-        if arr[i] > arr[i - 1] and arr[i] > arr[i + 1]:
-            local_maxima.append(arr[i])
+    n = len(values)
+    idx = np.arange(n)
+    is_below = (values <= levels[:, beat_id]) & (idx > after[beat_id])
+    first = np.minimum.reduceat(np.where(is_below, idx, n), starts, axis=1)
+    found = first < ends
 
-    return local_maxima
+    # first > after >= 0, so the sample before the crossing always exists
+    j = np.where(found, first, 1)
+    v0, v1 = values[j - 1], values[j]
+    t0, t1 = time[j - 1], time[j]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        frac = np.where(v1 != v0, (levels - v0) / (v1 - v0), 1)
+    return np.where(found, t0 + frac * (t1 - t0), np.nan)
 
 
-def make_s1s2_fig(df_ts, plot_var):
+def make_s1s2_fig(df_ts, plot_var, max_points=display_points):
     line_width = 1
 
-    fig = px.line(df_ts, x="time", y=plot_var, color="s2_interval")
+    # Only pass the (decimated) columns plotted
+    data = decimate_traces(
+        df_ts, "time", plot_var, "s2_interval", max_points=max_points
+    )
+    fig = px.line(data, x="time", y=plot_var, color="s2_interval")
 
     fig.update_xaxes(title="Time (ms)")
 
@@ -401,10 +3674,15 @@ def sim_rate_change(
     params={},
     bcl_values="250:500:50, 500:1000:100",
     nbeats=10,
+    adaptive=False,
+    rtol=1e-4,
+    log_interval=None,
+    executor=None,
+    float32=False,
+    control=None,
 ):
     """
     Simulate Torord model for a range of bcl values
-    Allow a max of 20 bcl values (to aviod overloading machine)
     Return data on APD and CaT amplitude as a function of bcl
     Reset model to initial state before prepacing.
 
@@ -419,21 +3697,47 @@ def sim_rate_change(
         String input by the user that provides bcl values
     nbeats : int
         number of pulses
+    adaptive : bool
+        If True, stop prepacing at each BCL once the state at each stimulus
+        changes by less than rtol between beats. nbeats is then an upper
+        bound.
+    rtol : float
+        Relative tolerance for adaptive prepacing
+    log_interval : float
+        Interval (ms) at which variables are logged. If None, every solver
+        step is logged.
+    executor : SimulationProcessPool
+        Pool made with make_process_pool, used to simulate the BCL values in
+        parallel. If None (or the pool is broken), BCL values are simulated
+        one after another. Output is the same either way.
+    float32 : bool
+        If True, store the time series (other than time) as float32
+    control : RunControl
+        Cancel token and deadline of the run. If the run is stopped, the BCL
+        values that finished are returned.
 
     Returns
     -------
+    df_ts : SimResult
+        time series
     df_rate: pd.DataFrame
-        apd and cat_amplitude as a function of bcl
+        Biomarkers of both recorded beats (see compute_biomarkers) as a
+        function of bcl. apd is measured at -80 mV, and cat_amplitude is the
+        peak calcium of the beat.
+        The number of prepacing beats simulated and the final beat-to-beat
+        residual for each bcl are stored as lists in
+        df_rate.attrs["prepace_beats"] and df_rate.attrs["prepace_residual"].
+        If the run was stopped early, df_rate.attrs["stopped"] is the reason
+        (see RunControl.stop_reason). df_rate.attrs["completed"] and
+        df_rate.attrs["requested"] are the number of BCL values that
+        finished and that were asked for.
 
     """
 
-    # Unpack S2 values
+    # Unpack BCL values. The number of values is limited by the app's
+    # RunScheduler (see rate_change_cost).
     list_bcl_values = s2_input_to_list(bcl_values)
 
-    # If too many - only work with last 20 vals
-    if len(list_bcl_values) > 20:
-        list_bcl_values = list_bcl_values[-20:]
-
     # Only take values greater than 0
     list_bcl_values = [s2 for s2 in list_bcl_values if s2 > 0]
 
@@ -444,93 +3748,173 @@ def sim_rate_change(
     for key in params.keys():
         s.set_constant(key, params[key])
 
-    list_df = []
-    list_apd_vals = []
-    list_cat_amplitude_vals = []
-
-    for bcl in list_bcl_values:
+    # Run BCL values, in parallel if an executor is given
+    results = None
+    with timing_span("bcl_values", requested=len(list_bcl_values)) as span:
+        if executor is not None:
+            results = run_in_processes(
+                executor,
+                _run_bcl_worker,
+                [
+                    (
+                        params,
+                        default_state,
+                        bcl,
+                        nbeats,
+                        adaptive,
+                        rtol,
+                        log_interval,
+                    )
+                    for bcl in list_bcl_values
+                ],
+                control=control,
+            )
+        span["parallel"] = results is not None
+
+        if results is None:
+            results = [None] * len(list_bcl_values)
+            for i, bcl in enumerate(list_bcl_values):
+                try:
+                    results[i] = _run_bcl(
+                        s, bcl, nbeats, adaptive, rtol, log_interval, progress=control
+                    )
+                except myokit.SimulationCancelledError:
+                    break
+                finally:
+                    # Reset simulation to state that was before pre-pacing
+                    s.set_default_state(default_state)
+                    s.set_state(default_state)
+                    s.set_time(0)
+
+        # Prepacing beats and recorded 3 * bcl of each finished BCL value
+        simulated_ms = sum(
+            (result[2] + 3) * bcl
+            for bcl, result in zip(list_bcl_values, results)
+            if result is not None
+        )
+        completed = sum(result is not None for result in results)
+        span.update(completed=completed, simulated_ms=simulated_ms)
+
+    # Keep the BCL values that finished (all of them unless stopped early)
+    num_bcl_values = len(list_bcl_values)
+    list_bcl_values = [
+        bcl for bcl, result in zip(list_bcl_values, results) if result is not None
+    ]
+    results = [result for result in results if result is not None]
+    stopped = None
+    if len(results) < num_bcl_values:
+        stopped = control.stop_reason
+        print(
+            "Run {} after {} of {} BCL values".format(
+                stopped, len(results), num_bcl_values
+            )
+        )
 
-        # Pre-pacing
-        p = myokit.pacing.blocktrain(bcl, duration=0.5, offset=0)
-        s.set_protocol(p)
-        s.pre(nbeats * bcl)
+    list_df = [result[0] for result in results]
+    list_df_beats = [result[1] for result in results]
+    list_prepace_beats = [result[2] for result in results]
+    list_prepace_residuals = [result[3] for result in results]
+
+    with timing_span("result") as span:
+        # APD and CaT amplitude of both recorded beats at each BCL
+        df_rate = pd.DataFrame(columns=["bcl", "apd", "cat_amplitude"])
+        if len(list_df_beats) > 0:
+            df_beats = pd.concat(list_df_beats, ignore_index=True)
+            df_rate = pd.concat(
+                [
+                    pd.DataFrame(
+                        {"bcl": [bcl for bcl in list_bcl_values for _ in range(2)]}
+                    ),
+                    df_beats,
+                ],
+                axis=1,
+            )
+        df_rate.attrs["prepace_beats"] = list_prepace_beats
+        df_rate.attrs["prepace_residual"] = list_prepace_residuals
+        df_rate.attrs["stopped"] = stopped
+        df_rate.attrs["completed"] = len(results)
+        df_rate.attrs["requested"] = num_bcl_values
+
+        if len(list_df) == 0:
+            columns = ["membrane.v", "time", "intracellular_ions.cai", "bcl"]
+            df_ts = SimResult({key: np.array([]) for key in columns})
+        else:
+            df_ts = SimResult.concat(list_df, float32=float32)
+        span["bytes"] = df_ts.nbytes
 
-        # Set pacing protocol
-        p = myokit.Protocol()
-        # Schedule 2 stimuli
-        p.schedule(level=1.0, start=0, duration=0.5)
-        p.schedule(level=1.0, start=bcl, duration=0.5)
+    return df_ts, df_rate
 
-        # Update protoocl
-        s.set_protocol(p)
 
-        # Pacing simulation
-        d = s.run(3 * bcl)
+def _run_bcl(
+    s, bcl, nbeats, adaptive=False, rtol=1e-4, log_interval=None, progress=None
+):
+    """
+    Prepace at bcl from the current state, then record two beats
 
-        # Collect data
-        data_dict = {}
-        data_dict["membrane.v"] = d["membrane.v"]
-        data_dict["time"] = d["environment.time"]
-        data_dict["intracellular_ions.cai"] = d["intracellular_ions.cai"]
-        df = pd.DataFrame(data_dict)
-        df["bcl"] = bcl
-        list_df.append(df)
-
-        # Compute APD
-        voltage_vals = d["membrane.v"]
-        time_vals = d["environment.time"]
-        thresh = -80  # mV
-        crossings_zero_voltage = find_crossings(voltage_vals, 0)
-        crossings_thresh = find_crossings(voltage_vals, thresh)
-
-        # Must be 4 crossings at zero voltage to determine APD
-        if (len(crossings_zero_voltage) == 4) & (len(crossings_thresh) == 4):
-            # Get DI and APD info
-            ap1_start = crossings_thresh[0]
-            ap1_end = crossings_thresh[1]
-            ap2_start = crossings_thresh[2]
-            ap2_end = crossings_thresh[3]
-            apd1 = time_vals[ap1_end] - time_vals[ap1_start]
-            apd2 = time_vals[ap2_end] - time_vals[ap2_start]
+    Returns
+    -------
+    df : SimResult
+        time series
+    df_beats : pd.DataFrame
+        biomarkers of the two recorded beats (see compute_biomarkers)
+    beats, residual
+        number of prepacing beats and final residual
 
-        else:
-            apd1 = np.nan
-            apd2 = np.nan
+    """
 
-        list_apd_vals.append(apd1)
-        list_apd_vals.append(apd2)
+    # Pre-pacing
+    p = myokit.pacing.blocktrain(bcl, duration=0.5, offset=0)
+    s.set_protocol(p)
+    if adaptive:
+        beats, residual = prepace_to_steady_state(
+            s, bcl, nbeats, rtol, progress=progress
+        )
+    else:
+        beats, residual = prepace(s, bcl, nbeats, progress=progress)
 
-        # Compute calcium transient amplitude
-        local_maxima = find_local_maxima(d["intracellular_ions.cai"])
-        # Require at least two peaks
-        if len(local_maxima) >= 2:
-            cat1, cat2 = local_maxima[:2]
-        else:
-            cat1, cat2 = np.nan, np.nan
+    # Set pacing protocol
+    p = myokit.Protocol()
+    # Schedule 2 stimuli
+    p.schedule(level=1.0, start=0, duration=0.5)
+    p.schedule(level=1.0, start=bcl, duration=0.5)
 
-        list_cat_amplitude_vals.append(cat1)
-        list_cat_amplitude_vals.append(cat2)
+    # Update protoocl
+    s.set_protocol(p)
 
-        # Reset simulation to state that was before pre-pacing
-        s.set_state(default_state)
-        s.set_time(0)
+    # Pacing simulation
+    d = s.run(
+        3 * bcl, log=log_vars_protocol, log_interval=log_interval, progress=progress
+    )
 
-    df_rate = pd.DataFrame(
-        {
-            "bcl": [bcl for bcl in list_bcl_values for _ in range(2)],
-            "apd": list_apd_vals,
-            "cat_amplitude": list_cat_amplitude_vals,
-        }
+    # Collect data
+    data_dict = {}
+    data_dict["membrane.v"] = d["membrane.v"]
+    data_dict["time"] = d["environment.time"]
+    data_dict["intracellular_ions.cai"] = d["intracellular_ions.cai"]
+    df = SimResult(data_dict)
+    df["bcl"] = bcl
+
+    # Biomarkers of the two recorded beats
+    df_beats = compute_biomarkers(
+        d["environment.time"],
+        d["membrane.v"],
+        d["intracellular_ions.cai"],
+        stim_times=[0, bcl],
     )
 
-    if len(list_df) == 0:
-        df_ts = pd.DataFrame(
-            columns=["membrane.v", "time", "intracellular_ions.cai", "bcl"]
-        )
-    else:
-        df_ts = pd.concat(list_df)
+    return df, df_beats, beats, residual
 
-    return df_ts, df_rate
+
+def _run_bcl_worker(
+    params, state, bcl, nbeats, adaptive, rtol, log_interval, task=None
+):
+    """Run _run_bcl in a worker process, starting from state"""
+    progress = _worker_control(task)
+    with _worker_pool.simulation() as s:
+        for key in params.keys():
+            s.set_constant(key, params[key])
+        s.set_state(state)
+        return _run_bcl(s, bcl, nbeats, adaptive, rtol, log_interval, progress)
 
 
 def make_rate_fig(df_rate, plot_var):
@@ -569,10 +3953,12 @@ def make_rate_fig(df_rate, plot_var):
     return fig
 
 
-def make_bcl_ts_fig(df_ts, plot_var):
+def make_bcl_ts_fig(df_ts, plot_var, max_points=display_points):
     line_width = 1
 
-    fig = px.line(df_ts, x="time", y=plot_var, color="bcl")
+    # Only pass the (decimated) columns plotted
+    data = decimate_traces(df_ts, "time", plot_var, "bcl", max_points=max_points)
+    fig = px.line(data, x="time", y=plot_var, color="bcl")
 
     fig.update_xaxes(title="Time (ms)")
 
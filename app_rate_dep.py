@@ -10,29 +10,27 @@ Dash app to run simulation of Torod model in myokit
 """
 
 import os
+import uuid
+from functools import lru_cache
 import numpy as np
 import pandas as pd
 
-from dash import Dash, html, dcc, Input, Output, State, callback, ctx
+from dash import Dash, html, dcc, Input, Output, State, ctx
+from dash import ClientsideFunction, no_update
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
 import plotly.express as px
 import myokit as myokit
 
 import app_functions as funs
+import app_shared
 
+# Model, simulations and caches are shared with the other protocol apps
+from app_shared import fileroot, m, sim_pool, result_store
+from app_shared import run_registry, scheduler
 
-# Determine if running app locally or on cloud
-fileroot_local = "/Users/tbury/Google Drive/research/postdoc_23/ap-simulator"
-fileroot_cloud = "/home/ubuntu/ap-simulator/"
 
-if os.getcwd() == fileroot_local:
-    run_cloud = False
-    fileroot = fileroot_local
-    requests_pathname_prefix = "/"
-else:
-    run_cloud = True
-    fileroot = fileroot_cloud
-    requests_pathname_prefix = "/ap-simulator/rate-dep/"
+requests_pathname_prefix = app_shared.requests_pathname_prefix("rate-dep")
 
 # Top navigation bar
 navbar = dbc.NavbarSimple(
@@ -41,15 +39,17 @@ navbar = dbc.NavbarSimple(
             [
                 dbc.DropdownMenuItem(
                     "Regular stimulation",
-                    href="/ap-simulator/reg-stim/",
+                    href=app_shared.page_href("reg-stim"),
                     external_link=True,
                 ),
                 dbc.DropdownMenuItem(
-                    "S1-S2 restitution", href="/ap-simulator/s1-s2/", external_link=True
+                    "S1-S2 restitution",
+                    href=app_shared.page_href("s1-s2"),
+                    external_link=True,
                 ),
                 dbc.DropdownMenuItem(
                     "Rate dependence and alternans",
-                    href="/ap-simulator/rate-dep/",
+                    href=app_shared.page_href("rate-dep"),
                     external_link=True,
                 ),
             ],
@@ -84,6 +84,7 @@ app = Dash(
     suppress_callback_exceptions=True,
 )
 server = app.server
+server.add_url_rule("/metrics", view_func=app_shared.metrics_view)
 
 
 list_params_cond = [
@@ -109,19 +110,10 @@ list_params_extracell = [
 
 list_params_other = ["environment.celltype"]
 
-# Load in model from mmt file
-filepath_mmt = fileroot + "/mmt_files/torord-2019.mmt"
-m = myokit.load_model(filepath_mmt)
-
-# Get names of all variables in model
-var_names = [var.qname() for var in list(m.variables(const=False))]
 # State variables to plot by default
 plot_vars = ["membrane.v", "intracellular_ions.cai"]
 plot_var_def = "membrane.v"
 
-# Create simulation object with model
-s = myokit.Simulation(m)
-
 # Preset parameter configurations - default values
 params_default = {
     par: m.get(par).value()
@@ -131,28 +123,54 @@ params_default = {
 # Default protocol values
 bcl_values_def = "250:500:50, 500:1000:100"
 nbeats_def = 10
+adaptive_def = False
+
 
 # Run default rate change simulation
-df_ts, df_rate = funs.sim_rate_change(
-    s,
-    params={},
-    bcl_values=bcl_values_def,
-    nbeats=nbeats_def,
+def run_default_simulation():
+    # Run serially, so that the process pool isn't made at import
+    with sim_pool.simulation() as s:
+        df_ts, df_rate = funs.sim_rate_change(
+            s,
+            params={},
+            bcl_values=bcl_values_def,
+            nbeats=nbeats_def,
+            adaptive=adaptive_def,
+        )
+    return df_ts, df_rate
+
+
+# Load default results made by build_defaults.py (computed if missing or stale)
+df_ts, df_rate = funs.load_default_results(
+    os.path.join(fileroot, "cache", "default_results_rate_dep.pkl"),
+    m,
+    dict(
+        bcl_values=bcl_values_def,
+        nbeats=nbeats_def,
+        adaptive=adaptive_def,
+    ),
+    run_default_simulation,
 )
 
-# Need to convert df to dict to store as json on app
-ts_data = {"data-frame": df_ts.to_dict("records")}
-rate_data = {"data-frame": df_rate.to_dict("records")}
+# Store time series on the server and only keep its ID on the app. The
+# rate table is small, so keep it on the app as json.
+ts_data = {"result_id": result_store.put(df_ts)}
+rate_data = {"data-frame": df_rate.to_dict("list")}
 
 # Make dict contianing all parameter values to save
 parameter_data = params_default.copy()
 parameter_data["bcl_values"] = bcl_values_def
 parameter_data["nbeats"] = nbeats_def
-
-# Make default figs
-fig_ts = funs.make_bcl_ts_fig(df_ts, plot_var_def)
-fig_rate_change = funs.make_rate_fig(df_rate, plot_var_def)
-div_fig = html.Div([dcc.Graph(figure=fig_ts), dcc.Graph(figure=fig_rate_change)])
+parameter_data["prepace_beats"] = df_rate.attrs["prepace_beats"]
+
+# Make default figs for each tab. Figures are drawn on the client, and the
+# traces of all tabs are decimated together so they share their x data.
+df_fig = funs.decimate_columns(df_ts, "time", plot_vars, "bcl")
+figure_data = [
+    funs.make_tab_figures(lambda var: funs.make_bcl_ts_fig(df_fig, var), plot_vars),
+    funs.make_tab_figures(lambda var: funs.make_rate_fig(df_rate, var), plot_vars),
+]
+div_fig = html.Div([dcc.Graph(id="fig_ts"), dcc.Graph(id="fig_rate")])
 
 # Setup figure tabs
 list_tabs = [dcc.Tab(value=var, label=var) for var in plot_vars]
@@ -281,6 +299,18 @@ body_layout = dbc.Container(
                             ],
                             style=dict(display="inline-block", width="100%"),
                         ),
+                        # Checkbox to stop prepacing once at steady state
+                        dcc.Checklist(
+                            id="adaptive",
+                            options=[
+                                {
+                                    "label": " Stop prepacing at steady state",
+                                    "value": "adaptive",
+                                }
+                            ],
+                            value=["adaptive"] if adaptive_def else [],
+                            style=dict(fontSize=14),
+                        ),
                         dcc.Markdown(
                             """
                             -----
@@ -405,6 +435,13 @@ body_layout = dbc.Container(
                             **Plot variables**:
                             """
                         ),
+                        # Message when a run is stopped early
+                        dbc.Alert(
+                            id="run_message",
+                            color="warning",
+                            is_open=False,
+                            dismissable=True,
+                        ),
                         # Tabs
                         html.Div(tabs, id="tabs_container_div"),
                         # Figure
@@ -478,6 +515,9 @@ body_layout = dbc.Container(
                                             dcc.Store(
                                                 id="parameter_data", data=parameter_data
                                             ),
+                                            dcc.Store(
+                                                id="figure_data", data=figure_data
+                                            ),
                                         ],
                                         className="d-grid gap-2",
                                     ),
@@ -494,7 +534,15 @@ body_layout = dbc.Container(
 )
 
 
-app.layout = html.Div([navbar, body_layout])
+def serve_layout():
+    # Each page load gets its own session ID, so that a new run only cancels
+    # runs from the same page
+    return html.Div(
+        [navbar, body_layout, dcc.Store(id="session_id", data=uuid.uuid4().hex)]
+    )
+
+
+app.layout = serve_layout
 
 
 # # -----------------
@@ -628,6 +676,8 @@ def udpate_sliders_and_boxes(preset):
         Output("download_ts", "data"),
         Output("download_rate", "data"),
         Output("download_parameters", "data"),
+        Output("run_message", "children", allow_duplicate=True),
+        Output("run_message", "is_open", allow_duplicate=True),
     ],
     Input("button_savedata", "n_clicks"),
     State("ts_data", "data"),
@@ -636,17 +686,20 @@ def udpate_sliders_and_boxes(preset):
     prevent_initial_call=True,
 )
 def func(n_clicks, ts_data, rate_data, parameter_data):
-    df_ts = pd.DataFrame(ts_data["data-frame"])
+    df_ts = result_store.get(ts_data["result_id"])
+    if df_ts is None:
+        print("Time series {} is no longer stored".format(ts_data["result_id"]))
+        return [no_update] * 3 + [funs.RESULT_EXPIRED_MESSAGE, True]
     df_rate = pd.DataFrame(rate_data["data-frame"])
     df_pars = pd.DataFrame()
     df_pars["name"] = parameter_data.keys()
     df_pars["value"] = parameter_data.values()
     # df_pars = df_pars.astype("object")
-    out_ts = dcc.send_data_frame(df_ts.to_csv, "ts.csv")
+    out_ts = dcc.send_data_frame(df_ts.to_pandas().to_csv, "ts.csv")
     out_rate = dcc.send_data_frame(df_rate.to_csv, "rate.csv")
     out_pars = dcc.send_data_frame(df_pars.to_csv, "parameters.csv")
 
-    return [out_ts, out_rate, out_pars]
+    return [out_ts, out_rate, out_pars, no_update, no_update]
 
 
 # -----------
@@ -655,11 +708,13 @@ def func(n_clicks, ts_data, rate_data, parameter_data):
 
 # Output includes (i) all figures, (ii) loading sign (iii) simulation and parameter data for download
 outputs_callback_run = (
-    Output("tabs_container_output_div", "children"),
+    Output("figure_data", "data"),
     Output("loading-output", "children"),
     Output("ts_data", "data"),
     Output("rate_data", "data"),
     Output("parameter_data", "data"),
+    Output("run_message", "children"),
+    Output("run_message", "is_open"),
 )
 # Input is click of run button
 inputs_callback_run = dict(n_clicks=[Input("run_button", "n_clicks")])
@@ -668,8 +723,8 @@ inputs_callback_run = dict(n_clicks=[Input("run_button", "n_clicks")])
 states_callback_run = dict(
     bcl_values=State("bcl_values", "value"),
     nbeats=State("nbeats", "value"),
+    adaptive=State("adaptive", "value"),
     cell_type=State("cell_type", "value"),
-    current_plot_var=State("tabs", "value"),
     params_cond={
         par: State("{}_box".format(par.replace(".", "_")), "value")
         for par in list_params_cond
@@ -678,6 +733,7 @@ states_callback_run = dict(
         par: State("{}_box".format(par.replace(".", "_")), "value")
         for par in list_params_extracell
     },
+    session_id=State("session_id", "data"),
 )
 
 
@@ -687,14 +743,17 @@ states_callback_run = dict(
     state=states_callback_run,
     prevent_initial_call=True,
 )
+@funs.timed_request("run_rate_dep")
+@funs.profiled("run_rate_dep")
 def run_sim_and_update_fig(
     n_clicks,
     bcl_values,
     nbeats,
+    adaptive,
     cell_type,
-    current_plot_var,
     params_cond,
     params_extracell,
+    session_id,
 ):
     # Updated parameter values
     params = {}
@@ -716,46 +775,118 @@ def run_sim_and_update_fig(
     parameter_data["bcl_values"] = bcl_values
     parameter_data["nbeats"] = nbeats
 
-    # Run simulation
-    df_ts, df_rate = funs.sim_rate_change(
-        s,
-        params=params,
-        bcl_values=bcl_values,
-        nbeats=nbeats,
-    )
+    # Run simulation. A new run from the same page cancels this one, runs wait
+    # for their turn in the scheduler, and stop at the time limit of
+    # run_registry.
+    control = run_registry.start(session_id)
+    cost = funs.rate_change_cost(bcl_values, nbeats)
+    try:
+        with scheduler.admit(session_id, cost, control):
+            with sim_pool.simulation(timeout=control.remaining()) as s:
+                df_ts, df_rate = funs.sim_rate_change(
+                    s,
+                    params=params,
+                    bcl_values=bcl_values,
+                    nbeats=nbeats,
+                    adaptive="adaptive" in adaptive,
+                    executor=app_shared.get_process_pool(),
+                    control=control,
+                )
+    except funs.RunRejected as e:
+        message = str(e)
+        return [no_update, "", no_update, no_update, no_update, message, True]
+    except TimeoutError:
+        message = "All simulations are busy. Please try again shortly."
+        return [no_update, "", no_update, no_update, no_update, message, True]
+    except myokit.SimulationCancelledError:
+        if control.stop_reason == "cancelled":
+            # Replaced by a newer run from the same page
+            raise PreventUpdate
+        message = funs.stopped_message(control.stop_reason, run_registry.timeout)
+        return [no_update, "", no_update, no_update, no_update, message, True]
+    finally:
+        run_registry.finish(session_id, control)
+
+    # Show the BCL values that finished if the run was stopped early
+    stopped = df_rate.attrs["stopped"]
+    if stopped == "cancelled":
+        raise PreventUpdate
+    message = None
+    if stopped is not None:
+        message = funs.stopped_message(
+            stopped,
+            run_registry.timeout,
+            df_rate.attrs["completed"],
+            df_rate.attrs["requested"],
+            "BCL values",
+        )
+        if df_rate.attrs["completed"] == 0:
+            return [no_update, "", no_update, no_update, no_update, message, True]
+
+    parameter_data["prepace_beats"] = df_rate.attrs["prepace_beats"]
 
-    # Need to convert df to dict to store as json on app
-    ts_data = {"data-frame": df_ts.to_dict("records")}
-    rate_data = {"data-frame": df_rate.to_dict("records")}
+    # Store time series on the server and only keep its ID on the app
+    ts_data = {"result_id": result_store.put(df_ts)}
+    rate_data = {"data-frame": df_rate.to_dict("list")}
 
-    # Make figs
-    fig_ts = funs.make_bcl_ts_fig(df_ts, current_plot_var)
-    fig_rate_change = funs.make_rate_fig(df_rate, current_plot_var)
-    div_fig = html.Div([dcc.Graph(figure=fig_ts), dcc.Graph(figure=fig_rate_change)])
+    # Make figs for each tab, decimated together so they share their x data
+    df_fig = funs.decimate_columns(df_ts, "time", plot_vars, "bcl")
+    figure_data = [
+        funs.make_tab_figures(lambda var: funs.make_bcl_ts_fig(df_fig, var), plot_vars),
+        funs.make_tab_figures(lambda var: funs.make_rate_fig(df_rate, var), plot_vars),
+    ]
 
-    return [div_fig, "", ts_data, rate_data, parameter_data]
+    outputs = [
+        figure_data,
+        "",
+        ts_data,
+        rate_data,
+        parameter_data,
+        message,
+        message is not None,
+    ]
+    funs.log_payload_size("run", outputs)
+    return outputs
 
 
 # ---------
-# Callback to switch between tabs
+# Callback to switch between tabs - runs on the client (assets/clientside.js)
 # ---------
-@callback(
-    Output("tabs_container_output_div", "children", allow_duplicate=True),
+app.clientside_callback(
+    ClientsideFunction(namespace="tabs", function_name="render_figures"),
+    [Output("fig_ts", "figure"), Output("fig_rate", "figure")],
     Input("tabs", "value"),
-    State("ts_data", "data"),
-    State("rate_data", "data"),
-    prevent_initial_call=True,
+    Input("figure_data", "data"),
 )
-def render_content(tab, ts_data, rate_data):
-    df_ts = pd.DataFrame(ts_data["data-frame"])
-    df_rate = pd.DataFrame(rate_data["data-frame"])
-    # Make figs
-    fig_ts = funs.make_bcl_ts_fig(df_ts, tab)
-    fig_rate_change = funs.make_rate_fig(df_rate, tab)
 
-    div_fig = html.Div([dcc.Graph(figure=fig_ts), dcc.Graph(figure=fig_rate_change)])
 
-    return div_fig
+# ---------
+# Callback to redraw the zoomed window of the time series at higher resolution
+# ---------
+@lru_cache(maxsize=8)
+def get_trace_pyramids(result_id, plot_var):
+    """Pyramids of the traces of plot_var in a stored result (None if gone)"""
+    df_ts = result_store.get(result_id)
+    if df_ts is None or plot_var not in df_ts.columns:
+        return None
+    return funs.make_trace_pyramids(df_ts, "time", plot_var, "bcl")
+
+
+@app.callback(
+    Output("fig_ts", "figure", allow_duplicate=True),
+    Input("fig_ts", "relayoutData"),
+    State("tabs", "value"),
+    State("ts_data", "data"),
+    prevent_initial_call=True,
+)
+def zoom_figure(relayout_data, tab, ts_data):
+    x_range = funs.relayout_x_range(relayout_data)
+    if x_range is None:
+        raise PreventUpdate
+    pyramids = get_trace_pyramids(ts_data["result_id"], tab)
+    if pyramids is None:
+        raise PreventUpdate
+    return funs.patch_trace_window(pyramids, x_range)
 
 
 if __name__ == "__main__":
@@ -11,36 +11,38 @@ Updates:
 """
 
 import os
+import uuid
+import tempfile
+from contextlib import closing
+from functools import lru_cache
+from urllib.parse import urlencode
 import numpy as np
 import pandas as pd
 
 from dash import Dash, html, dcc, Input, Output, State, callback, ctx
+from dash import ClientsideFunction, no_update
+from dash.exceptions import PreventUpdate
+from flask import Response, abort, request
+from werkzeug.wsgi import wrap_file
 import dash_bootstrap_components as dbc
 import plotly.express as px
 import myokit as myokit
 
 import app_functions as funs
+import app_shared
+
+# Model, simulations and caches are shared with the other protocol apps
+from app_shared import fileroot, m, var_names, sim_pool, result_store
+from app_shared import run_registry, scheduler
 
 
 # Potential new features
-# - button to save ALL variables (would require resimulation with immediate downlaod, don't want to store this data in browser as big file)
 # - make run button bigger
 
 # Inspired by this example
 # https://dash.gallery/dash-cytoscape-lda/?_gl=1*1n1w6iy*_ga*MTkwMzI4NzAyLjE2NjY4MDg0MDg.*_ga_6G7EE0JNSC*MTcwMDI2MTU3MS4xMDguMS4xNzAwMjYyNTY0LjYwLjAuMA..#
 
-# Determine if running app locally or on cloud
-fileroot_local = "/Users/tbury/Google Drive/research/postdoc_23/ap-simulator"
-fileroot_cloud = "/home/ubuntu/ap-simulator/"
-
-if os.getcwd() == fileroot_local:
-    run_cloud = False
-    fileroot = fileroot_local
-    requests_pathname_prefix = "/"
-else:
-    run_cloud = True
-    fileroot = fileroot_cloud
-    requests_pathname_prefix = "/ap-simulator/reg-stim/"
+requests_pathname_prefix = app_shared.requests_pathname_prefix("reg-stim")
 
 # Top navigation bar
 navbar = dbc.NavbarSimple(
@@ -49,15 +51,17 @@ navbar = dbc.NavbarSimple(
             [
                 dbc.DropdownMenuItem(
                     "Regular stimulation",
-                    href="/ap-simulator/reg-stim/",
+                    href=app_shared.page_href("reg-stim"),
                     external_link=True,
                 ),
                 dbc.DropdownMenuItem(
-                    "S1-S2 restitution", href="/ap-simulator/s1-s2/", external_link=True
+                    "S1-S2 restitution",
+                    href=app_shared.page_href("s1-s2"),
+                    external_link=True,
                 ),
                 dbc.DropdownMenuItem(
                     "Rate dependence and alternans",
-                    href="/ap-simulator/rate-dep/",
+                    href=app_shared.page_href("rate-dep"),
                     external_link=True,
                 ),
             ],
@@ -92,6 +96,7 @@ app = Dash(
     suppress_callback_exceptions=True,
 )
 server = app.server
+server.add_url_rule("/metrics", view_func=app_shared.metrics_view)
 
 
 # # Dictionary to map paramter label to parameter stored in mmt file
@@ -140,12 +145,6 @@ list_params_extracell = [
 
 list_params_other = ["environment.celltype"]
 
-# Load in model from mmt file
-filepath_mmt = fileroot + "/mmt_files/torord-2019.mmt"
-m = myokit.load_model(filepath_mmt)
-
-# Get names of all variables in model
-var_names = [var.qname() for var in list(m.variables(const=False))]
 # State variables to plot by default
 plot_vars_def = [
     "membrane.v",
@@ -156,8 +155,8 @@ plot_vars_def = [
     "IKs.IKs",
 ]
 
-# Create simulation object with model
-s = myokit.Simulation(m)
+# Cache of prepaced states, so repeated configurations skip prepacing
+steady_state_cache = app_shared.steady_state_cache
 
 # Preset parameter configurations - default values
 params_default = {
@@ -165,34 +164,85 @@ params_default = {
     for par in list_params_cond + list_params_extracell + list_params_other
 }
 
+# Converged prepaced states, used to warm start nearby parameter configurations
+warm_start_store = funs.WarmStartStore(params_default)
+app_shared.metrics.add_stats(
+    "warm_start",
+    warm_start_store.stats,
+    counters=["queries", "warm_starts", "beats_saved"],
+)
+
 # Default protocol values
 bcl_def = 1000
 total_beats_def = 100
 beats_keep_def = 1
+adaptive_def = False
+
+# Ranges of the protocol and parameter inputs (also enforced by /export)
+bcl_range = [1, 10000]
+beats_range = [1, 200]
+multiplier_range = [0, 3]
+extracell_range = [0, 1000]
+celltype_values = [0, 1, 2]
+
 
 # Run default simulation
-df_sim = funs.sim_model(
-    s,
-    plot_vars_def,
-    params={},
-    bcl=bcl_def,
-    total_beats=total_beats_def,
-    beats_keep=beats_keep_def,
+def run_default_simulation():
+    with sim_pool.simulation() as s:
+        df_sim, df_beats = funs.sim_model(
+            s,
+            plot_vars_def,
+            params={},
+            bcl=bcl_def,
+            total_beats=total_beats_def,
+            beats_keep=beats_keep_def,
+            cache=steady_state_cache,
+            warm_start=warm_start_store,
+            adaptive=adaptive_def,
+            biomarkers=True,
+        )
+    return df_sim, df_beats
+
+
+# Load default results made by build_defaults.py (computed if missing or stale)
+df_sim, df_beats = funs.load_default_results(
+    os.path.join(fileroot, "cache", "default_results_reg_stim.pkl"),
+    m,
+    dict(
+        plot_vars=plot_vars_def,
+        bcl=bcl_def,
+        total_beats=total_beats_def,
+        beats_keep=beats_keep_def,
+        adaptive=adaptive_def,
+        biomarkers=True,
+    ),
+    run_default_simulation,
 )
 
-# Need to convert df to dict to store as json on app
-simulation_data = {"data-frame": df_sim.to_dict("records")}
+# Store simulation on the server and only keep its ID on the app
+simulation_data = {
+    "result_id": result_store.put(df_sim),
+    "biomarkers": df_beats.to_dict("list"),
+}
 
 # Make dict contianing all parameter values to save
 parameter_data = params_default.copy()
 parameter_data["bcl"] = bcl_def
 parameter_data["total_beats"] = total_beats_def
 parameter_data["beats_keep"] = beats_keep_def
+parameter_data["adaptive"] = adaptive_def
+parameter_data["prepace_beats"] = df_sim.attrs["prepace_beats"]
 
 
-# Make default figure
-fig = funs.make_simulation_fig(df_sim, "membrane.v")
-div_fig = html.Div(dcc.Graph(figure=fig))
+# Make default figure for each tab. Figures are drawn on the client, and the
+# traces of all tabs are decimated together so they share their x data.
+df_fig = funs.decimate_columns(df_sim, "time", plot_vars_def)
+figure_data = [
+    funs.make_tab_figures(
+        lambda var: funs.make_simulation_fig(df_fig, var), plot_vars_def
+    )
+]
+div_fig = html.Div(dcc.Graph(id="fig_sim"))
 
 # Setup figure tabs
 list_tabs = [dcc.Tab(value=var, label=var) for var in plot_vars_def]
@@ -266,7 +316,10 @@ def make_slider(label="ICaL", id_prefix="ical", default_value=1, slider_range=[0
 list_sliders = []
 for par in list_params_cond:
     slider = make_slider(
-        label=par, id_prefix=par.replace(".", "_"), default_value=1, slider_range=[0, 3]
+        label=par,
+        id_prefix=par.replace(".", "_"),
+        default_value=1,
+        slider_range=multiplier_range,
     )
     list_sliders.append(slider)
 
@@ -295,8 +348,8 @@ body_layout = dbc.Container(
                                     type="number",
                                     style=dict(width=80, display="inline-block"),
                                     placeholder=bcl_def,
-                                    min=1,
-                                    max=10000,
+                                    min=bcl_range[0],
+                                    max=bcl_range[1],
                                 ),
                                 html.Label(", BPM = ", style=dict(fontSize=14)),
                                 dcc.Input(
@@ -322,8 +375,8 @@ body_layout = dbc.Container(
                                     type="number",
                                     style=dict(width=80, display="inline-block"),
                                     placeholder=total_beats_def,
-                                    min=1,
-                                    max=200,
+                                    min=beats_range[0],
+                                    max=beats_range[1],
                                     step=1,
                                 ),
                             ],
@@ -339,13 +392,25 @@ body_layout = dbc.Container(
                                     type="number",
                                     style=dict(width=80),
                                     placeholder=beats_keep_def,
-                                    min=1,
-                                    max=200,
+                                    min=beats_range[0],
+                                    max=beats_range[1],
                                     step=1,
                                 ),
                                 html.Label(" beats ", style=dict(fontSize=14)),
                             ]
                         ),
+                        # Checkbox to stop prepacing once at steady state
+                        dcc.Checklist(
+                            id="adaptive",
+                            options=[
+                                {
+                                    "label": " Stop prepacing at steady state",
+                                    "value": "adaptive",
+                                }
+                            ],
+                            value=["adaptive"] if adaptive_def else [],
+                            style=dict(fontSize=14),
+                        ),
                         dcc.Markdown(
                             """
                             -----
@@ -404,8 +469,8 @@ body_layout = dbc.Container(
                                     type="number",
                                     style=dict(width=80, display="inline-block"),
                                     placeholder=params_default["extracellular.cao"],
-                                    min=0,
-                                    max=1000,
+                                    min=extracell_range[0],
+                                    max=extracell_range[1],
                                     step=0.1,
                                 ),
                             ],
@@ -421,8 +486,8 @@ body_layout = dbc.Container(
                                     type="number",
                                     style=dict(width=80, display="inline-block"),
                                     placeholder=params_default["extracellular.clo"],
-                                    min=0,
-                                    max=1000,
+                                    min=extracell_range[0],
+                                    max=extracell_range[1],
                                     step=0.1,
                                 ),
                             ],
@@ -438,8 +503,8 @@ body_layout = dbc.Container(
                                     type="number",
                                     style=dict(width=80, display="inline-block"),
                                     placeholder=params_default["extracellular.ko"],
-                                    min=0,
-                                    max=1000,
+                                    min=extracell_range[0],
+                                    max=extracell_range[1],
                                     step=0.1,
                                 ),
                             ],
@@ -453,8 +518,8 @@ body_layout = dbc.Container(
                                     type="number",
                                     style=dict(width=80, display="inline-block"),
                                     placeholder=params_default["extracellular.nao"],
-                                    min=0,
-                                    max=1000,
+                                    min=extracell_range[0],
+                                    max=extracell_range[1],
                                     step=0.1,
                                 ),
                             ],
@@ -479,6 +544,13 @@ body_layout = dbc.Container(
                             optionHeight=20,
                             style=dict(fontSize=12),
                         ),
+                        # Message when a run is stopped early
+                        dbc.Alert(
+                            id="run_message",
+                            color="warning",
+                            is_open=False,
+                            dismissable=True,
+                        ),
                         # Tabs
                         html.Div(tabs, id="tabs_container_div"),
                         # Figure
@@ -537,6 +609,23 @@ body_layout = dbc.Container(
                                             ),
                                             dcc.Download(id="download_simulation"),
                                             dcc.Download(id="download_parameters"),
+                                            dcc.Download(id="download_biomarkers"),
+                                            # Export of all variables, streamed
+                                            # from the export endpoint
+                                            dbc.Button(
+                                                "Export all variables",
+                                                id="button_export",
+                                                external_link=True,
+                                                n_clicks=0,
+                                                style=dict(fontSize=14),
+                                            ),
+                                            dcc.Dropdown(
+                                                funs.available_export_formats(),
+                                                "csv.gz",
+                                                id="export_format",
+                                                clearable=False,
+                                                style=dict(fontSize=14),
+                                            ),
                                             # Storage component for simulation and parameter data
                                             dcc.Store(
                                                 id="simulation_data",
@@ -545,6 +634,9 @@ body_layout = dbc.Container(
                                             dcc.Store(
                                                 id="parameter_data", data=parameter_data
                                             ),
+                                            dcc.Store(
+                                                id="figure_data", data=figure_data
+                                            ),
                                         ],
                                         className="d-grid gap-2",
                                     ),
@@ -561,7 +653,15 @@ body_layout = dbc.Container(
 )
 
 
-app.layout = html.Div([navbar, body_layout])
+def serve_layout():
+    # Each page load gets its own session ID, so that a new run only cancels
+    # runs from the same page
+    return html.Div(
+        [navbar, body_layout, dcc.Store(id="session_id", data=uuid.uuid4().hex)]
+    )
+
+
+app.layout = serve_layout
 
 
 # -----------------
@@ -700,6 +800,9 @@ def display_tabs(plot_vars):
     [
         Output("download_simulation", "data"),
         Output("download_parameters", "data"),
+        Output("download_biomarkers", "data"),
+        Output("run_message", "children", allow_duplicate=True),
+        Output("run_message", "is_open", allow_duplicate=True),
     ],
     Input("button_savedata", "n_clicks"),
     State("simulation_data", "data"),
@@ -707,14 +810,140 @@ def display_tabs(plot_vars):
     prevent_initial_call=True,
 )
 def func(n_clicks, simulation_data, parameter_data):
-    df_sim = pd.DataFrame(simulation_data["data-frame"])
+    df_sim = result_store.get(simulation_data["result_id"])
+    if df_sim is None:
+        print("Simulation {} is no longer stored".format(simulation_data["result_id"]))
+        return [no_update] * 3 + [funs.RESULT_EXPIRED_MESSAGE, True]
     df_pars = pd.DataFrame()
     df_pars["name"] = parameter_data.keys()
     df_pars["value"] = parameter_data.values()
     # df_pars = df_pars.astype("object")
-    out1 = dcc.send_data_frame(df_sim.to_csv, "simulation_data.csv")
+    out1 = dcc.send_data_frame(df_sim.to_pandas().to_csv, "simulation_data.csv")
     out2 = dcc.send_data_frame(df_pars.to_csv, "parameters.csv")
-    return [out1, out2]
+    df_beats = pd.DataFrame(simulation_data["biomarkers"])
+    out3 = dcc.send_data_frame(df_beats.to_csv, "biomarkers.csv")
+    return [out1, out2, out3, no_update, no_update]
+
+
+# ---------
+# Export all variables - the simulation is run again (from its cached prepaced
+# state) with every variable logged, written beat by beat to a spool file
+# (in memory up to export_spool_bytes), and then streamed to the client. The
+# simulation is returned to the pool before the client reads the file, so a
+# slow download doesn't hold it.
+# ---------
+export_spool_bytes = 16 * 2**20
+
+
+@app.callback(
+    Output("button_export", "href"),
+    Input("parameter_data", "data"),
+    Input("export_format", "value"),
+    State("session_id", "data"),
+)
+def update_export_link(parameter_data, fmt, session_id):
+    query = {
+        key: value for key, value in parameter_data.items() if key != "prepace_beats"
+    }
+    query["format"] = fmt
+    query["session_id"] = session_id
+    return app.get_relative_path("/export") + "?" + urlencode(query)
+
+
+def export_params_valid(params, bcl, total_beats, beats_keep):
+    """Whether the parameters of an export are within the ranges of the inputs"""
+    values = list(params.values()) + [bcl]
+    if not np.all(np.isfinite(values)):
+        return False
+    if not bcl_range[0] <= bcl <= bcl_range[1]:
+        return False
+    if not beats_range[0] <= beats_keep <= total_beats <= beats_range[1]:
+        return False
+    for par in list_params_cond:
+        value_min, value_max = (params_default[par] * x for x in multiplier_range)
+        if not value_min <= params[par] <= value_max:
+            return False
+    for par in list_params_extracell:
+        if not extracell_range[0] <= params[par] <= extracell_range[1]:
+            return False
+    return params["environment.celltype"] in celltype_values
+
+
+@server.route("/export")
+def export_all_variables():
+    fmt = request.args.get("format", "csv.gz")
+    if fmt not in funs.available_export_formats():
+        abort(400, "Unknown export format {}".format(fmt))
+
+    # Values that are missing or can't be parsed take their default
+    params = {
+        par: request.args.get(par, params_default[par], type=float)
+        for par in params_default
+    }
+    bcl = request.args.get("bcl", bcl_def, type=float)
+    total_beats = request.args.get("total_beats", total_beats_def, type=int)
+    beats_keep = request.args.get("beats_keep", beats_keep_def, type=int)
+    adaptive = request.args.get("adaptive", str(adaptive_def)) == "True"
+    if not export_params_valid(params, bcl, total_beats, beats_keep):
+        abort(400, "Invalid simulation parameters")
+
+    # A new export from the same page cancels the page's export in progress
+    # (but not its run). Exports stop at the time limit of run_registry, and
+    # are admitted by the scheduler as runs of the page, so they share its
+    # limits. Links without a session ID share one session per client address.
+    session_id = request.args.get("session_id") or request.remote_addr
+    run_key = "export:{}".format(session_id)
+    control = run_registry.start(run_key)
+    cost = funs.sim_model_cost(bcl, total_beats)
+    spool = tempfile.SpooledTemporaryFile(max_size=export_spool_bytes)
+    try:
+        with funs.request_span("export", format=fmt) as span:
+            with scheduler.admit(session_id, cost, control):
+                with sim_pool.simulation(timeout=control.remaining()) as s:
+                    chunks = funs.sim_model_beats(
+                        s,
+                        params=params,
+                        bcl=bcl,
+                        total_beats=total_beats,
+                        beats_keep=beats_keep,
+                        cache=steady_state_cache,
+                        warm_start=warm_start_store,
+                        adaptive=adaptive,
+                        log_vars=var_names,
+                        control=control,
+                    )
+                    # Close the chunks (resetting the simulation) before the
+                    # simulation is returned to the pool, even if writing fails
+                    with closing(chunks):
+                        for data in funs.stream_export(chunks, fmt):
+                            spool.write(data)
+            span["bytes"] = spool.tell()
+    except funs.RunRejected as e:
+        spool.close()
+        abort(503, str(e))
+    except TimeoutError:
+        spool.close()
+        abort(503, "All simulations are busy. Please try again shortly.")
+    except myokit.SimulationCancelledError:
+        spool.close()
+        if control.stop_reason == "cancelled":
+            abort(409, "Export replaced by a newer export from the same page")
+        abort(503, funs.stopped_message(control.stop_reason, run_registry.timeout))
+    except BaseException:
+        spool.close()
+        raise
+    finally:
+        run_registry.finish(run_key, control)
+
+    extension, mimetype = funs.export_formats[fmt]
+    filename = "simulation_all_variables.{}".format(extension)
+    spool.seek(0)
+    return Response(
+        wrap_file(request.environ, spool),
+        mimetype=mimetype,
+        headers={"Content-Disposition": "attachment; filename=" + filename},
+        direct_passthrough=True,
+    )
 
 
 # -----------
@@ -725,10 +954,12 @@ def func(n_clicks, simulation_data, parameter_data):
 outputs_callback_run = (
     # [Output("fig_{}".format(var).replace(".", "_"), "figure") for var in plot_vars_def]
     # [Output("div_tabs", "children")]
-    Output("tabs_container_output_div", "children"),
+    Output("figure_data", "data"),
     Output("loading-output", "children"),
     Output("simulation_data", "data"),
     Output("parameter_data", "data"),
+    Output("run_message", "children"),
+    Output("run_message", "is_open"),
 )
 # Input is click of run button
 inputs_callback_run = dict(n_clicks=[Input("run_button", "n_clicks")])
@@ -738,9 +969,9 @@ states_callback_run = dict(
     bcl=State("bcl", "value"),
     total_beats=State("total_beats", "value"),
     beats_keep=State("beats_keep", "value"),
+    adaptive=State("adaptive", "value"),
     cell_type=State("cell_type", "value"),
     plot_vars=State("dropdown_plot_vars", "value"),
-    current_plot_var=State("tabs", "value"),
     params_cond={
         par: State("{}_box".format(par.replace(".", "_")), "value")
         for par in list_params_cond
@@ -749,6 +980,7 @@ states_callback_run = dict(
         par: State("{}_box".format(par.replace(".", "_")), "value")
         for par in list_params_extracell
     },
+    session_id=State("session_id", "data"),
 )
 
 
@@ -758,16 +990,19 @@ states_callback_run = dict(
     state=states_callback_run,
     prevent_initial_call=True,
 )
+@funs.timed_request("run_reg_stim")
+@funs.profiled("run_reg_stim")
 def run_sim_and_update_fig(
     n_clicks,
     bcl,
     total_beats,
     beats_keep,
+    adaptive,
     cell_type,
     plot_vars,
-    current_plot_var,
     params_cond,
     params_extracell,
+    session_id,
 ):
     # Updated parameter values
     params = {}
@@ -791,40 +1026,120 @@ def run_sim_and_update_fig(
     parameter_data["bcl"] = bcl
     parameter_data["total_beats"] = total_beats
     parameter_data["beats_keep"] = beats_keep
+    parameter_data["adaptive"] = "adaptive" in adaptive
+
+    # Run simulation. A new run from the same page cancels this one, runs wait
+    # for their turn in the scheduler, and stop at the time limit of
+    # run_registry.
+    control = run_registry.start(session_id)
+    cost = funs.sim_model_cost(bcl, total_beats)
+    try:
+        with scheduler.admit(session_id, cost, control):
+            with sim_pool.simulation(timeout=control.remaining()) as s:
+                df_sim, df_beats = funs.sim_model(
+                    s,
+                    plot_vars,
+                    params=params,
+                    bcl=bcl,
+                    total_beats=total_beats,
+                    beats_keep=beats_keep,
+                    cache=steady_state_cache,
+                    warm_start=warm_start_store,
+                    adaptive="adaptive" in adaptive,
+                    biomarkers=True,
+                    control=control,
+                )
+    except funs.RunRejected as e:
+        message = str(e)
+        return [no_update, "", no_update, no_update, message, True]
+    except TimeoutError:
+        message = "All simulations are busy. Please try again shortly."
+        return [no_update, "", no_update, no_update, message, True]
+    except myokit.SimulationCancelledError:
+        if control.stop_reason == "cancelled":
+            # Replaced by a newer run from the same page
+            raise PreventUpdate
+        message = funs.stopped_message(control.stop_reason, run_registry.timeout)
+        return [no_update, "", no_update, no_update, message, True]
+    finally:
+        run_registry.finish(session_id, control)
+
+    # Show the beats that finished if the run was stopped early
+    stopped = df_sim.attrs["stopped"]
+    if stopped == "cancelled":
+        raise PreventUpdate
+    message = None
+    if stopped is not None:
+        message = funs.stopped_message(
+            stopped, run_registry.timeout, df_sim.attrs["completed"], beats_keep
+        )
 
-    # Run simulation
-    df_sim = funs.sim_model(
-        s,
-        plot_vars,
-        params=params,
-        bcl=bcl,
-        total_beats=total_beats,
-        beats_keep=beats_keep,
-    )
+    parameter_data["prepace_beats"] = df_sim.attrs["prepace_beats"]
 
-    # Need to convert df to dict to store as json
-    simulation_data = {"data-frame": df_sim.to_dict("records")}
+    # Store simulation on the server and only keep its ID on the app
+    simulation_data = {
+        "result_id": result_store.put(df_sim),
+        "biomarkers": df_beats.to_dict("list"),
+    }
 
-    fig = funs.make_simulation_fig(df_sim, current_plot_var)
-    div_fig = html.Div(dcc.Graph(figure=fig))
+    # Figures for each tab, decimated together so they share their x data
+    df_fig = funs.decimate_columns(df_sim, "time", plot_vars)
+    figure_data = [
+        funs.make_tab_figures(
+            lambda var: funs.make_simulation_fig(df_fig, var), plot_vars
+        )
+    ]
 
-    return [div_fig, "", simulation_data, parameter_data]
+    outputs = [
+        figure_data,
+        "",
+        simulation_data,
+        parameter_data,
+        message,
+        message is not None,
+    ]
+    funs.log_payload_size("run", outputs)
+    return outputs
 
 
 # ---------
-# Callback to switch between tabs
+# Callback to switch between tabs - runs on the client (assets/clientside.js)
 # ---------
-@callback(
-    Output("tabs_container_output_div", "children", allow_duplicate=True),
+app.clientside_callback(
+    ClientsideFunction(namespace="tabs", function_name="render_figures"),
+    [Output("fig_sim", "figure")],
     Input("tabs", "value"),
+    Input("figure_data", "data"),
+)
+
+
+# ---------
+# Callback to redraw the zoomed window of the time series at higher resolution
+# ---------
+@lru_cache(maxsize=8)
+def get_trace_pyramids(result_id, plot_var):
+    """Pyramids of the traces of plot_var in a stored result (None if gone)"""
+    df_sim = result_store.get(result_id)
+    if df_sim is None or plot_var not in df_sim.columns:
+        return None
+    return funs.make_trace_pyramids(df_sim, "time", plot_var)
+
+
+@app.callback(
+    Output("fig_sim", "figure", allow_duplicate=True),
+    Input("fig_sim", "relayoutData"),
+    State("tabs", "value"),
     State("simulation_data", "data"),
     prevent_initial_call=True,
 )
-def render_content(tab, simulation_data):
-    df_sim = pd.DataFrame(simulation_data["data-frame"])
-    fig = funs.make_simulation_fig(df_sim, tab)
-    div_fig = html.Div(dcc.Graph(figure=fig))
-    return div_fig
+def zoom_figure(relayout_data, tab, simulation_data):
+    x_range = funs.relayout_x_range(relayout_data)
+    if x_range is None:
+        raise PreventUpdate
+    pyramids = get_trace_pyramids(simulation_data["result_id"], tab)
+    if pyramids is None:
+        raise PreventUpdate
+    return funs.patch_trace_window(pyramids, x_range)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 16 Oct, 2026
+
+Single server for all protocol apps.
+
+The reg-stim, S1-S2 and rate dependence apps are mounted as pages of one WSGI
+application, so they run in the same process and share the model, simulation
+pool, process pool and caches in app_shared.py. Pages are served at
+<url root>/reg-stim/, <url root>/s1-s2/ and <url root>/rate-dep/, and the
+url root redirects to the regular stimulation page. Metrics of all pages are
+served at <url root>/metrics.
+
+Run locally with
+
+    python app_server.py
+
+@author: tbury
+"""
+
+from flask import Flask, redirect, request
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
+
+import app_shared
+
+# Served locally at http://localhost:8050/<page>/ unless AP_URL_ROOT is set
+if app_shared.url_root is None:
+    app_shared.url_root = "/"
+
+import app_reg_stim
+import app_s1_s2
+import app_rate_dep
+
+
+# Dash app of each page
+pages = {
+    "reg-stim": app_reg_stim.app,
+    "s1-s2": app_s1_s2.app,
+    "rate-dep": app_rate_dep.app,
+}
+
+server = Flask(__name__)
+
+
+@server.route("/")
+def index():
+    return redirect(request.script_root + "/reg-stim/")
+
+
+server.add_url_rule("/metrics", view_func=app_shared.metrics_view)
+
+
+application = DispatcherMiddleware(
+    server, {"/" + page: app.server for page, app in pages.items()}
+)
+
+
+if __name__ == "__main__":
+    from werkzeug.serving import run_simple
+
+    run_simple("localhost", 8050, application, use_reloader=True)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 16 Oct, 2026
+
+Resources shared by the protocol apps (reg-stim, S1-S2, rate dependence).
+
+The model, compiled simulation pool, process pool, run registry and
+scheduler, result and steady state caches, and request metrics are made once
+per process when this module is first imported. Apps served from the same process (see
+app_server.py) therefore share them, rather than each loading the model and
+compiling its own simulations.
+
+@author: tbury
+"""
+
+import os
+import threading
+
+import myokit as myokit
+from flask import Response
+
+import app_functions as funs
+
+
+# Determine if running app locally or on cloud
+fileroot_local = "/Users/tbury/Google Drive/research/postdoc_23/ap-simulator"
+fileroot_cloud = "/home/ubuntu/ap-simulator/"
+
+if os.getcwd() == fileroot_local:
+    run_cloud = False
+    fileroot = fileroot_local
+else:
+    run_cloud = True
+    fileroot = fileroot_cloud
+
+# URL under which the apps are served. Each app is served at
+# url_root + "<protocol>/". If None, a standalone app is served at "/".
+url_root = os.environ.get("AP_URL_ROOT", "/ap-simulator/" if run_cloud else None)
+
+
+def requests_pathname_prefix(page):
+    """URL prefix of the app for page (e.g. "reg-stim")"""
+    if url_root is None:
+        return "/"
+    return url_root + page + "/"
+
+
+def page_href(page):
+    """URL of the app for page, for links between the apps (e.g. the navbar)"""
+    return (url_root or "/") + page + "/"
+
+
+# Load in model from mmt file
+filepath_mmt = fileroot + "/mmt_files/torord-2019.mmt"
+m = myokit.load_model(filepath_mmt)
+
+# Get names of all variables in model
+var_names = [var.qname() for var in list(m.variables(const=False))]
+
+# Directory of compiled simulations, shared between app processes and restarts
+sim_cache_dir = os.environ.get(
+    "AP_SIM_CACHE_DIR", os.path.join(fileroot, "cache", "simulations")
+)
+
+# Pool of simulation objects with model, so that concurrent requests don't
+# share constants, protocol or state
+sim_pool = funs.SimulationPool(
+    m, size=int(os.environ.get("AP_SIM_POOL_SIZE", 2)), cache_dir=sim_cache_dir
+)
+
+# Server-side store of simulation results. Only result IDs are sent to the
+# browser, and traces are fetched by ID to make figures and downloads.
+result_store = funs.ResultStore(
+    path=os.path.join(fileroot, "cache", "results"),
+    max_bytes=int(os.environ.get("AP_RESULT_STORE_MB", 256)) * 2**20,
+)
+
+# Cache of prepaced states, so repeated configurations skip prepacing. Keys
+# include the pacing protocol, so protocols can share the cache, and the model,
+# so states are recomputed after the model changes.
+steady_state_cache = funs.SteadyStateCache(
+    path=os.path.join(fileroot, "cache", "steady_states.json"),
+    maxsize=500,
+    model=m,
+)
+
+# Time limit (s) of each simulation run (AP_RUN_TIMEOUT=0 for no limit). A new
+# run from the same page cancels the page's run in progress.
+run_timeout = float(os.environ.get("AP_RUN_TIMEOUT", 60)) or None
+run_registry = funs.RunRegistry(timeout=run_timeout)
+
+# Admission control of runs, with costs in simulated model time. Runs that
+# simulate more than AP_MAX_RUN_SECONDS are rejected, and runs wait while
+# AP_WORK_BUDGET_SECONDS are being simulated or their page has a run in
+# progress. Runs of up to AP_INTERACTIVE_SECONDS start before larger sweeps.
+scheduler = funs.RunScheduler(
+    max_cost=float(os.environ.get("AP_MAX_RUN_SECONDS", 1000)) * 1000,
+    budget=float(os.environ.get("AP_WORK_BUDGET_SECONDS", 3000)) * 1000,
+    session_limit=int(os.environ.get("AP_SESSION_RUNS", 1)),
+    interactive_cost=float(os.environ.get("AP_INTERACTIVE_SECONDS", 200)) * 1000,
+)
+
+# Process pool to run S2 intervals or BCL values in parallel
+# (AP_SIM_PROCESSES=1 to disable). Made by the first run that needs it. Kept
+# small by default, as the simulation pool also runs simulations in this
+# process.
+num_processes = int(os.environ.get("AP_SIM_PROCESSES", min(2, os.cpu_count())))
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def get_process_pool():
+    """Process pool shared by the apps (None if AP_SIM_PROCESSES=1)"""
+    global _process_pool
+    if num_processes <= 1:
+        return None
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = funs.make_process_pool(
+                m, num_processes, cache_dir=sim_cache_dir
+            )
+    return _process_pool
+
+
+# Metrics of requests and of the shared resources, served at /metrics of each
+# app (see metrics_view)
+metrics = funs.RequestMetrics()
+funs.span_handlers.append(metrics.observe_span)
+metrics.add_stats("sim_pool", sim_pool.stats, counters=["checkouts"])
+metrics.add_stats(
+    "result_store", result_store.stats, counters=["hits", "disk_hits", "misses"]
+)
+metrics.add_stats("runs", run_registry.stats, counters=["cancelled"])
+metrics.add_stats("scheduler", scheduler.stats, counters=["admitted", "rejected"])
+
+
+def metrics_view():
+    """Metrics in the Prometheus text format, for a /metrics route"""
+    return Response(metrics.exposition(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,43 @@
+/*
+Clientside callbacks for the AP simulator apps.
+
+Tab switching is done in the browser from figure data sent by the run
+callback (see make_tab_figures in app_functions.py), so it needs no request
+to the server.
+*/
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    tabs: {
+        // Return the figure of each graph for the selected tab
+        render_figures: function (tab, figure_data) {
+            if (!figure_data) {
+                return window.dash_clientside.no_update;
+            }
+            return figure_data.map(function (tab_figures) {
+                return render_figure(tab, tab_figures);
+            });
+        },
+    },
+});
+
+function render_figure(tab, tab_figures) {
+    var traces = tab_figures.traces[tab];
+    var layout = tab_figures.layout[tab];
+
+    // Variable was not simulated - show empty axes labelled by the variable
+    if (traces === undefined) {
+        var layouts = Object.values(tab_figures.layout);
+        layout = Object.assign({}, layouts.length > 0 ? layouts[0] : {});
+        layout.yaxis = Object.assign({}, layout.yaxis, {title: {text: tab}});
+        return {data: [], layout: layout};
+    }
+
+    // Traces without x data use the x data shared by all tabs
+    var data = traces.map(function (trace, i) {
+        if (trace.x !== undefined) {
+            return trace;
+        }
+        return Object.assign({}, trace, {x: tab_figures.x[i]});
+    });
+    return {data: data, layout: layout};
+}
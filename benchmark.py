@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 16 Oct, 2026
+
+Benchmarks of the protocol functions in app_functions.
+
+Times sim_model (several pacing configurations), sim_s1s2_restitution and
+sim_rate_change with the app defaults, the biomarker helpers and the figure
+builders with the Torord model, and prepacing and recording of the
+FitzHugh-Nagumo model (mmt_files/fhn.mmt). The protocol functions are
+specific to Torord variable names, so fhn is benchmarked on the generic
+simulation steps only.
+
+Each benchmark runs in a fresh process. Setup (loading the model and the
+data a benchmark needs) isn't timed. For each benchmark the median wall time
+over the repeats, the increase in peak RSS over the timed runs (above the
+RSS after setup, run_rss_mb) and the model time simulated per wall second
+are recorded, and compared with a JSON baseline. Benchmarks slower than the
+baseline, or using more memory, by more than the threshold are flagged as
+regressions. The RSS after setup is recorded as setup_rss_mb.
+
+    python benchmark.py                  # run and compare with the baseline
+    python benchmark.py --save           # run and save as the baseline
+    python benchmark.py -k sim_model     # only benchmarks matching sim_model
+
+Simulations are run serially with fixed prepacing (not adaptive), so that
+each run does the same work. The exit status is 1 if a regression was
+flagged.
+
+@author: tbury
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import statistics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import myokit as myokit
+
+# Don't print timing records of each stage (see app_functions.timing_span)
+os.environ.setdefault("AP_TIMING", "0")
+
+import app_functions as funs
+
+
+fileroot = os.path.dirname(os.path.abspath(__file__))
+sim_cache_dir = os.environ.get(
+    "AP_SIM_CACHE_DIR", os.path.join(fileroot, "cache", "simulations")
+)
+baseline_path_def = os.path.join(fileroot, "cache", "benchmark_baseline.json")
+
+# App defaults (see app_reg_stim.py, app_s1_s2.py and app_rate_dep.py)
+plot_vars_reg_stim = [
+    "membrane.v",
+    "INa.INa",
+    "INaCa.INaCa_i",
+    "ICaL.ICaL",
+    "IKr.IKr",
+    "IKs.IKs",
+]
+plot_vars_protocol = ["membrane.v", "intracellular_ions.cai"]
+s1_interval_def = 1000
+s1_nbeats_def = 10
+s2_intervals_def = "300:500:20, 500:1000:50"
+bcl_values_def = "250:500:50, 500:1000:100"
+nbeats_def = 10
+
+# Pacing configurations (bcl, total_beats, beats_keep) of sim_model
+sim_model_configs = [(1000, 100, 1), (1000, 100, 4), (400, 200, 10), (4000, 25, 2)]
+
+
+def load_simulation(name):
+    """Simulation of mmt_files/<name>.mmt, compiled once and cached"""
+    model = myokit.load_model(os.path.join(fileroot, "mmt_files", name + ".mmt"))
+    return funs.load_compiled_simulation(model, sim_cache_dir)
+
+
+def setup_sim_model(bcl, total_beats, beats_keep):
+    s = load_simulation("torord-2019")
+
+    def run():
+        funs.sim_model(
+            s,
+            plot_vars_reg_stim,
+            bcl=bcl,
+            total_beats=total_beats,
+            beats_keep=beats_keep,
+            biomarkers=True,
+        )
+        return funs.sim_model_cost(bcl, total_beats)
+
+    return run
+
+
+def setup_s1s2():
+    s = load_simulation("torord-2019")
+
+    def run():
+        funs.sim_s1s2_restitution(
+            s,
+            s1_interval=s1_interval_def,
+            s1_nbeats=s1_nbeats_def,
+            s2_intervals=s2_intervals_def,
+        )
+        return funs.s1s2_cost(s1_interval_def, s1_nbeats_def, s2_intervals_def)
+
+    return run
+
+
+def setup_rate_change():
+    s = load_simulation("torord-2019")
+
+    def run():
+        funs.sim_rate_change(s, bcl_values=bcl_values_def, nbeats=nbeats_def)
+        return funs.rate_change_cost(bcl_values_def, nbeats_def)
+
+    return run
+
+
+def record_beats(bcl=1000, num_beats=10):
+    """Time, voltage and calcium of num_beats recorded Torord beats"""
+    s = load_simulation("torord-2019")
+    df = funs.sim_model(
+        s, plot_vars_protocol, bcl=bcl, total_beats=100, beats_keep=num_beats
+    )
+    stim_times = 20 + bcl * np.arange(num_beats)
+    return df["time"], df["membrane.v"], df["intracellular_ions.cai"], stim_times
+
+
+def setup_biomarkers():
+    time, voltage, cai, stim_times = record_beats()
+
+    def run():
+        funs.compute_biomarkers(time, voltage, cai, stim_times=stim_times)
+        return 0
+
+    return run
+
+
+def setup_crossings():
+    time, voltage, cai, stim_times = record_beats()
+
+    def run():
+        funs.find_crossings(voltage, -60, time=time)
+        funs.find_local_maxima(voltage, time=time)
+        return 0
+
+    return run
+
+
+def setup_fig_reg_stim():
+    s = load_simulation("torord-2019")
+    df_sim = funs.sim_model(
+        s, plot_vars_reg_stim, bcl=1000, total_beats=100, beats_keep=4
+    )
+
+    def run():
+        df_fig = funs.decimate_columns(df_sim, "time", plot_vars_reg_stim)
+        funs.make_tab_figures(
+            lambda var: funs.make_simulation_fig(df_fig, var), plot_vars_reg_stim
+        )
+        return 0
+
+    return run
+
+
+def setup_fig_s1s2():
+    s = load_simulation("torord-2019")
+    df_ts, df_restitution = funs.sim_s1s2_restitution(
+        s,
+        s1_interval=s1_interval_def,
+        s1_nbeats=s1_nbeats_def,
+        s2_intervals=s2_intervals_def,
+    )
+
+    def run():
+        df_fig = funs.decimate_columns(df_ts, "time", plot_vars_protocol, "s2_interval")
+        funs.make_tab_figures(
+            lambda var: funs.make_s1s2_fig(df_fig, var), plot_vars_protocol
+        )
+        funs.make_tab_figures(
+            lambda var: funs.make_restitution_fig(df_restitution, var),
+            plot_vars_protocol,
+        )
+        return 0
+
+    return run
+
+
+def setup_fig_rate():
+    s = load_simulation("torord-2019")
+    df_ts, df_rate = funs.sim_rate_change(
+        s, bcl_values=bcl_values_def, nbeats=nbeats_def
+    )
+
+    def run():
+        df_fig = funs.decimate_columns(df_ts, "time", plot_vars_protocol, "bcl")
+        funs.make_tab_figures(
+            lambda var: funs.make_bcl_ts_fig(df_fig, var), plot_vars_protocol
+        )
+        funs.make_tab_figures(
+            lambda var: funs.make_rate_fig(df_rate, var), plot_vars_protocol
+        )
+        return 0
+
+    return run
+
+
+def setup_fhn(bcl=1000, num_beats_pre=100, beats_keep=4):
+    s = load_simulation("fhn")
+    s.set_protocol(myokit.pacing.blocktrain(bcl, duration=0.5, offset=20))
+    # s.pre overwrites the default state (so s.reset would start from the
+    # last run's prepaced state), so start each run from the initial state
+    initial = s.default_state()
+
+    def run():
+        s.set_default_state(initial)
+        s.set_state(initial)
+        s.set_time(0)
+        funs.prepace(s, bcl, num_beats_pre)
+        s.run(bcl * beats_keep, log=["engine.time", "membrane.v", "membrane.w"])
+        return bcl * (num_beats_pre + beats_keep)
+
+    return run
+
+
+# Name -> (setup function, arguments). Setup returns a function that runs the
+# benchmark once and returns the model time it simulated (ms).
+benchmarks = {
+    "sim_model[bcl={},total_beats={},beats_keep={}]".format(*config): (
+        setup_sim_model,
+        config,
+    )
+    for config in sim_model_configs
+}
+benchmarks.update(
+    {
+        "sim_s1s2_restitution[default]": (setup_s1s2, ()),
+        "sim_rate_change[default]": (setup_rate_change, ()),
+        "compute_biomarkers[10 beats]": (setup_biomarkers, ()),
+        "find_crossings+find_local_maxima[10 beats]": (setup_crossings, ()),
+        "make_tab_figures[reg_stim]": (setup_fig_reg_stim, ()),
+        "make_tab_figures[s1s2]": (setup_fig_s1s2, ()),
+        "make_tab_figures[rate]": (setup_fig_rate, ()),
+        "fhn[prepace+record]": (setup_fhn, ()),
+    }
+)
+
+
+# Memory increases below this (MB) are compared with it instead, so that
+# noise in small increases isn't flagged as a regression
+rss_floor_mb = 10
+
+
+def peak_rss():
+    """Peak resident set size (bytes) of this process"""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kB on Linux
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS of this process to its current RSS
+
+    Only supported on Linux (/proc/self/clear_refs). Returns whether the peak
+    was reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def run_benchmark(name, repeat):
+    """Run a benchmark (in this process) and return its measurements"""
+    setup, args = benchmarks[name]
+    run = setup(*args)
+
+    # Measure the memory of the timed runs rather than of setup (e.g. loading
+    # the model). Where the peak can't be reset, it includes setup, and only
+    # an increase above the peak of setup is seen.
+    rss_setup = peak_rss()
+    if reset_peak_rss():
+        rss_setup = peak_rss()
+
+    wall_times = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        simulated_ms = run()
+        wall_times.append(time.perf_counter() - t_start)
+
+    wall_time = statistics.median(wall_times)
+    return {
+        "wall_time": wall_time,
+        "wall_time_min": min(wall_times),
+        "setup_rss_mb": rss_setup / 2**20,
+        "run_rss_mb": (peak_rss() - rss_setup) / 2**20,
+        "simulated_ms": simulated_ms,
+        "throughput": simulated_ms / wall_time if simulated_ms else None,
+    }
+
+
+def run_isolated(name, repeat):
+    """Run a benchmark in a fresh process"""
+    # Spawn (rather than fork) so the process doesn't inherit this one's memory
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(run_benchmark, name, repeat).result()
+
+
+def environment():
+    """Description of the machine and versions the benchmarks ran with"""
+    return {
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "myokit": myokit.__version__,
+        "numpy": np.__version__,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results with a baseline
+
+    Returns
+    -------
+    list
+        (name, metric, ratio) of each regression: wall time or RSS increase
+        of the runs greater than the baseline by more than threshold (a
+        fraction). RSS increases are compared with at least rss_floor_mb.
+
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in ["wall_time", "run_rss_mb"]:
+            # Baselines saved by older versions of this script lack run_rss_mb
+            if metric not in baseline[name]:
+                continue
+            value_base = baseline[name][metric]
+            if metric == "run_rss_mb":
+                value_base = max(value_base, rss_floor_mb)
+            ratio = result[metric] / value_base
+            if ratio > 1 + threshold:
+                regressions.append((name, metric, ratio))
+    return regressions
+
+
+def print_results(results, baseline):
+    print(
+        "{:<50} {:>10} {:>8} {:>12} {:>12}".format(
+            "benchmark", "wall (s)", "vs base", "run RSS (MB)", "sim ms / s"
+        )
+    )
+    for name, result in results.items():
+        ratio, throughput = "", ""
+        if name in baseline:
+            ratio = "{:.2f}x".format(result["wall_time"] / baseline[name]["wall_time"])
+        if result["throughput"] is not None:
+            throughput = "{:.0f}".format(result["throughput"])
+        print(
+            "{:<50} {:>10.4f} {:>8} {:>12.1f} {:>12}".format(
+                name, result["wall_time"], ratio, result["run_rss_mb"], throughput
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument(
+        "--baseline", default=baseline_path_def, help="JSON baseline to compare with"
+    )
+    parser.add_argument(
+        "--save", action="store_true", help="save the results as the baseline"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="fractional increase flagged as a regression (default 0.2)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="runs of each benchmark (default 3)"
+    )
+    parser.add_argument(
+        "-k", dest="pattern", default="", help="only run benchmarks matching this"
+    )
+    args = parser.parse_args()
+
+    names = [name for name in benchmarks if args.pattern in name]
+    results = {}
+    for name in names:
+        print("Run {}".format(name))
+        results[name] = run_isolated(name, args.repeat)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.threshold)
+    print_results(results, baseline)
+
+    for name, metric, ratio in regressions:
+        print("REGRESSION {}: {} is {:.2f}x the baseline".format(name, metric, ratio))
+
+    if args.save:
+        # Keep baseline results of benchmarks that weren't run
+        baseline.update(results)
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump({"environment": environment(), "results": baseline}, f, indent=2)
+        print("Saved baseline to {}".format(args.baseline))
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
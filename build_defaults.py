@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 16 Oct, 2026
+
+Build step to compute the default results shown when each app loads.
+
+Importing an app loads its default results from cache/, computing and
+storing them if they are missing or stale (see
+app_functions.load_default_results). Run this after deploying, or after
+changing the model or app functions, so that app workers start without
+running any simulations:
+
+    python build_defaults.py
+
+@author: tbury
+"""
+
+import os
+import importlib
+
+# One simulation per app is enough to build the defaults
+os.environ.setdefault("AP_SIM_POOL_SIZE", "1")
+os.environ.setdefault("AP_SIM_PROCESSES", "1")
+
+list_apps = ["app_reg_stim", "app_s1_s2", "app_rate_dep"]
+
+
+if __name__ == "__main__":
+    for name in list_apps:
+        importlib.import_module(name)
+        print("Built default results for {}".format(name))
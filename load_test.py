@@ -0,0 +1,577 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 16 Oct, 2026
+
+Load test of the apps with concurrent virtual users.
+
+Each virtual user opens a page (reg-stim, s1-s2 or rate-dep) and then
+repeatedly, after a random think time, does one of
+- run: click Run with random parameter values around the defaults
+- zoom: switch to a random tab and zoom its figure (tabs are switched on the
+  client, and each zoom fetches traces of the tab from the server)
+- download: click the button to save data
+- export: follow the link to export all variables (reg-stim only), reading
+  the streamed file
+- page: reload the page
+Requests are the ones a browser makes, with callback payloads built from the
+app's layout and callback dependencies, and the stores updated by each
+response.
+
+By default the apps are served in this process (app_server.application)
+through werkzeug's test client, so configurations can be compared by setting
+environment variables, e.g.
+
+    AP_SIM_POOL_SIZE=4 python load_test.py --users 8 --duration 120
+
+With --url, requests are sent to a running server instead, e.g. one started
+with python app_server.py:
+
+    python load_test.py --url http://localhost:8050 --users 8
+
+Reports the latency percentiles, throughput and error rate of each action,
+and the peak memory of each server process (this process and its workers, or
+the processes given with --pid).
+
+@author: tbury
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import threading
+import contextlib
+import urllib.error
+import urllib.request
+
+import numpy as np
+
+# Don't print timing records of each stage (see app_functions.timing_span)
+os.environ.setdefault("AP_TIMING", "0")
+
+
+# Pages of app_server.py
+list_pages = ["reg-stim", "s1-s2", "rate-dep"]
+
+# Relative frequency of each action of a virtual user
+action_weights = {"run": 4, "zoom": 3, "download": 2, "export": 1, "page": 1}
+
+# Callback each action needs. Actions of pages without it are skipped.
+action_callbacks = {
+    "run": "run",
+    "zoom": "zoom",
+    "download": "download",
+    "export": "export_link",
+}
+
+
+class LocalClient:
+    """Send requests to a WSGI application in this process"""
+
+    def __init__(self, application):
+        from werkzeug.test import Client
+
+        self.client = Client(application)
+
+    def request(self, method, path, body=None):
+        response = self.client.open(path, method=method, json=body)
+        return response.status_code, response.get_data()
+
+
+class HttpClient:
+    """Send requests to a server at url"""
+
+    def __init__(self, url, timeout=600):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def request(self, method, path, body=None):
+        data = None if body is None else json.dumps(body).encode()
+        request = urllib.request.Request(
+            self.url + path,
+            data=data,
+            method=method,
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+def find_props(layout):
+    """Props of each component of a Dash layout (as JSON) by ID"""
+    props = {}
+
+    def walk(node):
+        if isinstance(node, dict):
+            if "props" in node and "type" in node:
+                if isinstance(node["props"].get("id"), str):
+                    props[node["props"]["id"]] = node["props"]
+                node = node["props"]
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(layout)
+    return props
+
+
+def decode_array(values):
+    """Values of a figure array, which may be a typed array (see encode_array)"""
+    if isinstance(values, dict) and "bdata" in values:
+        return np.frombuffer(base64.b64decode(values["bdata"]), dtype=values["dtype"])
+    return np.asarray(values, dtype=float)
+
+
+def random_value(value, props, spread):
+    """Random value of a numeric input around value, within its min and max"""
+    value = value * np.exp(random.gauss(0, spread))
+    value = min(max(value, props["min"]), props["max"])
+    step = props.get("step")
+    if step is not None:
+        value = round(round(value / step) * step, 6)
+        if float(step).is_integer():
+            value = int(value)
+    return value
+
+
+class VirtualUser:
+    """
+    A user of one page, keeping its props (e.g. stores) between requests
+
+    Parameters
+    ----------
+    client : LocalClient or HttpClient
+    page : str
+        Page of the app (see list_pages)
+    record : function
+        Called with (page, action, latency, status, nbytes, outcome) after
+        each request
+    spread : float
+        Standard deviation of the log of random parameter values relative to
+        their defaults
+
+    """
+
+    def __init__(self, client, page, record, spread=0.3):
+        self.client = client
+        self.page = page
+        self.record = record
+        self.spread = spread
+        self.n_clicks = 0
+
+    def request(self, action, method, path, body=None):
+        """Send a request and record it. Return the JSON response, if any."""
+        t_start = time.perf_counter()
+        try:
+            status, data = self.client.request(method, path, body)
+        except Exception as e:
+            latency = time.perf_counter() - t_start
+            self.record(self.page, action, latency, None, 0, type(e).__name__)
+            return None
+        latency = time.perf_counter() - t_start
+
+        outcome = "ok" if status in (200, 204) else "error"
+        if status in (409, 503):
+            # Stopped or rejected by the server with a message, e.g. an export
+            # while the scheduler is full
+            outcome = "message"
+        response = None
+        if status == 200 and data[:1] in (b"{", b"["):
+            response = json.loads(data)
+        if isinstance(response, dict):
+            # A run that ended with a message, e.g. rejected by the scheduler
+            message = response.get("response", {}).get("run_message", {})
+            if message.get("is_open"):
+                outcome = "message"
+        self.record(self.page, action, latency, status, len(data), outcome)
+        return response
+
+    def load_page(self):
+        """Load the page, its layout and its callbacks"""
+        prefix = "/" + self.page
+        self.request("page", "GET", prefix + "/")
+        layout = self.request("page", "GET", prefix + "/_dash-layout")
+        dependencies = self.request("page", "GET", prefix + "/_dash-dependencies")
+        if layout is None or dependencies is None:
+            return False
+
+        self.props = find_props(layout)
+        self.callbacks = {}
+        for dependency in dependencies:
+            input_ids = [x["id"] + "." + x["property"] for x in dependency["inputs"]]
+            if "figure_data.data" in dependency["output"]:
+                self.callbacks["run"] = dependency
+            elif "button_savedata.n_clicks" in input_ids:
+                self.callbacks["download"] = dependency
+            elif dependency["output"] == "button_export.href":
+                self.callbacks["export_link"] = dependency
+            elif input_ids[0].endswith(".relayoutData"):
+                self.callbacks["zoom"] = dependency
+        return True
+
+    def value(self, x):
+        return self.props.get(x["id"], {}).get(x["property"])
+
+    def callback(self, action, inputs, states={}):
+        """Call the callback of action, with inputs and states by ID.property"""
+        dependency = self.callbacks[action]
+
+        def values(items, overrides):
+            return [
+                dict(
+                    x, value=overrides.get(x["id"] + "." + x["property"], self.value(x))
+                )
+                for x in items
+            ]
+
+        outputs = []
+        for output in dependency["output"].strip(".").split("..."):
+            component_id, prop = output.split(".", 1)
+            outputs.append({"id": component_id, "property": prop})
+        body = {
+            "output": dependency["output"],
+            "outputs": outputs if len(outputs) > 1 else outputs[0],
+            "inputs": values(dependency["inputs"], inputs),
+            "state": values(dependency["state"], states),
+            "changedPropIds": list(inputs),
+        }
+        response = self.request(
+            action, "POST", "/" + self.page + "/_dash-update-component", body
+        )
+
+        # Keep the updated stores (e.g. figure_data, simulation_data) and
+        # links
+        if response is not None and action in ("run", "export_link"):
+            for component_id, props in response.get("response", {}).items():
+                self.props.setdefault(component_id, {}).update(props)
+
+    def run(self):
+        """Click Run with random values of the numeric inputs"""
+        states = {}
+        for x in self.callbacks["run"]["state"]:
+            props = self.props.get(x["id"], {})
+            value = props.get(x["property"])
+            if isinstance(value, (int, float)) and "min" in props and "max" in props:
+                states[x["id"] + "." + x["property"]] = random_value(
+                    value, props, self.spread
+                )
+        self.n_clicks += 1
+        self.callback("run", {"run_button.n_clicks": self.n_clicks}, states)
+
+    def zoom(self):
+        """Switch to a random tab and zoom into a random window of its figure"""
+        tabs = [tab["props"]["value"] for tab in self.props["tabs"]["children"]]
+        figure_data = self.props["figure_data"]["data"]
+        x = decode_array(figure_data[0]["x"][0])
+        if random.random() < 0.2 or len(x) < 2:
+            relayout_data = {"xaxis.autorange": True}
+        else:
+            x0, x1 = sorted(random.uniform(float(x[0]), float(x[-1])) for _ in range(2))
+            relayout_data = {"xaxis.range[0]": x0, "xaxis.range[1]": x1}
+        graph_id = self.callbacks["zoom"]["inputs"][0]["id"]
+        self.callback(
+            "zoom",
+            {graph_id + ".relayoutData": relayout_data},
+            {"tabs.value": random.choice(tabs)},
+        )
+
+    def download(self):
+        self.n_clicks += 1
+        self.callback("download", {"button_savedata.n_clicks": self.n_clicks})
+
+    def export(self):
+        """Update the export link for the current parameters, and follow it"""
+        self.callback(
+            "export_link",
+            {"parameter_data.data": self.props["parameter_data"]["data"]},
+        )
+        href = self.props.get("button_export", {}).get("href")
+        if href is None:
+            return
+        # The link is under the URL root seen by the browser (AP_URL_ROOT),
+        # while requests are sent to the page as served by app_server
+        prefix = "/" + self.page + "/"
+        self.request("export", "GET", prefix + href.split(prefix, 1)[-1].lstrip("/"))
+
+    def session(self, deadline, think_time):
+        """Use the page until deadline"""
+        if not self.load_page():
+            return
+        actions = [
+            action
+            for action in action_weights
+            if action == "page" or action_callbacks[action] in self.callbacks
+        ]
+        weights = [action_weights[action] for action in actions]
+        while time.perf_counter() < deadline:
+            action = random.choices(actions, weights)[0]
+            if action == "page":
+                if not self.load_page():
+                    return
+            else:
+                getattr(self, action)()
+            time.sleep(random.expovariate(1 / think_time) if think_time else 0)
+
+
+def rss_by_process(pids=None):
+    """
+    Resident memory (bytes) of processes, by PID
+
+    If pids is None, this process and its child processes (e.g. workers of
+    the process pool). Memory is read from /proc, so only on Linux. Elsewhere
+    the peak RSS of this process is given.
+    """
+    if not os.path.exists("/proc/self/status"):
+        import resource
+
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {os.getpid(): maxrss if sys.platform == "darwin" else maxrss * 1024}
+
+    if pids is None:
+        pids = [os.getpid()]
+        i = 0
+        while i < len(pids):
+            for path in _task_children_files(pids[i]):
+                with contextlib.suppress(OSError), open(path) as f:
+                    pids += [int(pid) for pid in f.read().split()]
+            i += 1
+
+    rss = {}
+    for pid in pids:
+        with contextlib.suppress(OSError), open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss[pid] = int(line.split()[1]) * 1024
+    return rss
+
+
+def _task_children_files(pid):
+    try:
+        tasks = os.listdir("/proc/{}/task".format(pid))
+    except OSError:
+        return []
+    return ["/proc/{}/task/{}/children".format(pid, task) for task in tasks]
+
+
+class MemorySampler(threading.Thread):
+    """Record the peak RSS of each server process while the test runs"""
+
+    def __init__(self, pids=None, interval=0.5):
+        super().__init__(daemon=True)
+        self.pids = pids
+        self.interval = interval
+        self.peak = {}
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            for pid, rss in rss_by_process(self.pids).items():
+                self.peak[pid] = max(self.peak.get(pid, 0), rss)
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def summarize(records, duration):
+    """Latency percentiles, throughput and error rate of each page and action"""
+    groups = {}
+    for page, action, latency, status, nbytes, outcome in records:
+        groups.setdefault((page, action), []).append((latency, nbytes, outcome))
+        groups.setdefault(("all", action), []).append((latency, nbytes, outcome))
+
+    summary = {}
+    for (page, action), group in sorted(groups.items()):
+        latency = np.array([item[0] for item in group])
+        outcomes = [item[2] for item in group]
+        summary["{} {}".format(page, action)] = {
+            "requests": len(group),
+            "throughput": len(group) / duration,
+            "errors": sum(outcome not in ("ok", "message") for outcome in outcomes),
+            "error_rate": np.mean([o not in ("ok", "message") for o in outcomes]),
+            "messages": outcomes.count("message"),
+            "error_types": {
+                outcome: outcomes.count(outcome)
+                for outcome in set(outcomes)
+                if outcome not in ("ok", "message")
+            },
+            "p50": np.percentile(latency, 50),
+            "p90": np.percentile(latency, 90),
+            "p95": np.percentile(latency, 95),
+            "p99": np.percentile(latency, 99),
+            "max": latency.max(),
+            "mean_kb": np.mean([item[1] for item in group]) / 1000,
+        }
+    return summary
+
+
+def print_summary(summary, memory, duration, num_records):
+    print(
+        "{:<22} {:>6} {:>7} {:>6} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8} {:>9}".format(
+            "",
+            "n",
+            "req/s",
+            "err%",
+            "msg",
+            "p50 s",
+            "p90 s",
+            "p95 s",
+            "p99 s",
+            "max s",
+            "mean kB",
+        )
+    )
+    for name, row in summary.items():
+        print(
+            "{:<22} {:>6} {:>7.2f} {:>6.1f} {:>6} {:>8.3f} {:>8.3f} {:>8.3f} "
+            "{:>8.3f} {:>8.3f} {:>9.1f}".format(
+                name,
+                row["requests"],
+                row["throughput"],
+                100 * row["error_rate"],
+                row["messages"],
+                row["p50"],
+                row["p90"],
+                row["p95"],
+                row["p99"],
+                row["max"],
+                row["mean_kb"],
+            )
+        )
+    print(
+        "\n{} requests in {:.1f} s ({:.2f} requests/s)".format(
+            num_records, duration, num_records / duration
+        )
+    )
+    print("Peak memory of server processes:")
+    for pid, rss in sorted(memory.items()):
+        label = "this process" if pid == os.getpid() else "PID {}".format(pid)
+        print("    {}: {:.1f} MB".format(label, rss / 2**20))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--users", type=int, default=4, help="virtual users")
+    parser.add_argument(
+        "--duration", type=float, default=60, help="length of the test (s)"
+    )
+    parser.add_argument(
+        "--ramp-up", type=float, default=5, help="time to start all users (s)"
+    )
+    parser.add_argument(
+        "--think-time", type=float, default=1, help="mean time between actions (s)"
+    )
+    parser.add_argument(
+        "--pages", nargs="+", default=list_pages, help="pages users open"
+    )
+    parser.add_argument(
+        "--spread",
+        type=float,
+        default=0.3,
+        help="spread of random parameter values (log scale)",
+    )
+    parser.add_argument("--url", help="URL of a running server to test")
+    parser.add_argument(
+        "--pid", type=int, nargs="+", help="PIDs of the server processes (--url)"
+    )
+    parser.add_argument("--seed", type=int, help="random seed")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the output of the apps"
+    )
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    pids = args.pid
+    if args.url is None:
+        print("Load apps")
+        import app_server
+
+        application = app_server.application
+        pids = None
+
+    records = []
+    records_lock = threading.Lock()
+
+    def record(*item):
+        with records_lock:
+            records.append(item)
+
+    def make_client():
+        if args.url is None:
+            return LocalClient(application)
+        return HttpClient(args.url)
+
+    # Memory of a remote server is only known if its PIDs are given
+    memory = MemorySampler(pids) if args.url is None or pids else None
+
+    print(
+        "Run {} users for {:g} s on {}".format(
+            args.users, args.duration, args.url or "apps in this process"
+        )
+    )
+    t_start = time.perf_counter()
+    deadline = t_start + args.ramp_up + args.duration
+    users = []
+    for i in range(args.users):
+        user = VirtualUser(
+            make_client(), args.pages[i % len(args.pages)], record, args.spread
+        )
+        delay = args.ramp_up * i / max(args.users, 1)
+        thread = threading.Timer(delay, user.session, (deadline, args.think_time))
+        users.append(thread)
+
+    # The apps print progress of each simulation. Hide it unless verbose.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(
+        sys.stdout if args.verbose else devnull
+    ):
+        if memory is not None:
+            memory.start()
+        for thread in users:
+            thread.start()
+        for thread in users:
+            thread.join()
+        if memory is not None:
+            memory.stop()
+    duration = time.perf_counter() - t_start
+
+    summary = summarize(records, duration)
+    peak_memory = {} if memory is None else memory.peak
+    print_summary(summary, peak_memory, duration, len(records))
+
+    if args.output is not None:
+        results = {
+            "config": {
+                "users": args.users,
+                "duration": duration,
+                "think_time": args.think_time,
+                "pages": args.pages,
+                "url": args.url,
+                "environment": {
+                    key: value
+                    for key, value in os.environ.items()
+                    if key.startswith("AP_")
+                },
+            },
+            "summary": summary,
+            "peak_memory_mb": {
+                str(pid): rss / 2**20 for pid, rss in peak_memory.items()
+            },
+        }
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, default=float)
+        print("Results written to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
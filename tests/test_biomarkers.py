@@ -0,0 +1,101 @@
+"""Tests of compute_biomarkers and the crossing and peak helpers on synthetic traces."""
+
+import numpy as np
+import pytest
+
+import app_functions as funs
+
+
+def synthetic_ap(time, stim_time, duration):
+    """Action potential with a linear upstroke and cubic repolarisation"""
+    x = time - stim_time
+    repol = np.clip((x - 2) / duration, 0, 1) ** 3
+    return np.where(x < 0, -88, np.where(x < 2, -88 + 64 * x, 40 - 128 * repol)).astype(
+        float
+    )
+
+
+def synthetic_cat(time, stim_time, amplitude):
+    """Calcium transient peaking 50 ms after the stimulus"""
+    x = np.clip(time - stim_time, 0, None)
+    return 1e-4 + amplitude * (x / 50) * np.exp(1 - x / 50)
+
+
+@pytest.fixture
+def two_beats():
+    time = np.arange(0, 2000, 0.5)
+    voltage = np.where(
+        time < 1000, synthetic_ap(time, 0, 300), synthetic_ap(time, 1000, 250)
+    )
+    cai = np.where(
+        time < 1000, synthetic_cat(time, 0, 5e-4), synthetic_cat(time, 1000, 4e-4)
+    )
+    return time, voltage, cai
+
+
+def test_find_crossings():
+    arr = np.array([0.0, 2.0, 4.0, 2.0, 0.0])
+    np.testing.assert_array_equal(funs.find_crossings(arr, 3), [1, 2])
+    time = np.array([0.0, 1.0, 2.0, 3.0, 4.0])
+    np.testing.assert_allclose(funs.find_crossings(arr, 3, time=time), [1.5, 2.5])
+    rows = funs.find_crossings(np.array([arr, -arr]), 3)
+    assert len(rows) == 2
+    assert len(rows[1]) == 0
+
+
+def test_find_local_maxima():
+    time = np.linspace(0, 10, 101)
+    arr = -((time - 4.03) ** 2)
+    values, times = funs.find_local_maxima(arr, time, return_times=True)
+    np.testing.assert_allclose(times, [4.03])
+    np.testing.assert_allclose(values, [0], atol=1e-12)
+    assert len(funs.find_local_maxima(time)) == 0
+
+
+def test_ap_biomarkers(two_beats):
+    time, voltage, cai = two_beats
+    df = funs.compute_biomarkers(time, voltage, cai, stim_times=[0, 1000])
+    assert list(df["beat"]) == [0, 1]
+    assert list(df.columns) == funs.biomarker_columns_ap + funs.biomarker_columns_cat
+
+    # Repolarisation through -80 mV (5% of the way back to rest)
+    apd_expected = 2 + np.array([300, 250]) * (120 / 128) ** (1 / 3)
+    np.testing.assert_allclose(df["ap_start"], [0.125, 1000.125])
+    np.testing.assert_allclose(df["apd"], apd_expected - 0.125, atol=0.1)
+    np.testing.assert_allclose(df["v_peak"], [40, 40])
+    np.testing.assert_allclose(df["v_rest"], [-88, -88])
+    np.testing.assert_allclose(df["dvdt_max"], [64, 64])
+    assert (df["apd30"] < df["apd50"]).all()
+    assert (df["apd50"] < df["apd90"]).all()
+    assert (df["apd90"] < df["apd"]).all()
+    np.testing.assert_allclose(df["triangulation"], df["apd90"] - df["apd30"])
+
+
+def test_cat_biomarkers(two_beats):
+    time, voltage, cai = two_beats
+    df = funs.compute_biomarkers(time, voltage, cai, stim_times=[0, 1000])
+    np.testing.assert_allclose(df["cat_amplitude"], [6e-4, 5e-4], rtol=1e-6)
+    np.testing.assert_allclose(df["cai_diastolic"], [1e-4, 1e-4])
+    np.testing.assert_allclose(df["cat_rise"], [5e-4, 4e-4], rtol=1e-6)
+    np.testing.assert_allclose(df["cat_ttp"], [50, 50], atol=0.01)
+    assert (df["cat_tau"] > 0).all()
+
+
+def test_unexcited_beats_are_nan():
+    time = np.arange(0, 100, 1.0)
+    voltage = np.full(len(time), -88.0)
+    # Sub-threshold bump that still crosses -80 mV
+    voltage[10:20] = -70
+    cai = np.full(len(time), 1e-4)
+    df = funs.compute_biomarkers(time, voltage, cai, stim_times=[0, 50, 200])
+    assert len(df) == 3
+    assert df[["ap_start", "apd", "apd90", "activation_time"]].isna().all().all()
+    # No calcium peak, and the stimulus after the end of the trace is empty
+    assert df["cat_amplitude"].isna().all()
+    assert df.loc[2].drop(["beat", "stim_time"]).isna().all()
+
+
+def test_no_calcium():
+    time = np.arange(0, 1000, 0.5)
+    df = funs.compute_biomarkers(time, synthetic_ap(time, 0, 300))
+    assert list(df.columns) == funs.biomarker_columns_ap
@@ -0,0 +1,62 @@
+"""Tests of the compact encoding of figure data sent to the browser."""
+
+import base64
+import json
+
+import numpy as np
+import plotly.graph_objects as go
+
+import app_functions as funs
+
+
+def test_round_significant():
+    values = np.array([123456789.0, 0.00123456789, -9.87654321, 1 / 3])
+    np.testing.assert_array_equal(
+        funs.round_significant(values, 3), [123000000.0, 0.00123, -9.88, 0.333]
+    )
+    # Rounded values are written to JSON with at most digits significant digits
+    assert json.dumps(funs.round_significant(values, 7).tolist()) == (
+        "[123456800.0, 0.001234568, -9.876543, 0.3333333]"
+    )
+
+
+def test_round_significant_zero_and_non_finite():
+    values = np.array([0.0, -0.0, np.nan, np.inf, -np.inf, 1.23456])
+    rounded = funs.round_significant(values, 2)
+    np.testing.assert_array_equal(rounded, [0.0, 0.0, np.nan, np.inf, -np.inf, 1.2])
+
+
+def test_encode_array():
+    values = np.array([1 / 3, 2 / 3, 1e-9])
+    assert funs.encode_array(values) == [0.3333333, 0.6666667, 1e-9]
+    assert funs.encode_array(values, float32=False) == values.tolist()
+    # Integer arrays are sent as they are
+    assert funs.encode_array(np.arange(3)) == [0, 1, 2]
+
+    typed = funs.encode_array(values, typed_array=True)
+    assert typed["dtype"] == "f4"
+    decoded = np.frombuffer(base64.b64decode(typed["bdata"]), "<f4")
+    np.testing.assert_array_equal(decoded, values.astype(np.float32))
+    typed = funs.encode_array(values, float32=False, typed_array=True)
+    assert typed["dtype"] == "f8"
+
+    # Typed arrays made by plotly are decoded and encoded again
+    assert funs.encode_array(typed) == [0.3333333, 0.6666667, 1e-9]
+
+
+def test_compact_figure():
+    x = np.linspace(0, 1, 4)
+    fig = go.Figure(go.Scatter(x=x, y=x / 3))
+    fig.add_scatter(x=["a", "b"], y=[1, 2])
+
+    fig_dict = funs.compact_figure(fig, typed_array=False)
+    assert fig_dict["data"][0]["x"] == [0.0, 0.3333333, 0.6666667, 1.0]
+    assert fig_dict["data"][0]["y"] == [0.0, 0.1111111, 0.2222222, 0.3333333]
+    assert fig_dict["data"][1]["x"] == ["a", "b"]
+    assert fig_dict["data"][1]["y"] == [1, 2]
+    # The figure itself keeps full precision
+    np.testing.assert_array_equal(fig.data[0].y, x / 3)
+
+    fig_dict = funs.compact_figure(fig, typed_array=True)
+    assert fig_dict["data"][0]["y"]["dtype"] == "f4"
+    json.dumps(fig_dict)
@@ -0,0 +1,61 @@
+"""Tests of stream_export on synthetic chunks."""
+
+import gzip
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import app_functions as funs
+
+
+def make_chunks(num_chunks=3, rows=5):
+    for i in range(num_chunks):
+        time = i * rows + np.arange(rows, dtype=float)
+        yield funs.SimResult({"time": time, "membrane.v": np.sin(time)})
+
+
+def test_csv_gz():
+    data = b"".join(funs.stream_export(make_chunks(), "csv.gz"))
+    df = pd.read_csv(io.BytesIO(gzip.decompress(data)))
+    assert list(df.columns) == ["time", "membrane.v"]
+    np.testing.assert_array_equal(df["time"], np.arange(15.0))
+    np.testing.assert_allclose(df["membrane.v"], np.sin(np.arange(15.0)))
+
+
+def test_npz():
+    data = b"".join(funs.stream_export(make_chunks(), "npz"))
+    with np.load(io.BytesIO(data)) as npz:
+        assert sorted(npz.files) == ["membrane.v", "time"]
+        np.testing.assert_array_equal(npz["time"], np.arange(15.0))
+        np.testing.assert_array_equal(npz["membrane.v"], np.sin(np.arange(15.0)))
+
+
+def test_chunks_are_consumed_lazily():
+    consumed = []
+
+    def chunks():
+        for chunk in make_chunks():
+            consumed.append(chunk)
+            yield chunk
+
+    # Nothing is simulated until the download is read
+    stream = funs.stream_export(chunks(), "csv.gz")
+    assert consumed == []
+    b"".join(stream)
+    assert len(consumed) == 3
+
+
+def test_parquet():
+    pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+
+    data = b"".join(funs.stream_export(make_chunks(), "parquet"))
+    table = pq.read_table(io.BytesIO(data))
+    np.testing.assert_array_equal(table["time"].to_numpy(), np.arange(15.0))
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        funs.stream_export(make_chunks(), "xlsx")
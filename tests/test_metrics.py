@@ -0,0 +1,85 @@
+"""Tests of RequestMetrics and its Prometheus text exposition."""
+
+import pytest
+
+import app_functions as funs
+
+
+def samples(metrics):
+    """Sample lines of the exposition, as a dict of name and labels -> value"""
+    lines = metrics.exposition().splitlines()
+    return dict(line.rsplit(" ", 1) for line in lines if not line.startswith("#"))
+
+
+def test_histogram_buckets():
+    metrics = funs.RequestMetrics()
+    for wall_ms in [0.5, 20, 20, 90000]:
+        metrics.observe_span(
+            {"request_id": "r", "span": "run_reg_stim", "wall_ms": wall_ms}
+        )
+    values = samples(metrics)
+
+    def bucket(le):
+        name = 'ap_request_seconds_bucket{{request="run_reg_stim",le="{}"}}'
+        return values[name.format(le)]
+
+    # Buckets are cumulative
+    assert bucket("0.001") == "1"
+    assert bucket("0.01") == "1"
+    assert bucket("0.05") == "3"
+    assert bucket("60") == "3"
+    assert bucket("120") == "4"
+    assert bucket("+Inf") == "4"
+    assert values['ap_request_seconds_count{request="run_reg_stim"}'] == "4"
+    total = float(values['ap_request_seconds_sum{request="run_reg_stim"}'])
+    assert total == pytest.approx(90.0405)
+    assert "# TYPE ap_request_seconds histogram" in metrics.exposition()
+
+
+def test_counters():
+    metrics = funs.RequestMetrics()
+    records = [
+        {
+            "request_id": "r",
+            "span": "run_reg_stim/prepace",
+            "wall_ms": 500,
+            "simulated_ms": 96000,
+            "cache": "miss",
+        },
+        {
+            "request_id": "r",
+            "span": "run_reg_stim/prepace",
+            "wall_ms": 1,
+            "cache": "hit",
+        },
+        {"request_id": "r", "span": "run_reg_stim", "wall_ms": 2, "error": "KeyError"},
+        # Records outside of requests are not counted
+        {"request_id": None, "span": "run_reg_stim", "wall_ms": 2, "cache": "hit"},
+    ]
+    for record in records:
+        metrics.observe_span(record)
+    values = samples(metrics)
+
+    assert values['ap_simulated_seconds_total{request="run_reg_stim"}'] == "96.0"
+    assert values['ap_solver_seconds_total{request="run_reg_stim"}'] == "0.5"
+    assert values['ap_cache_lookups_total{result="hit",stage="prepace"}'] == "1"
+    assert values['ap_cache_lookups_total{result="miss",stage="prepace"}'] == "1"
+    assert (
+        values['ap_request_errors_total{error="KeyError",request="run_reg_stim"}']
+        == "1"
+    )
+    assert 'ap_stage_seconds_count{request="run_reg_stim",stage="prepace"}' in values
+
+
+def test_stats():
+    metrics = funs.RequestMetrics()
+    metrics.add_stats(
+        "pool", lambda: {"in_use": 2, "checkouts": 10, "name": "x"}, ["checkouts"]
+    )
+    values = samples(metrics)
+    assert values["ap_pool_in_use"] == "2"
+    assert values["ap_pool_checkouts_total"] == "10"
+    assert "ap_pool_name" not in values
+    exposition = metrics.exposition()
+    assert "# TYPE ap_pool_in_use gauge" in exposition
+    assert "# TYPE ap_pool_checkouts_total counter" in exposition
@@ -0,0 +1,109 @@
+"""Tests of ResultStore memory eviction and storage on disk."""
+
+import os
+import pickle
+
+import numpy as np
+
+import app_functions as funs
+
+
+def make_result(value, size=1000):
+    return funs.SimResult({"time": np.arange(size, dtype=float) + value})
+
+
+def result_size(result):
+    return len(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def test_put_and_get():
+    store = funs.ResultStore()
+    result = make_result(0)
+    result_id = store.put(result)
+    assert store.valid_id(result_id)
+    assert store.put(make_result(0)) == result_id
+    assert len(store) == 1
+    np.testing.assert_array_equal(store.get(result_id)["time"], result["time"])
+    assert store.get("0" * 32) is None
+    assert store.stats()["hits"] == 1
+    assert store.stats()["misses"] == 1
+
+
+def test_invalid_ids_are_misses(tmp_path):
+    store = funs.ResultStore(path=str(tmp_path))
+    (tmp_path / "secret.pkl").write_bytes(pickle.dumps("secret"))
+    for result_id in ["../secret", "secret", "A" * 32, 123, None]:
+        assert store.get(result_id) is None
+    assert store.stats()["misses"] == 5
+
+
+def test_eviction_in_memory():
+    size = result_size(make_result(0))
+    store = funs.ResultStore(max_bytes=2 * size)
+    result_ids = [store.put(make_result(i)) for i in range(3)]
+    assert len(store) == 2
+    assert store.nbytes == 2 * size
+    assert store.get(result_ids[0]) is None
+    assert store.get(result_ids[2]) is not None
+
+    # The newest result is kept even if it is over the limit
+    store.put(make_result(0, size=10000))
+    assert len(store) == 1
+
+
+def test_results_written_through(tmp_path):
+    size = result_size(make_result(0))
+    store = funs.ResultStore(path=str(tmp_path), max_bytes=2 * size)
+    result_ids = [store.put(make_result(i)) for i in range(2)]
+    # Results are written to disk when stored, so other processes can read them
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        "{}.pkl".format(result_id) for result_id in result_ids
+    )
+    assert store.stats()["files"] == 2
+    assert store.disk_bytes == 2 * size
+    store_other = funs.ResultStore(path=str(tmp_path))
+    result = store_other.get(result_ids[1])
+    np.testing.assert_array_equal(result["time"], make_result(1)["time"])
+    assert store_other.stats()["disk_hits"] == 1
+
+    # Storing a result again doesn't rewrite its file
+    store.put(make_result(0))
+    assert store.stats()["files"] == 2
+    assert store.disk_bytes == 2 * size
+
+    # Results evicted from memory are read back from disk
+    store.put(make_result(2))
+    result = store.get(result_ids[1])
+    np.testing.assert_array_equal(result["time"], make_result(1)["time"])
+    assert store.stats()["disk_hits"] == 1
+    assert store.stats()["files"] == 3
+    assert store.disk_bytes == 3 * size
+
+
+def test_disk_limit(tmp_path):
+    size = result_size(make_result(0))
+    store = funs.ResultStore(
+        path=str(tmp_path), max_bytes=size, max_disk_bytes=2 * size
+    )
+    result_ids = [store.put(make_result(i)) for i in range(5)]
+    # Only the newest two files are kept
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        "{}.pkl".format(result_id) for result_id in result_ids[3:]
+    )
+    assert store.disk_bytes == 2 * size
+    assert store.get(result_ids[0]) is None
+
+    # Files left by an earlier process are counted on creation
+    store_restart = funs.ResultStore(path=str(tmp_path))
+    assert store_restart.stats()["files"] == 2
+    assert store_restart.disk_bytes == 2 * size
+    assert store_restart.get(result_ids[3]) is not None
+
+
+def test_write_error_keeps_result_in_memory(tmp_path):
+    path = tmp_path / "file"
+    path.write_text("")
+    store = funs.ResultStore(path=str(path))
+    result_id = store.put(make_result(0))
+    assert store.get(result_id) is not None
+    assert store.stats()["files"] == 0
@@ -0,0 +1,167 @@
+"""Tests of admission control (RunScheduler) and run costs."""
+
+import threading
+import time
+
+import myokit
+import pytest
+
+import app_functions as funs
+
+
+def admit_in_thread(scheduler, session_id, cost, started, control=None):
+    """Start a run in a thread that holds its place until release is set"""
+    release = threading.Event()
+    errors = []
+
+    def run():
+        try:
+            with scheduler.admit(session_id, cost, control):
+                started.append(session_id)
+                release.wait()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, release, errors
+
+
+def wait_for(condition, timeout=5):
+    t_end = time.time() + timeout
+    while not condition():
+        assert time.time() < t_end, "timed out"
+        time.sleep(0.01)
+
+
+def test_invalid_limits():
+    with pytest.raises(ValueError):
+        funs.RunScheduler(max_cost=10, budget=10, interactive_cost=5)
+
+
+def test_reject_over_max_cost():
+    scheduler = funs.RunScheduler(max_cost=100, budget=300, interactive_cost=50)
+    with pytest.raises(funs.RunRejected):
+        with scheduler.admit("a", 101):
+            pass
+    with scheduler.admit("a", 100):
+        assert scheduler.stats()["cost_in_progress"] == 100
+    stats = scheduler.stats()
+    assert stats["cost_in_progress"] == 0
+    assert stats["admitted"] == 1
+    assert stats["rejected"] == 1
+
+
+def test_budget():
+    scheduler = funs.RunScheduler(max_cost=100, budget=150, interactive_cost=50)
+    started = []
+    thread_a, release_a, _ = admit_in_thread(scheduler, "a", 100, started)
+    wait_for(lambda: started == ["a"])
+
+    # Sweeps may only use budget - interactive_cost, so b waits for a
+    thread_b, release_b, _ = admit_in_thread(scheduler, "b", 60, started)
+    wait_for(lambda: scheduler.stats()["waiting"] == 1)
+    # An interactive run still fits
+    with scheduler.admit("c", 50):
+        assert scheduler.stats()["cost_in_progress"] == 150
+    assert started == ["a"]
+
+    release_a.set()
+    wait_for(lambda: started == ["a", "b"])
+    release_b.set()
+    thread_a.join()
+    thread_b.join()
+    assert scheduler.stats()["cost_in_progress"] == 0
+
+
+def test_session_limit():
+    scheduler = funs.RunScheduler(
+        max_cost=100, budget=1000, session_limit=1, interactive_cost=50
+    )
+    started = []
+    thread_a, release_a, _ = admit_in_thread(scheduler, "a", 10, started)
+    wait_for(lambda: started == ["a"])
+    thread_a2, release_a2, _ = admit_in_thread(scheduler, "a", 10, started)
+    wait_for(lambda: scheduler.stats()["waiting"] == 1)
+
+    # Other sessions are not held up by session a
+    with scheduler.admit("b", 10):
+        pass
+    # Nor are runs without a session
+    with scheduler.admit(None, 10):
+        pass
+    assert started == ["a"]
+
+    release_a.set()
+    wait_for(lambda: started == ["a", "a"])
+    release_a2.set()
+    thread_a.join()
+    thread_a2.join()
+
+
+def test_interactive_runs_first():
+    scheduler = funs.RunScheduler(max_cost=100, budget=200, interactive_cost=50)
+    started = []
+    thread_a, release_a, _ = admit_in_thread(scheduler, "a", 100, started)
+    thread_b, release_b, _ = admit_in_thread(scheduler, "b", 100, started)
+    wait_for(lambda: len(started) == 1 and scheduler.stats()["waiting"] == 1)
+
+    # c (interactive) arrives after b (sweep) but starts first, as b doesn't
+    # fit in the budget of sweeps until a finishes
+    thread_c, release_c, _ = admit_in_thread(scheduler, "c", 50, started)
+    wait_for(lambda: len(started) == 2)
+    assert started[1] == "c"
+
+    release_a.set()
+    release_c.set()
+    wait_for(lambda: len(started) == 3)
+    release_b.set()
+    for thread in [thread_a, thread_b, thread_c]:
+        thread.join()
+
+
+def test_cancel_and_timeout_while_waiting():
+    scheduler = funs.RunScheduler(max_cost=100, budget=150, interactive_cost=50)
+    started = []
+    thread_a, release_a, _ = admit_in_thread(scheduler, "a", 100, started)
+    wait_for(lambda: started == ["a"])
+
+    control = funs.RunControl()
+    thread_b, _, errors_b = admit_in_thread(scheduler, "b", 100, started, control)
+    wait_for(lambda: scheduler.stats()["waiting"] == 1)
+    control.cancel()
+    thread_b.join(timeout=5)
+    assert isinstance(errors_b[0], myokit.SimulationCancelledError)
+
+    with pytest.raises(funs.RunRejected):
+        with scheduler.admit("c", 100, funs.RunControl(timeout=0.2)):
+            pass
+    assert scheduler.stats()["waiting"] == 0
+
+    release_a.set()
+    thread_a.join()
+    assert started == ["a"]
+
+
+def test_max_waiting():
+    scheduler = funs.RunScheduler(
+        max_cost=100, budget=150, interactive_cost=50, max_waiting=1
+    )
+    started = []
+    thread_a, release_a, _ = admit_in_thread(scheduler, "a", 100, started)
+    wait_for(lambda: started == ["a"])
+    thread_b, release_b, _ = admit_in_thread(scheduler, "b", 100, started)
+    wait_for(lambda: scheduler.stats()["waiting"] == 1)
+    with pytest.raises(funs.RunRejected):
+        with scheduler.admit("c", 10):
+            pass
+    release_a.set()
+    release_b.set()
+    thread_a.join()
+    thread_b.join()
+
+
+def test_costs():
+    assert funs.sim_model_cost(1000, 100) == 1e5
+    assert funs.s1s2_cost(1000, 10, "300:500:100") == 1000 * (10 + 2 * 2)
+    assert funs.rate_change_cost("500, 1000", 10) == 500 * 13 + 1000 * 13
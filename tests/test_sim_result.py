@@ -0,0 +1,72 @@
+"""Tests of SimResult on synthetic columns."""
+
+import array
+import json
+
+import numpy as np
+import pytest
+
+import app_functions as funs
+
+
+def make_result(**kwargs):
+    return funs.SimResult(
+        {"time": np.arange(4.0), "membrane.v": np.array([-88.0, 40.0, 0.0, -85.0])},
+        **kwargs,
+    )
+
+
+def test_columns_and_length():
+    df = make_result(attrs={"prepace_beats": 96})
+    assert df.columns == ["time", "membrane.v"]
+    assert len(df) == 4
+    assert "time" in df and "cai" not in df
+    assert df.attrs == {"prepace_beats": 96}
+    assert df.nbytes == 2 * 4 * 8
+
+
+def test_logged_array_is_not_copied():
+    logged = array.array("d", [0.0, 1.0, 2.0])
+    df = funs.SimResult({"time": logged})
+    logged[1] = 5.0
+    assert df["time"][1] == 5.0
+
+
+def test_unequal_columns_rejected():
+    with pytest.raises(ValueError):
+        funs.SimResult({"time": [0.0, 1.0], "membrane.v": [0.0]})
+    df = make_result()
+    with pytest.raises(ValueError):
+        df["membrane.v"] = [0.0]
+
+
+def test_scalar_column_is_repeated():
+    df = make_result()
+    df["bcl"] = 1000
+    np.testing.assert_array_equal(df["bcl"], [1000] * 4)
+
+
+def test_float32_keeps_time():
+    df = make_result(float32=True)
+    assert df["time"].dtype == np.float64
+    assert df["membrane.v"].dtype == np.float32
+
+
+def test_concat():
+    df = funs.SimResult.concat([make_result(attrs={"prepace_beats": 1}), make_result()])
+    assert len(df) == 8
+    assert df.attrs == {"prepace_beats": 1}
+    np.testing.assert_array_equal(df["time"], np.tile(np.arange(4.0), 2))
+    assert len(funs.SimResult.concat([])) == 0
+
+
+def test_conversions():
+    df = make_result(attrs={"completed": 4})
+    df_pandas = df.to_pandas()
+    assert list(df_pandas.columns) == df.columns
+    assert df_pandas.attrs == {"completed": 4}
+    assert df.to_dict()["membrane.v"] == [-88.0, 40.0, 0.0, -85.0]
+    assert df.to_dict("records")[1] == {"time": 1.0, "membrane.v": 40.0}
+    assert json.loads(df.to_json()) == df.to_dict()
+    with pytest.raises(ValueError):
+        df.to_dict("index")
@@ -0,0 +1,79 @@
+"""Tests of SteadyStateCache persistence and steady state keys of models."""
+
+import json
+import threading
+
+import myokit
+
+import app_functions as funs
+
+
+def test_concurrent_puts(tmp_path):
+    path = tmp_path / "steady_states.json"
+    cache = funs.SteadyStateCache(path=str(path), maxsize=1000, save_interval=0)
+    errors = []
+
+    def put_states(i):
+        try:
+            for j in range(100):
+                cache.put("{}-{}".format(i, j), [float(j)])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=put_states, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    cache.flush()
+    assert len(json.loads(path.read_text())) == 400
+    # No temporary files are left behind
+    assert [p.name for p in tmp_path.iterdir()] == ["steady_states.json"]
+
+
+def test_save_interval(tmp_path):
+    path = tmp_path / "steady_states.json"
+    cache = funs.SteadyStateCache(path=str(path), save_interval=3600)
+    cache.put("a", [1.0])
+    cache.put("b", [2.0])
+    # Only the first put is written until the interval has passed
+    assert [key for key, _ in json.loads(path.read_text())] == ["a"]
+    cache.flush()
+    assert [key for key, _ in json.loads(path.read_text())] == ["a", "b"]
+
+    cache_restart = funs.SteadyStateCache(path=str(path))
+    assert cache_restart.get("b") == [2.0]
+
+
+def test_write_error_is_not_raised(tmp_path):
+    # The parent of the cache file is a file, so it can't be written
+    (tmp_path / "file").write_text("")
+    cache = funs.SteadyStateCache(path=str(tmp_path / "file" / "states.json"))
+    cache.put("a", [1.0])
+    assert cache.get("a") == [1.0]
+
+
+def test_key_depends_on_model():
+    model = myokit.parse_model("""
+        [[model]]
+        c.x = 0
+
+        [c]
+        t = 0 bind time
+        k = 1
+        dot(x) = -k * x
+        """)
+    model_edited = model.clone()
+    model_edited.get("c.k").set_rhs(2)
+    hash_original = funs.model_code_hash(model)
+    assert hash_original == funs.model_code_hash(model.clone())
+    assert hash_original != funs.model_code_hash(model_edited)
+
+    key = funs.steady_state_key({}, 1000, 96, model_hash=hash_original)
+    assert key != funs.steady_state_key(
+        {}, 1000, 96, model_hash=funs.model_code_hash(model_edited)
+    )
+    cache = funs.SteadyStateCache(model=model)
+    assert cache.model_hash == hash_original
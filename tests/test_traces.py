@@ -0,0 +1,80 @@
+"""Tests of multi-resolution trace serving on synthetic traces."""
+
+import numpy as np
+
+import app_functions as funs
+
+
+def spiky_trace(n=100000, period=10000):
+    """Flat trace with a one-sample spike every period samples"""
+    x = np.arange(n, dtype=float)
+    y = np.zeros(n)
+    y[period // 2 :: period] = 1
+    y[period // 2 + 1 :: period] = -1
+    return x, y
+
+
+def test_pyramid_levels():
+    x, y = spiky_trace()
+    pyramid = funs.TracePyramid(x, y, min_points=500)
+    sizes = [len(level_x) for level_x, _ in pyramid.levels]
+    assert sizes[0] == len(x)
+    # Samples left over from the blocks of four are kept
+    assert all(
+        size_next == size // 4 * 2 + size % 4
+        for size, size_next in zip(sizes, sizes[1:])
+    )
+    assert sizes[-1] <= 500
+    # Every level keeps the spikes, in x order
+    for level_x, level_y in pyramid.levels:
+        assert np.all(np.diff(level_x) >= 0)
+        assert (level_y == 1).sum() == 10
+        assert (level_y == -1).sum() == 10
+
+
+def test_pyramid_select():
+    x, y = spiky_trace()
+    pyramid = funs.TracePyramid(x, y)
+
+    x_all, y_all = pyramid.select(max_points=5000)
+    assert len(x_all) <= 5000
+    assert x_all[0] == 0 and x_all[-1] > 0.99 * x[-1]
+
+    # Zoomed in far enough, the trace is served at full resolution, with one
+    # point either side of the window
+    x_zoom, y_zoom = pyramid.select((1000, 2000), max_points=5000)
+    np.testing.assert_array_equal(x_zoom, np.arange(999, 2002))
+    np.testing.assert_array_equal(y_zoom, y[999:2002])
+
+    x_zoom, _ = pyramid.select((1000, None), max_points=5000)
+    assert len(x_zoom) <= 5000
+    assert x_zoom[0] <= 1000 and x_zoom[-1] > 0.99 * x[-1]
+
+
+def test_decimate_traces():
+    x, y = spiky_trace()
+    groups = np.repeat([300, 400], len(x) // 2)
+    data = funs.decimate_traces(
+        {"time": x, "membrane.v": y, "s2_interval": groups},
+        "time",
+        "membrane.v",
+        "s2_interval",
+        max_points=10000,
+    )
+    assert len(data["time"]) <= 10000
+    assert set(data["s2_interval"]) == {300, 400}
+    assert (data["membrane.v"] == 1).sum() == 10
+
+    # Short traces are left as they are
+    data = funs.decimate_traces({"time": x[:100], "y": y[:100]}, "time", "y")
+    np.testing.assert_array_equal(data["time"], x[:100])
+
+
+def test_relayout_x_range():
+    assert funs.relayout_x_range(None) is None
+    assert funs.relayout_x_range({}) is None
+    assert funs.relayout_x_range({"xaxis.range[0]": 1, "xaxis.range[1]": 2}) == (1, 2)
+    assert funs.relayout_x_range({"xaxis.range": [3, 4]}) == (3, 4)
+    assert funs.relayout_x_range({"xaxis.autorange": True}) == (None, None)
+    # Zooming only the y-axis doesn't change the x window
+    assert funs.relayout_x_range({"yaxis.range[0]": 0, "yaxis.range[1]": 1}) is None
@@ -0,0 +1,68 @@
+"""Tests of the nearest-neighbour warm start store and steady state keys."""
+
+import app_functions as funs
+
+reference_params = {"multipliers.i_Kr_multiplier": 1, "environment.celltype": 0}
+
+
+def test_nearest():
+    store = funs.WarmStartStore(reference_params, bcl_scale=1000, max_distance=0.5)
+    assert store.nearest({}, 1000) is None
+
+    store.add({"multipliers.i_Kr_multiplier": 1}, 1000, [1.0])
+    store.add({"multipliers.i_Kr_multiplier": 2}, 1000, [2.0])
+    store.add({"multipliers.i_Kr_multiplier": 1}, 500, [3.0])
+    assert len(store) == 3
+
+    assert store.nearest({"multipliers.i_Kr_multiplier": 1.1}, 1000) == [1.0]
+    assert store.nearest({"multipliers.i_Kr_multiplier": 1.8}, 1000) == [2.0]
+    assert store.nearest({}, 600) == [3.0]
+    # Parameters not given take their reference value
+    assert store.nearest({}, 1000) == [1.0]
+    # Further than max_distance from every stored state
+    assert store.nearest({"multipliers.i_Kr_multiplier": 3}, 2000) is None
+
+    stats = store.stats()
+    assert stats["queries"] == 6
+    assert stats["warm_starts"] == 4
+
+
+def test_nearest_same_celltype():
+    store = funs.WarmStartStore(reference_params)
+    store.add({"environment.celltype": 1}, 1000, [1.0])
+    assert store.nearest({}, 1000) is None
+    assert store.nearest({"environment.celltype": 1}, 1000) == [1.0]
+
+
+def test_returns_copy():
+    store = funs.WarmStartStore(reference_params)
+    store.add({}, 1000, [1.0])
+    state = store.nearest({}, 1000)
+    state[0] = 5.0
+    assert store.nearest({}, 1000) == [1.0]
+
+
+def test_maxsize():
+    store = funs.WarmStartStore(reference_params, maxsize=2)
+    store.add({}, 1000, [1.0])
+    store.add({}, 1100, [2.0])
+    store.add({"environment.celltype": 1}, 1000, [3.0])
+    assert len(store) == 2
+    # The oldest state of the most common cell type was dropped
+    assert store.nearest({}, 1000) == [2.0]
+    assert store.nearest({"environment.celltype": 1}, 1000) == [3.0]
+
+
+def test_steady_state_key():
+    params = {"multipliers.i_Kr_multiplier": 1, "environment.celltype": 0}
+    key = funs.steady_state_key(params, 1000, 96)
+    assert key == funs.steady_state_key(
+        {"environment.celltype": 0.0, "multipliers.i_Kr_multiplier": 1.0}, 1000, 96
+    )
+    assert key != funs.steady_state_key(params, 1000, 95)
+    assert key != funs.steady_state_key(params, 500, 96)
+    # Adaptive (possibly warm started) prepacing is cached separately
+    assert key != funs.steady_state_key(params, 1000, 96, adaptive=True)
+    assert funs.steady_state_key(
+        params, 1000, 96, rtol=1e-4, adaptive=True
+    ) != funs.steady_state_key(params, 1000, 96, rtol=1e-5, adaptive=True)